@@ -0,0 +1,337 @@
+'''
+Local stand-in for the Golem network, used by the benchmarks.
+
+`LocalServiceManager` replaces `yapapi_service_manager.ServiceManager`: every service it creates gets its own
+`LocalProvider`, that is:
+
+*   a sandbox directory that replaces the provider-side /golem/work (commands from the scripts are executed
+    locally, with paths rewritten to the sandbox, files are "uploaded"/"downloaded" by copying)
+*   a HTTP server (gunicorn with the given WSGI app, e.g. one from examples/), listening both on a local TCP
+    port and on the sandbox counterpart of /tmp/golem.sock
+*   a websocket tunnel to the server port (`LocalTunnel`), the same way yagna exposes the VPN network node
+
+Services themselves (VPNService, FileSerializationService) are the real ones, so the whole requestor-side code
+is measured.
+'''
+import asyncio
+import logging
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+from types import SimpleNamespace
+from typing import TYPE_CHECKING
+
+from aiohttp import web, WSMsgType
+
+from ya_httpx_client.cluster import Cluster
+
+if TYPE_CHECKING:
+    from typing import Any, AsyncGenerator, Dict, List, Optional, Tuple
+    from ya_httpx_client.service.service_base import AbstractServiceBase
+
+logger = logging.getLogger(__name__)
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#   Provider-side paths used by the services
+PROVIDER_WORK_DIR = '/golem/work'
+PROVIDER_SOCKET = '/tmp/golem.sock'
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class CommandError(Exception):
+    pass
+
+
+class LocalTunnel:
+    '''Websocket <-> TCP bridge: ws://127.0.0.1:{port}/{target_port} is connected to 127.0.0.1:{target_port}'''
+    def __init__(self) -> None:
+        self.port = free_port()
+        self._runner: 'Optional[web.AppRunner]' = None
+
+    def uri(self, target_port: int) -> str:
+        return f'ws://127.0.0.1:{self.port}/{target_port}'
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_get('/{target_port}', self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, '127.0.0.1', self.port).start()
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    @staticmethod
+    async def _handle(request: 'web.Request') -> 'web.WebSocketResponse':
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        reader, writer = await asyncio.open_connection('127.0.0.1', int(request.match_info['target_port']))
+
+        async def tcp_to_ws() -> None:
+            while True:
+                data = await reader.read(2 ** 16)
+                if not data:
+                    break
+                await ws.send_bytes(data)
+            await ws.close()
+
+        pump = asyncio.ensure_future(tcp_to_ws())
+        try:
+            async for msg in ws:
+                if msg.type == WSMsgType.BINARY:
+                    writer.write(msg.data)
+                    await writer.drain()
+        finally:
+            writer.close()
+            if not pump.done():
+                pump.cancel()
+        return ws
+
+
+class LocalScript:
+    '''Records the commands the same way yapapi.script.Script does (only the part used by our services)'''
+    def __init__(self) -> None:
+        self.commands: 'List[Tuple[str, Tuple[Any, ...]]]' = []
+
+    def add(self, cmd: 'Any') -> None:
+        #   yapapi.script.command.Run
+        self.commands.append(('run', (cmd.cmd, *cmd.args)))
+
+    def run(self, cmd: str, *args: str, **_kwargs) -> None:
+        self.commands.append(('run', (cmd, *args)))
+
+    def upload_file(self, src_path: str, dst_path: str, **_kwargs) -> None:
+        self.commands.append(('upload', (src_path, dst_path)))
+
+    def download_file(self, src_path: str, dst_path: str, **_kwargs) -> None:
+        self.commands.append(('download', (src_path, dst_path)))
+
+    def deploy(self, **_kwargs) -> None:
+        pass
+
+    def start(self, *_args) -> None:
+        pass
+
+    def terminate(self) -> None:
+        pass
+
+
+class LocalProvider:
+    '''A single "provider": sandbox directory, HTTP server and commands executed there'''
+    def __init__(self, name: str, app: str, app_dir: str, server_workers: int):
+        self.name = name
+        self.app = app
+        self.app_dir = app_dir
+        self.server_workers = server_workers
+
+        self.sandbox = tempfile.mkdtemp(prefix=f'yhc_bench_{name}_')
+        self.work_dir = os.path.join(self.sandbox, 'work')
+        self.socket_path = os.path.join(self.sandbox, 'golem.sock')
+        self.server_port = free_port()
+        os.makedirs(self.work_dir)
+
+        #   Process groups of everything started here (including background processes, e.g. the worker)
+        self._process_groups: 'List[int]' = []
+
+        self.env = dict(os.environ)
+        self.env['PATH'] = os.path.dirname(sys.executable) + os.pathsep + self.env.get('PATH', '')
+        self.env['PYTHONPATH'] = REPO_ROOT + os.pathsep + self.env.get('PYTHONPATH', '')
+
+    async def start(self) -> None:
+        await self._spawn(
+            sys.executable, '-m', 'gunicorn', '--chdir', self.app_dir, '--workers', str(self.server_workers),
+            '-b', f'127.0.0.1:{self.server_port}', '-b', f'unix:{self.socket_path}', self.app,
+        )
+        while True:
+            try:
+                _, writer = await asyncio.open_connection('127.0.0.1', self.server_port)
+                writer.close()
+                break
+            except OSError:
+                await asyncio.sleep(0.05)
+        while not os.path.exists(self.socket_path):
+            await asyncio.sleep(0.05)
+
+    def stop(self) -> None:
+        for pgid in self._process_groups:
+            try:
+                os.killpg(pgid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        shutil.rmtree(self.sandbox, ignore_errors=True)
+
+    def local_port(self, port: int) -> int:
+        if port != 80:
+            raise ValueError(f'Nothing is listening on port {port}')
+        return self.server_port
+
+    async def execute(self, script: LocalScript) -> None:
+        for command, args in script.commands:
+            if command == 'run':
+                proc = await self._spawn(*(self._rewrite(arg) for arg in args))
+                return_code = await proc.wait()
+                if return_code:
+                    raise CommandError(f'{args} failed on {self.name} with exit code {return_code}')
+            elif command == 'upload':
+                src_path, dst_path = args
+                shutil.copy(src_path, self._rewrite(dst_path))
+            elif command == 'download':
+                src_path, dst_path = args
+                shutil.copy(self._rewrite(src_path), dst_path)
+
+    async def _spawn(self, *args: str) -> 'asyncio.subprocess.Process':
+        proc = await asyncio.create_subprocess_exec(
+            *args, cwd=self.work_dir, env=self.env, start_new_session=True,
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL,
+        )
+        self._process_groups.append(proc.pid)
+        return proc
+
+    def _rewrite(self, arg: str) -> str:
+        return arg.replace(PROVIDER_WORK_DIR, self.work_dir).replace(PROVIDER_SOCKET, self.socket_path)
+
+
+class LocalWorkContext:
+    '''Replaces yapapi.WorkContext'''
+    def __init__(self, provider: LocalProvider):
+        self.provider_name = provider.name
+        self.provider_id = provider.name
+
+    @staticmethod
+    def new_script(*_args, **_kwargs) -> LocalScript:
+        return LocalScript()
+
+
+class LocalNetworkNode:
+    '''Replaces yapapi.network.Node'''
+    def __init__(self, provider: LocalProvider, tunnel: LocalTunnel):
+        self.provider = provider
+        self.tunnel = tunnel
+
+    def get_deploy_args(self) -> 'Dict[str, Any]':
+        return {}
+
+    def get_websocket_uri(self, port: int) -> str:
+        return self.tunnel.uri(self.provider.local_port(port))
+
+
+class LocalNetwork:
+    '''Replaces yapapi.network.Network (providers are not tracked, so the network always looks empty)'''
+    owner_ip = '192.168.0.1'
+    nodes_dict: 'Dict[str, str]' = {}
+
+    async def remove(self) -> None:
+        pass
+
+
+class LocalServiceWrapper:
+    '''Replaces yapapi_service_manager.ServiceWrapper: drives the service's start/run/shutdown scripts'''
+    def __init__(self, service: 'AbstractServiceBase', provider: LocalProvider):
+        self.service = service
+        self.provider = provider
+        self.status = 'pending'
+        self._task = asyncio.ensure_future(self._run())
+        self._stopped = asyncio.get_event_loop().create_future()
+
+    def stop(self) -> None:
+        if not self._task.done():
+            self._task.cancel()
+        asyncio.ensure_future(self._shutdown())
+
+    async def wait_stopped(self) -> None:
+        await asyncio.shield(self._stopped)
+
+    async def _run(self) -> None:
+        try:
+            await self.provider.start()
+            self.status = 'starting'
+            await self._drive(self.service.start())
+            self.status = 'running'
+            await self._drive(self.service.run())
+        except asyncio.CancelledError:  # pylint: disable=try-except-raise
+            #   Before python 3.8 CancelledError is an Exception
+            raise
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Service on %s failed', self.provider.name)
+            self.status = 'failed'
+
+    async def _shutdown(self) -> None:
+        if self._stopped.done():
+            return
+        try:
+            await asyncio.gather(self._task, return_exceptions=True)
+            if self.status != 'failed':
+                self.status = 'stopping'
+                await self._drive(self.service.shutdown())
+                self.status = 'stopped'
+        finally:
+            self.provider.stop()
+            if not self._stopped.done():
+                self._stopped.set_result(None)
+
+    async def _drive(self, gen: 'AsyncGenerator[Any, Any]') -> None:
+        '''Execute scripts yielded by the service, the same way yapapi does'''
+        try:
+            script = await gen.__anext__()  # pylint: disable=unnecessary-dunder-call
+            while True:
+                try:
+                    await self.provider.execute(script)
+                except CommandError as e:
+                    script = await gen.athrow(e)
+                else:
+                    script = await gen.asend(None)
+        except StopAsyncIteration:
+            pass
+
+
+class LocalServiceManager:
+    '''Replaces yapapi_service_manager.ServiceManager - every service runs on a new LocalProvider'''
+    def __init__(self, tunnel: LocalTunnel, app: str, app_dir: str, server_workers: int = 1):
+        self.tunnel = tunnel
+        self.app = app
+        self.app_dir = app_dir
+        self.server_workers = server_workers
+        self.service_wrappers: 'List[LocalServiceWrapper]' = []
+
+        #   Services use `self.cluster._engine._api_config.app_key` for the websocket authorization
+        self._yapapi_cluster = SimpleNamespace(_engine=SimpleNamespace(_api_config=SimpleNamespace(app_key='local')))
+
+    def create_service(self, service_cls, run_service_params) -> LocalServiceWrapper:
+        provider = LocalProvider(f'local-{len(self.service_wrappers)}', self.app, self.app_dir, self.server_workers)
+
+        service = service_cls(**run_service_params['instance_params'][0])
+        service._set_ctx(LocalWorkContext(provider))  # pylint: disable=protected-access
+        service._set_network_node(LocalNetworkNode(provider, self.tunnel))  # pylint: disable=protected-access
+        service._set_cluster(self._yapapi_cluster)  # pylint: disable=protected-access
+
+        service_wrapper = LocalServiceWrapper(service, provider)
+        self.service_wrappers.append(service_wrapper)
+        return service_wrapper
+
+    async def create_network(self, *_args, **_kwargs) -> LocalNetwork:
+        return LocalNetwork()
+
+    async def wait_running(self, cnt: int) -> None:
+        while sum(1 for wrapper in self.service_wrappers if wrapper.status == 'running') < cnt:
+            await asyncio.sleep(0.05)
+
+    async def close(self) -> None:
+        for service_wrapper in self.service_wrappers:
+            service_wrapper.stop()
+        await asyncio.gather(*(service_wrapper.wait_stopped() for service_wrapper in self.service_wrappers))
+
+
+class LocalCluster(Cluster):
+    '''Cluster that doesn't need the image repository'''
+    async def _payload(self, service_cls):
+        return None
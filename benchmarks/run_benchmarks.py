@@ -0,0 +1,162 @@
+'''
+Benchmarks of the requestor-side code, with providers replaced by local stand-ins (-> local_provider.py).
+
+For every combination of the communication path (vpn/file), request body size, number of concurrent requests
+and cluster size, `--requests` POST requests are sent to the echo server from examples/ and we measure:
+
+*   throughput (requests/s)
+*   latency percentiles
+*   peak memory allocated by Python on the requestor side (tracemalloc)
+
+Usage (requires ya-httpx-client[requestor] and ya-httpx-client[provider] dependencies, flask and gunicorn):
+
+    python benchmarks/run_benchmarks.py --path vpn --path file --body-size 100 --body-size 100000 \\
+        --concurrency 1 --concurrency 16 --cluster-size 1 --cluster-size 4 --output results.json
+
+Results are printed as a table and (optionally) saved as JSON, so that runs before and after a change
+can be compared.
+'''
+import asyncio
+import itertools
+import json
+import os
+import time
+import tracemalloc
+from typing import TYPE_CHECKING
+
+import click
+import httpx
+
+from local_provider import REPO_ROOT, LocalCluster, LocalServiceManager, LocalTunnel
+from ya_httpx_client.compression import ALGORITHMS, ANY_CONTENT_TYPE, Compression
+from ya_httpx_client.network_wrapper import NetworkWrapper
+from ya_httpx_client.service import FileSerializationService
+from ya_httpx_client.session import YagnaTransport
+
+if TYPE_CHECKING:
+    from typing import Any, Dict, List, Optional, Sequence
+
+BENCHMARK_URL = 'http://bench'
+DEFAULT_APP_DIR = os.path.join(REPO_ROOT, 'examples', 'requestor_proxy', 'echo_server')
+
+
+def percentile(values: 'Sequence[float]', pct: float) -> float:
+    values = sorted(values)
+    index = min(int(len(values) * pct / 100), len(values) - 1)
+    return values[index]
+
+
+async def run_scenario(  # pylint: disable=too-many-arguments,too-many-locals
+    path: str, body_size: int, concurrency: int, cluster_size: int, provider_concurrency: int,
+    request_cnt: int, warmup_cnt: int, app: str, app_dir: str, compression: 'Optional[str]' = None,
+) -> 'Dict[str, Any]':
+    #   Benchmark bodies have no Content-Type, so everything above the threshold is compressed
+    FileSerializationService.COMPRESSION = \
+        None if compression is None else Compression(compression, content_types=(ANY_CONTENT_TYPE,))
+
+    tunnel = LocalTunnel()
+    await tunnel.start()
+    manager = LocalServiceManager(tunnel, app, app_dir, server_workers=provider_concurrency)
+
+    cluster = LocalCluster(
+        manager, 'local', None, NetworkWrapper(manager), provider_concurrency=provider_concurrency, name=BENCHMARK_URL,
+    )
+    cluster.USE_VPN = path == 'vpn'  # pylint: disable=invalid-name
+    cluster.set_size(cluster_size)
+    cluster.start()
+
+    transport = YagnaTransport(cluster.scheduler, name=BENCHMARK_URL)
+    body = b'x' * body_size
+    latencies: 'List[float]' = []
+
+    async with httpx.AsyncClient(mounts={BENCHMARK_URL: transport}, timeout=None) as client:
+        async def send(cnt: int, record: bool) -> None:
+            for _ in range(cnt):
+                start = time.perf_counter()
+                res = await client.post(f'{BENCHMARK_URL}/echo/', content=body)
+                if res.status_code != 200:
+                    raise RuntimeError(f'Unexpected status {res.status_code}')
+                if record:
+                    latencies.append(time.perf_counter() - start)
+
+        await manager.wait_running(cluster_size)
+        await asyncio.gather(*(send(warmup_cnt // concurrency + 1, False) for _ in range(concurrency)))
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        await asyncio.gather(*(send(request_cnt // concurrency, True) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    cluster.stop()
+    await manager.close()
+    await tunnel.stop()
+
+    return {
+        'path': path,
+        'body_size': body_size,
+        'concurrency': concurrency,
+        'cluster_size': cluster_size,
+        'provider_concurrency': provider_concurrency,
+        'compression': compression or '-',
+        'requests': len(latencies),
+        'req_per_s': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p90_ms': percentile(latencies, 90) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'peak_memory_mb': peak_memory / 2 ** 20,
+    }
+
+
+def format_table(results: 'List[Dict[str, Any]]') -> str:
+    columns = [
+        'path', 'body_size', 'concurrency', 'cluster_size', 'compression', 'requests',
+        'req_per_s', 'p50_ms', 'p90_ms', 'p99_ms', 'peak_memory_mb',
+    ]
+    rows = [[f'{row[col]:.1f}' if isinstance(row[col], float) else str(row[col]) for col in columns] for row in results]
+    widths = [max(len(col), *(len(row[i]) for row in rows)) for i, col in enumerate(columns)]
+    lines = ['  '.join(col.rjust(width) for col, width in zip(columns, widths))]
+    lines += ['  '.join(val.rjust(width) for val, width in zip(row, widths)) for row in rows]
+    return '\n'.join(lines)
+
+
+@click.command()
+@click.option('--path', 'paths', type=click.Choice(['vpn', 'file']), multiple=True, default=['vpn', 'file'])
+@click.option('--body-size', 'body_sizes', type=int, multiple=True, default=[100, 100000])
+@click.option('--concurrency', 'concurrencies', type=int, multiple=True, default=[1, 16],
+              help='Number of requests sent at the same time')
+@click.option('--cluster-size', 'cluster_sizes', type=int, multiple=True, default=[1, 4])
+@click.option('--provider-concurrency', type=int, default=1)
+@click.option('--requests', 'request_cnt', type=int, default=200, help='Measured requests in each scenario')
+@click.option('--warmup', 'warmup_cnt', type=int, default=20)
+@click.option('--app', default='echo_server:app', help='WSGI app started by gunicorn on every provider')
+@click.option('--app-dir', default=DEFAULT_APP_DIR)
+@click.option('--compression', type=click.Choice(ALGORITHMS),
+              help='Compress the bodies in the files (file path only, -> FileSerializationService.COMPRESSION)')
+@click.option('--output', help='Save results to this JSON file')
+def run_benchmarks(  # pylint: disable=too-many-arguments,too-many-locals
+    paths: 'Sequence[str]', body_sizes: 'Sequence[int]', concurrencies: 'Sequence[int]',
+    cluster_sizes: 'Sequence[int]', provider_concurrency: int, request_cnt: int, warmup_cnt: int,
+    app: str, app_dir: str, compression: 'Optional[str]', output: str,
+) -> None:
+    results = []
+    for path, body_size, concurrency, cluster_size in itertools.product(
+        paths, body_sizes, concurrencies, cluster_sizes,
+    ):
+        result = asyncio.get_event_loop().run_until_complete(run_scenario(
+            path, body_size, concurrency, cluster_size, provider_concurrency,
+            request_cnt, warmup_cnt, app, app_dir, compression if path == 'file' else None,
+        ))
+        results.append(result)
+        click.echo(f"{path} body={body_size} concurrency={concurrency} cluster={cluster_size}: "
+                   f"{result['req_per_s']:.1f} req/s, p50 {result['p50_ms']:.1f}ms")
+
+    click.echo(format_table(results))
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    run_benchmarks()  # pylint: disable=no-value-for-parameter
@@ -30,8 +30,7 @@ async def add_many_times(client, total_request_cnt, max_concurrent_requests):
     max_concurrent_requests
         How many requests could be performed at the same time.
         Lower than the number of providers working -> we'll have some idle provider(s) all the time
-        Much higher than the number of providers working -> requests that failed & caused provider recycling
-        will be performed much later than they could/should be (they go to the end of the queue)
+        Much higher than the number of providers working -> many requests will wait in the queue
     '''
     add_args_queue = asyncio.Queue()
     for x in range(total_request_cnt):
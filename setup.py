@@ -6,12 +6,19 @@ with open("README.md", "r", encoding='utf-8') as fh:
 
 requestor_requirements = [
     "httpx==0.18.2",
+    "h11==0.12.0",
     "yapapi-service-manager @ git+https://github.com/golemfactory/yapapi-service-manager.git",
 ]
 provider_requirements = [
     "requests==2.25.1",
     "requests-unixsocket==0.2.0",
     "click==8.0.1",
+    #   ya_httpx_client.sidecar
+    "h11==0.12.0",
+]
+#   Optional zstd compression (-> ya_httpx_client.compression), required on both sides
+zstd_requirements = [
+    "zstandard==0.15.2",
 ]
 test_requirements = requestor_requirements.copy()
 test_requirements += [
@@ -40,6 +47,7 @@ setuptools.setup(
     extras_require={
         'requestor': requestor_requirements,
         'provider': provider_requirements,
+        'zstd': zstd_requirements,
         'tests': test_requirements,
     },
     tests_require=test_requirements,
@@ -0,0 +1,48 @@
+import asyncio
+
+import pytest
+
+from ya_httpx_client.admission import AdmissionController, ClusterOverloaded
+
+
+@pytest.mark.asyncio
+async def test_fail_policy_rejects_above_limit():
+    admission = AdmissionController(policy='fail', initial_limit=2)
+    admitted = [await admission.acquire(), await admission.acquire()]
+    with pytest.raises(ClusterOverloaded):
+        await admission.acquire()
+    for admitted_at in admitted:
+        admission.release(admitted_at, False)
+    assert admission.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_failures_decrease_the_limit_unknown_outcome_doesnt():
+    admission = AdmissionController(initial_limit=10, backoff=0.5)
+
+    admission.release(await admission.acquire(), None)
+    assert admission.limit == 10
+
+    admission.release(await admission.acquire(), True)
+    assert admission.limit == 5
+
+    admission.release(await admission.acquire(), False)
+    assert admission.limit == 5.2
+
+
+@pytest.mark.asyncio
+async def test_higher_priority_is_admitted_first():
+    admission = AdmissionController(initial_limit=1)
+    admitted_at = await admission.acquire()
+    order = []
+
+    async def send(priority):
+        request_admitted_at = await admission.acquire(priority)
+        order.append(priority)
+        admission.release(request_admitted_at, False)
+
+    tasks = [asyncio.ensure_future(send(priority)) for priority in (0, 5, 1)]
+    await asyncio.sleep(0)
+    admission.release(admitted_at, False)
+    await asyncio.gather(*tasks)
+    assert order == [5, 1, 0]
@@ -0,0 +1,104 @@
+import asyncio
+
+import pytest
+
+from ya_httpx_client.scheduler import Scheduler
+from ya_httpx_client.serializable_request import Request, Response, to_batch_file
+from ya_httpx_client.service.file_serialization import FileSerializationService
+
+
+class FakeScript:
+    def __init__(self):
+        self.uploaded = []
+        self.downloaded = []
+
+    def upload_file(self, src, dst):  # pylint: disable=unused-argument
+        self.uploaded.append(src)
+
+    def download_file(self, src, dst):  # pylint: disable=unused-argument
+        self.downloaded.append(dst)
+
+    def run(self, *args):
+        pass
+
+
+class FakeContext:
+    provider_name = 'provider'
+    provider_id = 'provider-id'
+
+    def new_script(self):
+        return FakeScript()
+
+
+def start_service(scheduler, failed):
+    service = FileSerializationService(entrypoint=(), scheduler=scheduler, on_failed=failed.append)
+    service._set_ctx(FakeContext())  # pylint: disable=protected-access
+    service.set_active(True)
+    return service
+
+
+def submit(scheduler, cnt):
+    loop = asyncio.get_event_loop()
+    items = [(Request('GET', f'http://service/{i}', b'', {}), loop.create_future()) for i in range(cnt)]
+    for item in items:
+        scheduler.submit(*item)
+    return items
+
+
+@pytest.mark.asyncio
+async def test_batch_round_trip():
+    scheduler, failed = Scheduler(), []
+    service = start_service(scheduler, failed)
+    items = submit(scheduler, 3)
+
+    run = service.run()
+    script = await run.__anext__()
+    reqs = Request.batch_from_file(script.uploaded[0])
+    assert [req.url for req in reqs] == [req.url for req, _ in items]
+
+    to_batch_file([Response(200, req.url.encode(), {}) for req in reqs], script.downloaded[0])
+    getter = asyncio.ensure_future(run.__anext__())
+    results = await asyncio.gather(*(fut for _, fut in items))
+    assert [res.data for res in results] == [req.url.encode() for req, _ in items]
+    assert not failed and not service.in_flight
+
+    getter.cancel()
+    await asyncio.gather(getter, return_exceptions=True)
+
+
+@pytest.mark.asyncio
+async def test_short_batch_fails_the_service_and_restarts_missing_requests():
+    scheduler, failed = Scheduler(), []
+    service = start_service(scheduler, failed)
+    items = submit(scheduler, 3)
+
+    run = service.run()
+    script = await run.__anext__()
+    to_batch_file([Response(200, b'first', {})], script.downloaded[0])
+    with pytest.raises(ConnectionError, match='1 responses for 3 requests'):
+        await run.__anext__()
+
+    assert failed == [service]
+    assert items[0][1].result().data == b'first'
+    assert set(service.in_flight) == {items[1][1], items[2][1]}
+
+    service.restart_failed_requests()
+    assert scheduler.qsize() == 2
+
+
+@pytest.mark.asyncio
+async def test_truncated_batch_fails_the_service():
+    scheduler, failed = Scheduler(), []
+    service = start_service(scheduler, failed)
+    items = submit(scheduler, 2)
+
+    run = service.run()
+    script = await run.__anext__()
+    to_batch_file([Response(200, b'body', {}) for _ in items], script.downloaded[0])
+    with open(script.downloaded[0], 'rb+') as f:
+        f.truncate(10)
+    with pytest.raises(ValueError):
+        await run.__anext__()
+
+    assert failed == [service]
+    assert len(service.in_flight) == 2
@@ -0,0 +1,136 @@
+import asyncio
+
+import pytest
+
+from ya_httpx_client.journal import JOURNAL_ID_HEADER, RequestJournal
+from ya_httpx_client.serializable_request import Request
+
+URL = 'http://cluster'
+
+
+class FakeClient:
+    '''Records the requests, fails the ones with urls in `fail`'''
+    def __init__(self, fail=()):
+        self.fail = fail
+        self.requests = []
+
+    async def request(self, method, url, content, headers):
+        self.requests.append((method, url, content, headers))
+        await asyncio.sleep(0)
+        if url in self.fail:
+            raise ConnectionError("failed")
+        return (url, content)
+
+
+def make_request(path: str) -> Request:
+    return Request('POST', f'{URL}{path}', path.encode(), {'Content-Type': 'text/plain'})
+
+
+async def journal_with(path, paths, completed=()):
+    journal = RequestJournal(path)
+    entry_ids = {req_path: journal.add(URL, make_request(req_path)) for req_path in paths}
+    await journal.sync()
+    for req_path in completed:
+        journal.complete(entry_ids[req_path])
+    await journal.close()
+    return entry_ids
+
+
+@pytest.mark.asyncio
+async def test_recovered_requests_are_replayed(tmp_path):
+    path = str(tmp_path / 'journal.db')
+    entry_ids = await journal_with(path, ['/a', '/b', '/c'], completed=['/b'])
+
+    replayed = []
+    journal = RequestJournal(path, on_replayed=replayed.append)
+    client = FakeClient()
+    await journal.replay(client, [URL])
+
+    assert sorted(replayed) == [(f'{URL}/a', b'/a'), (f'{URL}/c', b'/c')]
+    assert sorted(headers[JOURNAL_ID_HEADER] for *_, headers in client.requests) == \
+        sorted(str(entry_ids[req_path]) for req_path in ('/a', '/c'))
+
+    #   Nothing is replayed twice, new entries don't reuse the old ids
+    await journal.replay(client, [URL])
+    assert len(client.requests) == 2
+    assert journal.add(URL, make_request('/d')) > max(entry_ids.values())
+    await journal.close()
+
+
+@pytest.mark.asyncio
+async def test_failed_and_unknown_cluster_requests_stay_in_journal(tmp_path):
+    path = str(tmp_path / 'journal.db')
+    await journal_with(path, ['/a', '/b'])
+
+    journal = RequestJournal(path)
+    await journal.replay(FakeClient(fail=[f'{URL}/a']), [URL])
+    await journal.close()
+
+    journal = RequestJournal(path)
+    client = FakeClient()
+    await journal.replay(client, ['http://other-cluster'])
+    assert not client.requests
+    await journal.close()
+
+    #   /b was replayed, but it was never completed (this is done by the Session) - it's still there
+    journal = RequestJournal(path)
+    await journal.replay(client, [URL])
+    assert sorted(url for _, url, _, _ in client.requests) == [f'{URL}/a', f'{URL}/b']
+    await journal.close()
+
+
+@pytest.mark.asyncio
+async def test_requests_completed_before_flush_never_reach_the_disk(tmp_path):
+    path = str(tmp_path / 'journal.db')
+    journal = RequestJournal(path, flush_interval=10)
+    journal.complete(journal.add(URL, make_request('/a')))
+    journal.add(URL, make_request('/b'))
+    await journal.close()
+
+    journal = RequestJournal(path)
+    client = FakeClient()
+    await journal.replay(client, [URL])
+    assert [url for _, url, _, _ in client.requests] == [f'{URL}/b']
+    await journal.close()
+
+
+@pytest.mark.asyncio
+async def test_replay_concurrency_is_bounded(tmp_path):
+    path = str(tmp_path / 'journal.db')
+    await journal_with(path, [f'/{i}' for i in range(10)])
+
+    running = 0
+    max_running = 0
+
+    class SlowClient:
+        async def request(self, method, url, content, headers):  # pylint: disable=unused-argument
+            nonlocal running, max_running
+            running += 1
+            max_running = max(max_running, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+    journal = RequestJournal(path, replay_concurrency=3)
+    await journal.replay(SlowClient(), [URL])
+    assert max_running == 3
+    await journal.close()
+
+
+@pytest.mark.asyncio
+async def test_only_ids_being_replayed_are_honoured(tmp_path):
+    path = str(tmp_path / 'journal.db')
+    await journal_with(path, ['/a'])
+    journal = RequestJournal(path)
+
+    seen = []
+
+    class CheckingClient:
+        async def request(self, method, url, content, headers):  # pylint: disable=unused-argument
+            seen.append(journal.replayed_entry_id(headers[JOURNAL_ID_HEADER]))
+
+    assert journal.replayed_entry_id('1') is None
+    assert journal.replayed_entry_id('not a number') is None
+    await journal.replay(CheckingClient(), [URL])
+    assert seen == [1]
+    assert journal.replayed_entry_id('1') is None
+    await journal.close()
@@ -0,0 +1,119 @@
+import asyncio
+
+import pytest
+
+from ya_httpx_client.compression import ANY_CONTENT_TYPE, Compression
+from ya_httpx_client.mux import INITIAL_WINDOW, MuxConnection, StreamReset
+
+
+def connected_pair(compression=None):
+    '''Client & server MuxConnections talking over in-memory queues, and a queue of streams opened on the server'''
+    client_to_server: 'asyncio.Queue' = asyncio.Queue()
+    server_to_client: 'asyncio.Queue' = asyncio.Queue()
+    server_streams: 'asyncio.Queue' = asyncio.Queue()
+
+    client = MuxConnection(server_to_client.get, client_to_server.put, compression)
+    server = MuxConnection(client_to_server.get, server_to_client.put, compression, on_stream=server_streams.put_nowait)
+    client.start()
+    server.start()
+    return client, server, server_streams
+
+
+async def read_body(stream) -> bytes:
+    return b''.join([chunk async for chunk in stream.aiter_data()])
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('compression', [None, Compression(threshold=0, content_types=[ANY_CONTENT_TYPE])])
+async def test_round_trip(compression):
+    client, server, server_streams = connected_pair(compression)
+    req_body = b'request ' * 10000
+    res_body = b'response ' * 10000
+
+    stream = client.open_stream()
+    await stream.send_head({'method': 'POST', 'url': '/x', 'headers': {}})
+    await stream.send_data(req_body, end_stream=True)
+
+    server_stream = await server_streams.get()
+    assert await server_stream.receive_head() == {'method': 'POST', 'url': '/x', 'headers': {}}
+    assert await read_body(server_stream) == req_body
+    await server_stream.send_head({'status': 200, 'headers': {}})
+    await server_stream.send_data(res_body, end_stream=True)
+
+    assert await stream.receive_head() == {'status': 200, 'headers': {}}
+    assert await read_body(stream) == res_body
+    assert stream.closed and server_stream.closed
+    assert not client.streams and not server.streams
+
+    await client.close()
+    await server.close()
+
+
+@pytest.mark.asyncio
+async def test_sender_waits_when_window_is_exhausted():
+    client, server, server_streams = connected_pair()
+    body = bytes(range(256)) * (3 * INITIAL_WINDOW // 256)
+
+    stream = client.open_stream()
+    await stream.send_head({'method': 'POST', 'url': '/x', 'headers': {}})
+    send_task = asyncio.ensure_future(stream.send_data(body, end_stream=True))
+    server_stream = await server_streams.get()
+
+    #   Nothing is consumed on the server, so only INITIAL_WINDOW bytes can be sent
+    await asyncio.sleep(0.05)
+    assert not send_task.done()
+
+    assert await read_body(server_stream) == body
+    await asyncio.wait_for(send_task, 1)
+
+    await client.close()
+    await server.close()
+
+
+@pytest.mark.asyncio
+async def test_reset_by_client():
+    client, server, server_streams = connected_pair()
+    stream = client.open_stream()
+    await stream.send_head({'method': 'POST', 'url': '/x', 'headers': {}})
+    await stream.send_data(b'part of the body')
+
+    server_stream = await server_streams.get()
+    reset_called = asyncio.Event()
+    server_stream.on_reset = reset_called.set
+
+    await stream.send_reset("caller went away")
+    await asyncio.wait_for(reset_called.wait(), 1)
+    with pytest.raises(StreamReset, match="caller went away"):
+        await read_body(server_stream)
+
+    #   Stream is forgotten on both sides, new streams still work
+    assert not client.streams and not server.streams
+    other_stream = client.open_stream()
+    await other_stream.send_head({'method': 'GET', 'url': '/y', 'headers': {}}, end_stream=True)
+    assert (await (await server_streams.get()).receive_head())['url'] == '/y'
+
+    await client.close()
+    await server.close()
+
+
+@pytest.mark.asyncio
+async def test_reset_by_server_and_closed_connection():
+    client, server, server_streams = connected_pair()
+    stream = client.open_stream()
+    await stream.send_head({'method': 'GET', 'url': '/x', 'headers': {}}, end_stream=True)
+
+    server_stream = await server_streams.get()
+    await server_stream.send_reset("failed on the provider")
+    with pytest.raises(StreamReset, match="failed on the provider"):
+        await stream.receive_head()
+
+    #   Streams still open when the connection is closed are reset
+    stream = client.open_stream()
+    await stream.send_head({'method': 'GET', 'url': '/y', 'headers': {}}, end_stream=True)
+    await server_streams.get()
+    await server.close()
+    await client.close()
+    with pytest.raises(StreamReset):
+        await stream.receive_head()
+    with pytest.raises(StreamReset):
+        client.open_stream()
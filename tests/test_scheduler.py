@@ -0,0 +1,227 @@
+import asyncio
+import random
+
+import pytest
+
+from ya_httpx_client.scheduler import ConsistentHashScheduler, Scheduler
+from ya_httpx_client.serializable_request import Request
+
+
+class FakeService:
+    def __init__(self, name: str):
+        self.provider_id = name
+        self.active = True
+
+    def __repr__(self):
+        return self.provider_id
+
+
+def make_item(path: str = '/', priority: int = 0):
+    req = Request('GET', f'http://service{path}', b'', {})
+    req.priority = priority
+    return req, asyncio.get_event_loop().create_future()
+
+
+def take_all(scheduler: Scheduler, service: FakeService):
+    items = []
+    while True:
+        try:
+            items.append(scheduler.get_nowait(service))
+        except asyncio.QueueEmpty:
+            return items
+
+
+@pytest.mark.asyncio
+async def test_priority_and_fifo():
+    scheduler = Scheduler()
+    items = [make_item('/a', 0), make_item('/b', 5), make_item('/c', 0), make_item('/d', 5)]
+    for req, fut in items:
+        scheduler.submit(req, fut)
+
+    paths = [req.url for req, _ in take_all(scheduler, FakeService('a'))]
+    assert paths == ['http://service/b', 'http://service/d', 'http://service/a', 'http://service/c']
+
+
+@pytest.mark.asyncio
+async def test_requeue_goes_first_within_priority():
+    scheduler = Scheduler()
+    service = FakeService('a')
+    first, second, important = make_item('/1'), make_item('/2'), make_item('/important', 1)
+    scheduler.submit(*first)
+    scheduler.submit(*second)
+    taken = scheduler.get_nowait(service)
+    assert taken is not None and scheduler.outstanding_cnt == 1
+
+    scheduler.submit(*important)
+    scheduler.requeue(first)
+    assert scheduler.outstanding_cnt == 0
+    assert [fut for _, fut in take_all(scheduler, service)] == [important[1], first[1], second[1]]
+
+
+@pytest.mark.asyncio
+async def test_waiting_service_gets_request_and_cancelled_requests_are_skipped():
+    scheduler = Scheduler()
+    service = FakeService('a')
+    cancelled = make_item('/cancelled')
+    cancelled[1].cancel()
+    scheduler.submit(*cancelled)
+
+    getter = asyncio.ensure_future(scheduler.get(service))
+    await asyncio.sleep(0)
+    item = make_item('/x')
+    scheduler.submit(*item)
+    assert await asyncio.wait_for(getter, 1) == item
+    assert scheduler.service_of(item[1]) is service
+    assert scheduler.empty()
+
+
+@pytest.mark.asyncio
+async def test_batch_is_reserved_for_the_service_that_took_the_first_request():
+    scheduler = Scheduler()
+    service, other_service = FakeService('a'), FakeService('b')
+    batch = [make_item(f'/{i}') for i in range(5)]
+    scheduler.submit_batch(batch)
+
+    assert scheduler.get_nowait(service)[1] is batch[0][1]
+    assert scheduler.reserved_cnt(service) == 4
+    assert not take_all(scheduler, other_service)
+
+    taken = scheduler.take_reserved(service, limit=2)
+    assert [fut for _, fut in taken] == [batch[1][1], batch[2][1]]
+
+    #   Above the limit - anyone can take them
+    assert [fut for _, fut in take_all(scheduler, other_service)] == [batch[3][1], batch[4][1]]
+
+
+@pytest.mark.asyncio
+async def test_reserved_requests_of_deactivated_service_are_requeued():
+    scheduler = Scheduler()
+    service, other_service = FakeService('a'), FakeService('b')
+    batch = [make_item(f'/{i}') for i in range(3)]
+    scheduler.submit_batch(batch)
+    scheduler.get_nowait(service)
+
+    service.active = False
+    scheduler.set_service_active(service, False)
+    assert scheduler.reserved_cnt(service) == 0
+    assert [fut for _, fut in take_all(scheduler, other_service)] == [batch[1][1], batch[2][1]]
+
+
+@pytest.mark.asyncio
+async def test_timeout_counts_as_failure():
+    scheduler = Scheduler()
+    service = FakeService('a')
+    succeeded, timed_out = make_item('/ok'), make_item('/slow')
+    for item in (succeeded, timed_out):
+        scheduler.submit(*item)
+    take_all(scheduler, service)
+
+    scheduler.task_done(succeeded[1], app_error=True)
+    scheduler.report_timeout(timed_out[1])
+    scheduler.task_done(timed_out[1])
+
+    stats = scheduler.stats[service]
+    assert stats.completed == 2 and stats.outstanding == 0
+    assert stats.error_rate > 0 and stats.app_error_rate > 0
+
+
+def waiting_cnt(scheduler: Scheduler) -> int:
+    '''Requests waiting in the scheduler, counted the slow way'''
+    # pylint: disable=protected-access
+    waiting = [
+        *(item for lane in scheduler._lanes.values() for item in lane),
+        *(item for items in scheduler._batches.values() for item in items),
+        *(item for items in scheduler._reserved.values() for item in items),
+    ]
+    return sum(1 for _, fut in waiting if not fut.done())
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('scheduler_cls', [Scheduler, ConsistentHashScheduler])
+async def test_qsize_matches_waiting_requests(scheduler_cls):
+    rnd = random.Random(0)
+    scheduler = scheduler_cls()
+    services = [FakeService(name) for name in 'abc']
+    items, started = [], []
+
+    for _ in range(2000):
+        action = rnd.randrange(7)
+        service = rnd.choice(services)
+        if action == 0:
+            items.append(make_item(f'/{rnd.randrange(10)}', rnd.randrange(3)))
+            scheduler.submit(*items[-1])
+        elif action == 1:
+            batch = [make_item(f'/{rnd.randrange(10)}') for _ in range(rnd.randrange(1, 5))]
+            items += batch
+            scheduler.submit_batch(batch)
+        elif action == 2 and service.active:
+            try:
+                started.append(scheduler.get_nowait(service))
+            except asyncio.QueueEmpty:
+                pass
+            started += scheduler.take_reserved(service, rnd.choice([None, 0, 1]))
+        elif action == 3 and items:
+            rnd.choice(items)[1].cancel()
+        elif action == 4 and started:
+            item = started.pop(rnd.randrange(len(started)))
+            if rnd.random() < 0.5:
+                scheduler.requeue(item)
+            else:
+                scheduler.task_done(item[1])
+        elif action == 5:
+            service.active = not service.active
+            scheduler.set_service_active(service, service.active)
+        elif action == 6 and rnd.random() < 0.1:
+            scheduler.remove_service(service)
+
+        #   Done callbacks of the cancelled requests
+        await asyncio.sleep(0)
+        assert scheduler.qsize() == waiting_cnt(scheduler)
+        assert scheduler.empty() == (not waiting_cnt(scheduler))
+
+
+def key_for(scheduler: ConsistentHashScheduler, service: FakeService) -> str:
+    return next(path for path in (f'/{i}' for i in range(1000)) if scheduler.service_for(path) is service)
+
+
+@pytest.mark.asyncio
+async def test_consistent_hash_waits_for_busy_service_in_priority_order():
+    scheduler = ConsistentHashScheduler(key=lambda req: req.url[len('http://service'):], load_factor=100)
+    service, other_service = FakeService('a'), FakeService('b')
+    take_all(scheduler, service)
+    take_all(scheduler, other_service)
+    path = key_for(scheduler, service)
+
+    busy = make_item(path)
+    scheduler.submit(*busy)
+    assert scheduler.get_nowait(service) == busy
+
+    low, high = make_item(path, 0), make_item(path, 10)
+    scheduler.submit(*low)
+    scheduler.submit(*high)
+
+    #   Other service doesn't take requests waiting for the busy one
+    assert not take_all(scheduler, other_service)
+    assert [fut for _, fut in take_all(scheduler, service)] == [high[1], low[1]]
+
+
+@pytest.mark.asyncio
+async def test_consistent_hash_reroutes_when_service_is_deactivated():
+    scheduler = ConsistentHashScheduler(key=lambda req: req.url[len('http://service'):], load_factor=100)
+    service, other_service = FakeService('a'), FakeService('b')
+    take_all(scheduler, service)
+    take_all(scheduler, other_service)
+    path = key_for(scheduler, service)
+
+    scheduler.submit(*make_item(path))
+    scheduler.get_nowait(service)
+    waiting = make_item(path)
+    scheduler.submit(*waiting)
+
+    getter = asyncio.ensure_future(scheduler.get(other_service))
+    await asyncio.sleep(0)
+    assert not getter.done()
+
+    service.active = False
+    scheduler.set_service_active(service, False)
+    assert await asyncio.wait_for(getter, 1) == waiting
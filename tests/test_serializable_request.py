@@ -0,0 +1,140 @@
+import json
+import os
+import shlex
+
+import click
+import pytest
+
+from ya_httpx_client.compression import ANY_CONTENT_TYPE, GZIP, ZSTD, Compression, compression_options
+from ya_httpx_client.serializable_request import (
+    BINARY, JSON, FRAME_HEADER, Request, Response, pack_frame, to_batch_file, unpack_frame,
+)
+
+TEXT_HEADERS = {'Content-Type': 'text/plain'}
+TEXT_BODY = b'some text that compresses well ' * 1000
+BINARY_BODY = bytes(range(256)) * 4
+
+
+def frame_head(frame: bytes) -> dict:
+    _, head_len, _ = FRAME_HEADER.unpack_from(frame)
+    return json.loads(frame[FRAME_HEADER.size:FRAME_HEADER.size + head_len])
+
+
+def test_frame_round_trip():
+    head = {'status': 200, 'headers': TEXT_HEADERS}
+    frame = b''.join(pack_frame(head, BINARY_BODY))
+    assert frame_head(frame) == head
+    assert unpack_frame(frame) == (head, BINARY_BODY, len(frame))
+
+
+def test_invalid_and_truncated_frames():
+    frame = b''.join(pack_frame({'status': 200, 'headers': {}}, b'body'))
+    with pytest.raises(ValueError, match='Invalid frame'):
+        unpack_frame(b'XXXX' + frame[4:])
+    with pytest.raises(ValueError, match='Truncated frame'):
+        unpack_frame(frame[:-1])
+    with pytest.raises(ValueError, match='Truncated frame'):
+        unpack_frame(frame[:FRAME_HEADER.size - 1])
+
+
+def test_binary_bodies_survive_files(tmp_path):
+    fname = str(tmp_path / 'request')
+    req = Request('POST', 'http://service/upload', BINARY_BODY, {'Content-Type': 'application/octet-stream'})
+    req.to_file(fname)
+    loaded = Request.from_file(fname)
+    assert (loaded.method, loaded.url, loaded.data, loaded.headers) == (req.method, req.url, req.data, req.headers)
+
+    res = Response(200, BINARY_BODY, {'Content-Type': 'image/png'})
+    res.to_file(fname)
+    loaded_res = Response.from_file(fname)
+    assert (loaded_res.status, loaded_res.data, loaded_res.headers) == (res.status, res.data, res.headers)
+
+
+def test_batch_file(tmp_path):
+    fname = str(tmp_path / 'batch')
+    responses = [Response(200, BINARY_BODY, dict(TEXT_HEADERS)), Response(204, b'', {})]
+    to_batch_file(responses, fname, BINARY)
+    loaded = Response.batch_from_file(fname, BINARY)
+    assert [(res.status, res.data, res.headers) for res in loaded] == \
+        [(res.status, res.data, res.headers) for res in responses]
+
+
+@pytest.mark.parametrize('algorithm', [GZIP, ZSTD])
+def test_compressed_frame_round_trip(algorithm):
+    if algorithm == ZSTD:
+        pytest.importorskip('zstandard')
+    head = {'status': 200, 'headers': TEXT_HEADERS}
+    frame = b''.join(pack_frame(head, TEXT_BODY, Compression(algorithm)))
+
+    assert frame_head(frame) == {**head, 'encoding': algorithm}
+    assert len(frame) < len(TEXT_BODY)
+    assert unpack_frame(frame) == (head, TEXT_BODY, len(frame))
+
+
+@pytest.mark.parametrize('headers, body', [
+    (TEXT_HEADERS, b'too short'),
+    ({'Content-Type': 'image/png'}, TEXT_BODY),
+    ({'Content-Type': 'text/plain', 'Content-Encoding': 'br'}, TEXT_BODY),
+])
+def test_not_compressed(headers, body):
+    head = {'status': 200, 'headers': headers}
+    frame = b''.join(pack_frame(head, body, Compression()))
+    assert frame_head(frame) == head
+    assert unpack_frame(frame) == (head, body, len(frame))
+
+
+def test_incompressible_body_is_sent_raw():
+    body = os.urandom(10000)
+    head = {'status': 200, 'headers': {}}
+    frame = b''.join(pack_frame(head, body, Compression(threshold=0, content_types=[ANY_CONTENT_TYPE])))
+    assert 'encoding' not in frame_head(frame)
+    assert unpack_frame(frame)[1] == body
+
+
+def test_batch_file_with_compression(tmp_path):
+    fname = str(tmp_path / 'batch')
+    requests = [
+        Request('POST', 'http://service/text', TEXT_BODY, dict(TEXT_HEADERS)),
+        Request('GET', 'http://service/empty', b'', {}),
+    ]
+    to_batch_file(requests, fname, BINARY, Compression())
+
+    with open(fname, 'rb') as f:
+        assert frame_head(f.read())['encoding'] == GZIP
+    loaded = Request.batch_from_file(fname, BINARY)
+    assert [(req.method, req.url, req.data, req.headers) for req in loaded] == \
+        [(req.method, req.url, req.data, req.headers) for req in requests]
+
+
+def test_compression_requires_binary_format(tmp_path):
+    fname = str(tmp_path / 'batch')
+    with pytest.raises(ValueError, match='Compression requires'):
+        to_batch_file([Response(200, b'', {})], fname, JSON, Compression())
+    with pytest.raises(ValueError, match='Compression requires'):
+        Response(200, b'', {}).to_file(fname, JSON, Compression())
+
+
+def test_cli_args_round_trip():
+    compression = Compression(GZIP, threshold=10, content_types=['text/'], level=9)
+    parsed = []
+
+    @click.command()
+    @compression_options
+    def command(compression):
+        parsed.append(compression)
+
+    command.main(shlex.split(compression.cli_args()), standalone_mode=False)
+    assert vars(parsed[0]) == vars(compression)
+
+    command.main([], standalone_mode=False)
+    assert parsed[1] is None
+
+
+def test_unencodable_batch_item(tmp_path):
+    fname = str(tmp_path / 'batch')
+    responses = [Response(200, b'ok', {}), Response(200, BINARY_BODY, {})]
+    with pytest.raises(UnicodeDecodeError):
+        to_batch_file(responses, fname, JSON)
+
+    to_batch_file(responses, fname, JSON, on_error=lambda res, e: Response(502, str(e).encode(), {}))
+    assert [res.status for res in Response.batch_from_file(fname, JSON)] == [200, 502]
@@ -0,0 +1,20 @@
+import subprocess
+import time
+
+import pytest
+
+from ya_httpx_client.service.service_base import wait_for_pid_file
+
+
+@pytest.mark.parametrize('background, returncode', [
+    ('(sleep 0.1; echo 1 > {pid_file}; sleep 10)', 0),
+    ('(sleep 0.1; exit 1)', 1),
+    ('sleep 10', 1),
+])
+def test_wait_for_pid_file(tmp_path, background, returncode):
+    pid_file = str(tmp_path / 'pid')
+    command = f'{background.format(pid_file=pid_file)} & {wait_for_pid_file(pid_file, 0.5)}'
+
+    start = time.monotonic()
+    assert subprocess.run(['/bin/sh', '-c', command], check=False, timeout=5).returncode == returncode
+    assert time.monotonic() - start < 2
@@ -0,0 +1,30 @@
+import asyncio
+
+import pytest
+
+from ya_httpx_client.admission import AdmissionController
+from ya_httpx_client.scheduler import Scheduler
+from ya_httpx_client.serializable_request import PROVIDER_ERROR_HEADER, Request, Response
+
+session = pytest.importorskip('ya_httpx_client.session')
+
+
+async def send_with_response(transport, res):
+    task = asyncio.ensure_future(transport._send(Request('GET', 'http://service/', b'', {}), {}))  # pylint: disable=protected-access
+    _, fut = await transport.scheduler.get(object())
+    fut.set_result(res)
+    return await task
+
+
+@pytest.mark.asyncio
+async def test_only_provider_errors_decrease_the_admission_limit():
+    admission = AdmissionController(initial_limit=10, backoff=0.5)
+    transport = session.YagnaTransport(Scheduler(), admission=admission)
+
+    await send_with_response(transport, Response(500, b'bad input', {}))
+    limit = admission.limit
+    assert limit > 10
+
+    await send_with_response(transport, Response(502, b'', {PROVIDER_ERROR_HEADER: '1'}))
+    assert admission.limit == limit / 2
+    assert admission.in_flight == 0
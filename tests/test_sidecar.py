@@ -0,0 +1,75 @@
+import asyncio
+
+import pytest
+
+from ya_httpx_client.mux import MuxConnection
+from ya_httpx_client.serializable_request import PROVIDER_ERROR_HEADER
+from ya_httpx_client.sidecar import Sidecar
+
+
+class FlakyServer:
+    '''Answers the first request on every connection, closes the connection without answering the next one'''
+    def __init__(self):
+        self.connections = 0
+        self.server = None
+
+    async def start(self) -> int:
+        self.server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        await reader.readuntil(b'\r\n\r\n')
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok')
+        await writer.drain()
+        await reader.readuntil(b'\r\n\r\n')
+        writer.close()
+
+
+def sidecar_tunnel(sidecar: Sidecar) -> MuxConnection:
+    '''Requestor side of a tunnel to the sidecar, over in-memory queues'''
+    to_sidecar: 'asyncio.Queue' = asyncio.Queue()
+    to_requestor: 'asyncio.Queue' = asyncio.Queue()
+    # pylint: disable=protected-access
+    provider = MuxConnection(to_sidecar.get, to_requestor.put, on_stream=sidecar._stream_started)
+    requestor = MuxConnection(to_requestor.get, to_sidecar.put)
+    provider.start()
+    requestor.start()
+    return requestor
+
+
+async def get(tunnel: MuxConnection, port: int):
+    stream = tunnel.open_stream()
+    await stream.send_head({'method': 'GET', 'url': 'http://localhost/', 'headers': {}, 'port': port}, end_stream=True)
+    head = await stream.receive_head()
+    body = b''.join([chunk async for chunk in stream.aiter_data()])
+    return head, body
+
+
+@pytest.mark.asyncio
+async def test_stale_pooled_connection_is_retried_on_a_fresh_one():
+    server = FlakyServer()
+    port = await server.start()
+    tunnel = sidecar_tunnel(Sidecar())
+
+    for _ in range(2):
+        head, body = await asyncio.wait_for(get(tunnel, port), 5)
+        assert head['status'] == 200 and PROVIDER_ERROR_HEADER not in head['headers']
+        assert body == b'ok'
+    assert server.connections == 2
+
+    await tunnel.close()
+    server.server.close()
+
+
+@pytest.mark.asyncio
+async def test_failure_on_a_fresh_connection_is_a_provider_error():
+    server = await asyncio.start_server(lambda reader, writer: writer.close(), '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    tunnel = sidecar_tunnel(Sidecar())
+
+    head, _ = await asyncio.wait_for(get(tunnel, port), 5)
+    assert head['status'] == 502 and head['headers'][PROVIDER_ERROR_HEADER] == '1'
+
+    await tunnel.close()
+    server.close()
@@ -0,0 +1,52 @@
+import os
+
+import pytest
+
+from ya_httpx_client.serializable_request import (
+    BINARY, FORMATS, JSON, PROVIDER_ERROR_HEADER, Request, Response, to_batch_file,
+)
+from ya_httpx_client.worker import Worker
+
+BINARY_BODY = bytes(range(256))
+
+
+class FakeProcessor:
+    '''Answers every request with its own body'''
+    def process(self, reqs):
+        return [Response(200, req.data, {}) for req in reqs]
+
+
+@pytest.mark.parametrize('fmt', FORMATS)
+def test_process_file(tmp_path, fmt):
+    inbox, outbox = str(tmp_path / 'inbox'), str(tmp_path / 'outbox')
+    os.makedirs(inbox)
+    os.makedirs(outbox)
+    reqs = [Request('POST', 'http://service/', b'text', {})]
+    if fmt == BINARY:
+        reqs.append(Request('POST', 'http://service/', BINARY_BODY, {}))
+    to_batch_file(reqs, os.path.join(inbox, 'batch'), fmt)
+
+    Worker(FakeProcessor(), inbox, outbox, fmt).process_file('batch')
+
+    assert not os.listdir(inbox)
+    responses = Response.batch_from_file(os.path.join(outbox, 'batch'), fmt)
+    assert [res.data for res in responses] == [req.data for req in reqs]
+
+
+def test_unserializable_response_is_replaced_with_provider_error(tmp_path):
+    inbox, outbox = str(tmp_path / 'inbox'), str(tmp_path / 'outbox')
+    os.makedirs(inbox)
+    os.makedirs(outbox)
+
+    class BinaryProcessor:
+        def process(self, reqs):
+            return [Response(200, b'text', {})] + [Response(200, BINARY_BODY, {}) for _ in reqs[1:]]
+
+    reqs = [Request('GET', 'http://service/', b'', {}) for _ in range(2)]
+    to_batch_file(reqs, os.path.join(inbox, 'batch'), JSON)
+    Worker(BinaryProcessor(), inbox, outbox, JSON).process_file('batch')
+
+    responses = Response.batch_from_file(os.path.join(outbox, 'batch'), JSON)
+    assert [res.status for res in responses] == [200, 502]
+    assert responses[1].is_provider_error
+    assert PROVIDER_ERROR_HEADER in responses[1].headers
@@ -1,58 +1,46 @@
+from typing import TYPE_CHECKING
+
 import click
-import requests_unixsocket  # type: ignore
 
-from ya_httpx_client.serializable_request import Request, Response
+from ya_httpx_client.compression import compression_options
+from ya_httpx_client.request_processor import RequestProcessor, replace_unserializable
+from ya_httpx_client.serializable_request import Request, BINARY, FORMATS, to_batch_file
+
+if TYPE_CHECKING:
+    from typing import Optional
+    from ya_httpx_client.compression import Compression
 
 
 @click.command()
 @click.option('--url', required=True)
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), default=BINARY)
+@click.option('--batch', is_flag=True, help='Process a file with many requests (-> to_batch_file)')
+@click.option('--concurrency', type=int, default=1, help='Max number of requests (from a batch) sent at the same time')
+@compression_options
 @click.argument('request_path')
 @click.argument('response_path')
-def process_request(url: str, request_path: str, response_path: str) -> None:
-    url = _adjust_url(url)
-
-    req = Request.from_file(request_path)
-    req.replace_mount_url(url)
-
-    requests_req = req.as_requests_request()
-    session = requests_unixsocket.Session()
-    requests_res = session.send(requests_req.prepare())
-
-    res = Response.from_requests_response(requests_res)
-    res.to_file(response_path)
-
-    print(f"IN:  {request_path}")
+def process_request(  # pylint: disable=too-many-arguments
+    url: str, fmt: str, batch: bool, concurrency: int, compression: 'Optional[Compression]', request_path: str,
+    response_path: str,
+) -> None:
+    if batch:
+        reqs = Request.batch_from_file(request_path, fmt)
+    else:
+        reqs = [Request.from_file(request_path, fmt)]
+
+    responses = RequestProcessor(url, concurrency).process(reqs)
+
+    if batch:
+        to_batch_file(responses, response_path, fmt, compression, replace_unserializable)
+    else:
+        try:
+            responses[0].to_file(response_path, fmt, compression)
+        except ValueError as e:
+            replace_unserializable(responses[0], e).to_file(response_path, fmt, compression)
+
+    print(f"IN:  {request_path} ({len(reqs)} requests)")
     print(f"OUT: {response_path}")
 
 
-def _adjust_url(url: str) -> str:
-    '''
-    Only current usecase:
-        unix:///tmp/golem.sock/  --> http+unix://%2Ftmp%2Fgolem.sock
-
-    NOTE: urllib.parse is not used, because it doesn't work well with urls with empty host,
-          e.g. with the one above
-    '''
-    if '://' not in url:
-        raise ValueError(f"Missing schema in url {url}")
-
-    schema, no_schema_url = url.split('://', 1)
-    if schema == 'unix':
-        #   This is required by requests_unixsocket
-        schema = 'http+unix'
-
-    if no_schema_url.endswith('/'):
-        no_schema_url = no_schema_url[:-1]
-
-    if no_schema_url.startswith('/'):
-        #   If this is a no-host url, and we don't url-encode all '/',
-        #   requests assume the path is the host.
-        #   Also we can't use ullib.parse.quote, because some part might
-        #   already be url-encoded.
-        no_schema_url = no_schema_url.replace('/', '%2F')
-
-    return '://'.join([schema, no_schema_url])
-
-
 if __name__ == '__main__':
     process_request()  # pylint: disable=no-value-for-parameter
@@ -0,0 +1,174 @@
+'''
+Admission control: how many requests a single cluster accepts at the same time.
+
+Without it, every request sent by the client goes straight to the scheduler, so a burst of requests (e.g. when
+providers are still starting) creates an unlimited number of waiting requests. AdmissionController limits the number
+of requests in the scheduler (waiting there or processed) to `limit`, that adapts to the observed latency (AIMD):
+
+*   a successful request with the latency below `tolerance` times the baseline (the lowest latency of the recent
+    requests) increases the limit by 1 / limit, i.e. by 1 after `limit` such requests
+*   a slower or a failed request decreases the limit `1 / backoff` times (at most once per the latency of a request)
+
+A request failed if there was a transport error (e.g. a timeout) or the response is an error of the provider
+(-> serializable_request.PROVIDER_ERROR_HEADER). 5xx responses of the application are not failures.
+
+Requests above the limit wait in the admission queue, higher priority first (-> scheduler.PRIORITY_HEADER).
+What happens when a request can't be admitted immediately depends on the policy:
+
+*   "block" - wait in the queue (`pool` timeout is honoured). If the queue is full, ClusterOverloaded is raised.
+*   "fail" - don't wait at all, ClusterOverloaded is raised immediately
+*   "shed" - the same as "block", but if the queue is full, the newest of the lowest-priority queued requests is
+    rejected instead (if it has a lower priority than the new one)
+
+    session.add_url(url, image_hash, admission=AdmissionController(policy='shed', max_queue_size=100))
+
+Every cluster needs its own AdmissionController.
+'''
+import asyncio
+from collections import deque
+from typing import TYPE_CHECKING
+
+import httpx
+
+if TYPE_CHECKING:
+    from typing import Deque, Dict, Optional
+
+BLOCK = 'block'
+FAIL = 'fail'
+SHED = 'shed'
+POLICIES = (BLOCK, FAIL, SHED)
+
+
+class ClusterOverloaded(httpx.TransportError):
+    '''Request was rejected by the AdmissionController'''
+
+
+class AdmissionController:  # pylint: disable=too-many-instance-attributes
+    def __init__(
+        self,
+        policy: str = BLOCK,
+        max_queue_size: int = 1000,
+        initial_limit: int = 20,
+        min_limit: int = 1,
+        max_limit: int = 1000,
+        tolerance: float = 2,
+        backoff: float = 0.9,
+    ):
+        # pylint: disable=too-many-arguments
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown admission policy {policy}, expected one of {POLICIES}")
+        self.policy = policy
+        self.max_queue_size = max_queue_size
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tolerance = tolerance
+        self.backoff = backoff
+
+        self.limit = float(initial_limit)
+
+        #   Number of admitted requests that were not released yet
+        self.in_flight = 0
+
+        #   priority -> futures of the requests waiting for admission
+        self._lanes: 'Dict[int, Deque[asyncio.Future]]' = {}
+
+        #   Latencies of the recent successful requests (-> baseline)
+        self._latencies: 'Deque[float]' = deque(maxlen=100)
+
+        #   Requests admitted before the last decrease of the limit don't decrease it again
+        self._last_decrease_at = float('-inf')
+
+    @property
+    def queue_size(self) -> int:
+        return sum(len(lane) for lane in self._lanes.values())
+
+    async def acquire(self, priority: int = 0, timeout: 'Optional[float]' = None) -> float:
+        '''Wait until the request can be sent. Returns the admission time that should be passed to `release`.'''
+        loop = asyncio.get_event_loop()
+        if self.in_flight < int(self.limit) and not self.queue_size:
+            self.in_flight += 1
+            return loop.time()
+
+        if self.policy == FAIL:
+            raise ClusterOverloaded(f"Cluster is processing {self.in_flight} requests, limit is {int(self.limit)}")
+        if self.queue_size >= self.max_queue_size and not (self.policy == SHED and self._shed(priority)):
+            raise ClusterOverloaded(f"Admission queue is full ({self.max_queue_size} requests)")
+
+        waiter = loop.create_future()
+        self._lanes.setdefault(priority, deque()).append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout)
+        except asyncio.TimeoutError as e:
+            self._abandon(waiter)
+            raise httpx.PoolTimeout(f"Request waited more than {timeout}s for admission") from e
+        except asyncio.CancelledError:
+            self._abandon(waiter)
+            raise
+        return loop.time()
+
+    def release(self, admitted_at: float, failed: 'Optional[bool]') -> None:
+        '''
+        Request admitted at `admitted_at` finished. `failed` is None if the outcome is unknown (e.g. the caller
+        cancelled the request) - the limit is not updated then.
+        '''
+        self.in_flight -= 1
+        if failed is not None:
+            self._update_limit(admitted_at, failed)
+        self._admit_next()
+
+    def _update_limit(self, admitted_at: float, failed: bool) -> None:
+        now = asyncio.get_event_loop().time()
+        latency = now - admitted_at
+        if not failed:
+            self._latencies.append(latency)
+
+        too_slow = bool(self._latencies) and latency > self.tolerance * min(self._latencies)
+        if failed or too_slow:
+            if admitted_at >= self._last_decrease_at:
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+                self._last_decrease_at = now
+        else:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def _admit_next(self) -> None:
+        while self.in_flight < int(self.limit):
+            waiter = self._pop_waiter()
+            if waiter is None:
+                return
+            self.in_flight += 1
+            waiter.set_result(None)
+
+    def _pop_waiter(self) -> 'Optional[asyncio.Future]':
+        for priority in sorted(self._lanes, reverse=True):
+            lane = self._lanes[priority]
+            while lane:
+                waiter = lane.popleft()
+                if not waiter.done():
+                    return waiter
+            del self._lanes[priority]
+        return None
+
+    def _shed(self, priority: int) -> bool:
+        '''Reject the newest of the lowest-priority waiting requests, if it has a lower priority than `priority`'''
+        for lane_priority in sorted(self._lanes):
+            if lane_priority >= priority:
+                return False
+            lane = self._lanes[lane_priority]
+            while lane:
+                waiter = lane.pop()
+                if not waiter.done():
+                    waiter.set_exception(ClusterOverloaded("Request was shed to make room for a higher priority one"))
+                    return True
+        return False
+
+    def _abandon(self, waiter: asyncio.Future) -> None:
+        '''Caller stopped waiting - remove the request from the queue, or give back the slot it was just given'''
+        if not waiter.done():
+            waiter.cancel()
+            for lane in self._lanes.values():
+                if waiter in lane:
+                    lane.remove(waiter)
+                    break
+        elif not waiter.cancelled() and waiter.exception() is None:
+            self.in_flight -= 1
+            self._admit_next()
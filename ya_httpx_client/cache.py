@@ -0,0 +1,476 @@
+'''
+Requestor-side HTTP cache. Responses that the provider-side server marks as cacheable are stored
+and returned without sending the request to a provider:
+
+    cache = ResponseCache(max_memory_size=64 * 2 ** 20, directory='/tmp/yhc_cache')
+    async with session.client(cache=cache) as client:
+        ...
+
+Only GET requests are cached. Freshness is based on `Cache-Control: max-age` or `Expires`, stale responses
+with an `ETag` or `Last-Modified` are revalidated with a conditional request. Concurrent identical requests
+are sent only once (the first one is sent, the others wait for its response).
+
+Bodies of the stored responses are not read in advance - they are streamed to the caller and stored
+when they were read to the end. Responses larger than `max_entry_size` are not stored.
+'''
+import asyncio
+import hashlib
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from typing import TYPE_CHECKING
+
+import httpx
+
+from .serializable_request import pack_frame, unpack_frame
+
+if TYPE_CHECKING:
+    from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+
+#   Status codes that can be cached (RFC 7231, 6.1) - we don't cache partial responses
+CACHEABLE_STATUS_CODES = (200, 203, 300, 301, 308, 404, 405, 410, 414, 501)
+
+#   Successful requests with these methods invalidate the cached response for their url
+INVALIDATING_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+
+CONDITIONAL_HEADERS = ('if-none-match', 'if-modified-since', 'if-match', 'if-unmodified-since', 'if-range')
+
+
+def parse_cache_control(value: 'Optional[str]') -> 'Dict[str, Optional[str]]':
+    '''"no-cache, max-age=10" -> {"no-cache": None, "max-age": "10"}'''
+    directives: 'Dict[str, Optional[str]]' = {}
+    for directive in (value or '').split(','):
+        name, _, arg = directive.strip().partition('=')
+        if name:
+            directives[name.lower()] = arg.strip('"') if arg else None
+    return directives
+
+
+def parse_http_date(value: 'Optional[str]') -> 'Optional[float]':
+    if not value:
+        return None
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+class CacheEntry:
+    '''A single stored response, together with the values of the request headers listed in its Vary header'''
+    def __init__(
+        self, status: int, headers: 'Dict[str, str]', body: bytes, stored_at: float, vary: 'Dict[str, str]',
+    ):
+        # pylint: disable=too-many-arguments
+        self.status = status
+        self.headers = httpx.Headers(headers)
+        self.body = body
+        self.stored_at = stored_at
+        self.vary = vary
+
+    @classmethod
+    def create(cls, status: int, headers: 'httpx.Headers', body: bytes, req_headers: 'httpx.Headers') -> 'CacheEntry':
+        vary_names = [name.strip().lower() for name in headers.get('vary', '').split(',') if name.strip()]
+        vary = {name: req_headers.get(name, '') for name in vary_names}
+        return cls(status, dict(headers.items()), body, time.time(), vary)
+
+    @property
+    def size(self) -> int:
+        return len(self.body) + sum(len(key) + len(val) for key, val in self.headers.items())
+
+    def matches(self, req_headers: 'httpx.Headers') -> bool:
+        '''True if this response can be used for a request with these headers (-> Vary)'''
+        return all(req_headers.get(name, '') == val for name, val in self.vary.items())
+
+    def freshness_lifetime(self) -> float:
+        cache_control = parse_cache_control(self.headers.get('cache-control'))
+        if 'no-cache' in cache_control:
+            return 0
+        if 'max-age' in cache_control:
+            try:
+                return max(0, int(cache_control['max-age'] or 0))
+            except ValueError:
+                return 0
+        expires = parse_http_date(self.headers.get('expires'))
+        if expires is not None:
+            date = parse_http_date(self.headers.get('date'))
+            return max(0, expires - (date if date is not None else self.stored_at))
+        return 0
+
+    def age(self) -> float:
+        try:
+            initial_age = max(0, int(self.headers.get('age', 0)))
+        except ValueError:
+            initial_age = 0
+        return initial_age + time.time() - self.stored_at
+
+    def is_fresh(self) -> bool:
+        return self.freshness_lifetime() > self.age()
+
+    def validators(self) -> 'List[Tuple[bytes, bytes]]':
+        '''Headers of a conditional request that checks if this response is still valid'''
+        validators = []
+        if 'etag' in self.headers:
+            validators.append((b'if-none-match', self.headers['etag'].encode()))
+        if 'last-modified' in self.headers:
+            validators.append((b'if-modified-since', self.headers['last-modified'].encode()))
+        return validators
+
+    def refresh(self, not_modified_headers: 'httpx.Headers') -> None:
+        '''Update with the headers of a 304 Not Modified response'''
+        for key, val in not_modified_headers.items():
+            if key.lower() not in ('content-length', 'content-encoding', 'transfer-encoding'):
+                self.headers[key] = val
+        self.stored_at = time.time()
+
+    def raw_headers(self) -> 'List[Tuple[bytes, bytes]]':
+        age = str(int(self.age())).encode()
+        return [(key, val) for key, val in self.headers.raw if key.lower() != b'age'] + [(b'age', age)]
+
+    def to_bytes(self, key: str) -> bytes:
+        head = {
+            'key': key, 'status': self.status, 'headers': dict(self.headers.items()),
+            'stored_at': self.stored_at, 'vary': self.vary,
+        }
+        return b''.join(pack_frame(head, self.body))
+
+    @classmethod
+    def from_bytes(cls, data: bytes, key: str) -> 'Optional[CacheEntry]':
+        head, body, _ = unpack_frame(data)
+        if head['key'] != key:
+            #   Hash collision
+            return None
+        return cls(head['status'], head['headers'], body, head['stored_at'], head['vary'])
+
+
+class ResponseCache:  # pylint: disable=too-many-instance-attributes
+    '''
+    Storage for the cached responses: LRU in memory (up to `max_memory_size` bytes) and, if `directory`
+    is set, also on disk (LRU up to `max_disk_size` bytes, survives restarts of the requestor agent).
+    Responses larger than `max_entry_size` are not stored at all.
+    A single ResponseCache might be shared by many clients.
+    '''
+    def __init__(
+        self, max_memory_size: int = 64 * 2 ** 20, directory: 'Optional[str]' = None,
+        max_entry_size: int = 8 * 2 ** 20, max_disk_size: int = 2 ** 30,
+    ):
+        self.max_memory_size = max_memory_size
+        self.max_entry_size = max_entry_size
+        self.max_disk_size = max_disk_size
+        self.directory = directory
+
+        self._memory: 'OrderedDict[str, CacheEntry]' = OrderedDict()
+        self._memory_size = 0
+
+        #   Files in the `directory`: name -> size, least recently used first
+        self._disk_files: 'OrderedDict[str, int]' = OrderedDict()
+        self._disk_size = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self._load_disk_index()
+
+        #   key -> future resolved when the request that is now sent is finished (-> single-flight)
+        self.in_flight: 'Dict[str, asyncio.Future]' = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key: str) -> 'Optional[CacheEntry]':
+        entry = self._memory.get(key)
+        if entry is not None:
+            self._memory.move_to_end(key)
+            return entry
+
+        if self.directory is None:
+            return None
+        name = self._disk_name(key)
+        if name not in self._disk_files:
+            return None
+        entry = await self._run_in_executor(self._disk_read, name, key)
+        if entry is not None:
+            self._memory_set(key, entry)
+            if name in self._disk_files:
+                self._disk_files.move_to_end(name)
+        return entry
+
+    async def set(self, key: str, entry: CacheEntry) -> None:
+        self._memory_set(key, entry)
+        if self.directory is None:
+            return
+        name = self._disk_name(key)
+        data = entry.to_bytes(key)
+        if len(data) > self.max_disk_size:
+            return
+        await self._run_in_executor(self._disk_write, name, data)
+
+        self._disk_size -= self._disk_files.pop(name, 0)
+        self._disk_files[name] = len(data)
+        self._disk_size += len(data)
+        removed = []
+        while self._disk_size > self.max_disk_size:
+            removed_name, size = self._disk_files.popitem(last=False)
+            self._disk_size -= size
+            removed.append(removed_name)
+        if removed:
+            await self._run_in_executor(self._disk_remove, removed)
+
+    async def delete(self, key: str) -> None:
+        entry = self._memory.pop(key, None)
+        if entry is not None:
+            self._memory_size -= entry.size
+        if self.directory is not None:
+            name = self._disk_name(key)
+            if name in self._disk_files:
+                self._disk_size -= self._disk_files.pop(name)
+                await self._run_in_executor(self._disk_remove, [name])
+
+    def _memory_set(self, key: str, entry: CacheEntry) -> None:
+        old_entry = self._memory.pop(key, None)
+        if old_entry is not None:
+            self._memory_size -= old_entry.size
+        if entry.size > self.max_memory_size:
+            return
+
+        self._memory[key] = entry
+        self._memory_size += entry.size
+        while self._memory_size > self.max_memory_size:
+            _, removed_entry = self._memory.popitem(last=False)
+            self._memory_size -= removed_entry.size
+
+    @staticmethod
+    async def _run_in_executor(func, *args):
+        #   Disk IO is done in a thread, so that the event loop is not blocked
+        return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+    def _load_disk_index(self) -> None:
+        assert self.directory is not None
+        files = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.part'):
+                #   Interrupted write
+                os.remove(path)
+                continue
+            stat = os.stat(path)
+            files.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(files):
+            self._disk_files[name] = size
+            self._disk_size += size
+
+    def _disk_read(self, name: str, key: str) -> 'Optional[CacheEntry]':
+        assert self.directory is not None
+        try:
+            with open(os.path.join(self.directory, name), 'rb') as f:
+                return CacheEntry.from_bytes(f.read(), key)
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _disk_write(self, name: str, data: bytes) -> None:
+        assert self.directory is not None
+        tmp_fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.part')
+        with os.fdopen(tmp_fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, os.path.join(self.directory, name))
+
+    def _disk_remove(self, names: 'List[str]') -> None:
+        assert self.directory is not None
+        for name in names:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def _disk_name(key: str) -> str:
+        return hashlib.sha256(key.encode()).hexdigest()
+
+
+class CachingStream(httpx.AsyncByteStream):
+    '''
+    Response body that is passed to the caller chunk by chunk and collected at the same time.
+    `on_complete` gets the whole body when it was read to the end and is not larger than `max_size`,
+    otherwise (too large, or closed before the end) None.
+    '''
+    def __init__(
+        self, stream: 'httpx.AsyncByteStream', max_size: int,
+        on_complete: 'Callable[[Optional[bytes]], Awaitable[None]]',
+    ):
+        self.stream = stream
+        self.max_size = max_size
+        self.on_complete = on_complete
+        self._chunks: 'Optional[List[bytes]]' = []
+        self._size = 0
+        self._completed = False
+
+    async def __aiter__(self) -> 'AsyncIterator[bytes]':
+        async for chunk in self.stream:
+            if self._chunks is not None:
+                self._size += len(chunk)
+                if self._size > self.max_size:
+                    self._chunks = None
+                else:
+                    self._chunks.append(chunk)
+            yield chunk
+        await self._complete(None if self._chunks is None else b''.join(self._chunks))
+
+    async def aclose(self) -> None:
+        try:
+            await self.stream.aclose()
+        finally:
+            await self._complete(None)
+
+    async def _complete(self, body: 'Optional[bytes]') -> None:
+        if not self._completed:
+            self._completed = True
+            self._chunks = None
+            await self.on_complete(body)
+
+
+class CachingTransport(httpx.AsyncBaseTransport):
+    '''Wraps another transport (usually YagnaTransport), serves responses from the ResponseCache when possible'''
+    def __init__(self, transport: 'httpx.AsyncBaseTransport', cache: 'ResponseCache'):
+        self.transport = transport
+        self.cache = cache
+
+    async def handle_async_request(self, method, url, headers, stream, extensions):
+        # pylint: disable=too-many-arguments
+        key = self._cache_key(url)
+        req_headers = httpx.Headers(headers)
+        if method.upper() != b'GET' or self._bypass_cache(req_headers):
+            result = await self.transport.handle_async_request(method, url, headers, stream, extensions)
+            if method.decode().upper() in INVALIDATING_METHODS and 200 <= result[0] < 400:
+                await self.cache.delete(key)
+            return result
+
+        #   Single-flight: if the same request is already being sent, we wait for it and use its response
+        entry = await self._wait_in_flight(key, req_headers)
+        if entry is not None:
+            self.cache.hits += 1
+            return entry.status, entry.raw_headers(), httpx.ByteStream(entry.body), {}
+
+        finished = self._start_in_flight(key)
+        try:
+            status, res_headers, res_stream = await self._get_response(
+                key, method, url, headers, stream, extensions, finished,
+            )
+        except BaseException:
+            finished(None)
+            raise
+        return status, res_headers, res_stream, {}
+
+    async def _wait_in_flight(self, key: str, req_headers: 'httpx.Headers') -> 'Optional[CacheEntry]':
+        '''Entry stored by the same request that is being sent now, if it can be used for this request'''
+        in_flight = self.cache.in_flight.get(key)
+        if in_flight is None:
+            return None
+        entry = await asyncio.shield(in_flight)
+        if entry is not None and entry.matches(req_headers):
+            return entry
+        return None
+
+    def _start_in_flight(self, key: str) -> 'Callable[[Optional[CacheEntry]], None]':
+        '''
+        Make the following requests for `key` wait for this one. Returns a function that must be called when
+        the response is stored (or will not be stored), possibly after the body was read.
+        '''
+        fut = asyncio.get_event_loop().create_future()
+        self.cache.in_flight[key] = fut
+
+        def finished(entry: 'Optional[CacheEntry]') -> None:
+            if self.cache.in_flight.get(key) is fut:
+                del self.cache.in_flight[key]
+            if not fut.done():
+                fut.set_result(entry)
+        return finished
+
+    async def _get_response(self, key, method, url, headers, stream, extensions, finished):
+        # pylint: disable=too-many-arguments
+        req_headers = httpx.Headers(headers)
+        req_cache_control = parse_cache_control(req_headers.get('cache-control'))
+
+        entry = await self.cache.get(key)
+        if entry is not None and not entry.matches(req_headers):
+            entry = None
+
+        if entry is not None:
+            if entry.is_fresh() and 'no-cache' not in req_cache_control and req_cache_control.get('max-age') != '0':
+                self.cache.hits += 1
+                finished(entry)
+                return entry.status, entry.raw_headers(), httpx.ByteStream(entry.body)
+            headers = list(headers) + entry.validators()
+        self.cache.misses += 1
+
+        status, res_headers, res_stream, _ = await self.transport.handle_async_request(
+            method, url, headers, stream, extensions,
+        )
+        res_headers = httpx.Headers(res_headers)
+
+        if status == 304 and entry is not None:
+            await res_stream.aclose()
+            entry.refresh(res_headers)
+            await self.cache.set(key, entry)
+            finished(entry)
+            return entry.status, entry.raw_headers(), httpx.ByteStream(entry.body)
+
+        if not self._is_storable(status, res_headers, req_cache_control, self.cache.max_entry_size):
+            finished(None)
+            return status, res_headers.raw, res_stream
+
+        #   Body is streamed to the caller and stored when it was read to the end
+        return status, res_headers.raw, self._caching_stream(
+            key, res_stream, lambda body: CacheEntry.create(status, res_headers, body, req_headers), finished,
+        )
+
+    def _caching_stream(
+        self, key: str, res_stream: 'httpx.AsyncByteStream', create_entry: 'Callable[[bytes], CacheEntry]',
+        finished: 'Callable[[Optional[CacheEntry]], None]',
+    ) -> 'CachingStream':
+        async def store(body: 'Optional[bytes]') -> None:
+            new_entry = None
+            try:
+                if body is not None:
+                    new_entry = create_entry(body)
+                    await self.cache.set(key, new_entry)
+            finally:
+                finished(new_entry)
+
+        return CachingStream(res_stream, self.cache.max_entry_size, store)
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+    @staticmethod
+    def _cache_key(url: 'Tuple[bytes, bytes, Optional[int], bytes]') -> str:
+        scheme, host, port, path = url
+        return f'{scheme.decode()}://{host.decode()}:{port}{path.decode()}'
+
+    @staticmethod
+    def _bypass_cache(req_headers: 'httpx.Headers') -> bool:
+        #   Requests that are already conditional or forbid storing are not our business
+        if 'no-store' in parse_cache_control(req_headers.get('cache-control')):
+            return True
+        return any(name in req_headers for name in CONDITIONAL_HEADERS)
+
+    @staticmethod
+    def _is_storable(
+        status: int, res_headers: 'httpx.Headers', req_cache_control: 'Dict[str, Optional[str]]', max_size: int,
+    ) -> bool:
+        cache_control = parse_cache_control(res_headers.get('cache-control'))
+        if status not in CACHEABLE_STATUS_CODES or 'no-store' in cache_control or 'no-store' in req_cache_control:
+            return False
+        if res_headers.get('vary', '').strip() == '*':
+            return False
+        try:
+            if int(res_headers.get('content-length', 0)) > max_size:
+                return False
+        except ValueError:
+            return False
+
+        #   Response is worth storing if it's fresh for some time or can be revalidated
+        has_validators = 'etag' in res_headers or 'last-modified' in res_headers
+        has_lifetime = (
+            'max-age' in cache_control or 'expires' in res_headers
+        ) and 'no-cache' not in cache_control
+        return has_validators or has_lifetime
@@ -1,17 +1,30 @@
 import asyncio
+import logging
+from collections import deque
 from typing import TYPE_CHECKING
 
 from yapapi.payload import vm
 
 from . import service
+from .metrics import RESTARTS, STARTUP_TIME
+from .scheduler import LatencyWeightedScheduler
 
 if TYPE_CHECKING:
-    from typing import Callable, Union, SupportsInt, List, Optional, Tuple
+    from typing import Callable, Union, SupportsInt, List, Optional, Tuple, Deque, Dict, Any
+    from yapapi.network import Network
     from yapapi_service_manager import ServiceManager
     from .network_wrapper import NetworkWrapper
+    from .admission import AdmissionController
+    from .health import HealthPolicy
+    from .hedging import HedgingPolicy
+    from .performance import PerformanceStore
+    from .scheduler import Scheduler
+    from .service.service_base import AbstractServiceBase
 
+logger = logging.getLogger(__name__)
 
-class Cluster:
+
+class Cluster:  # pylint: disable=too-many-instance-attributes
     '''
     Q: Here is a Cluster class, and we have a `yapapi.Cluster`. Both seem to wrap a bunch of services.
        Do we need two separate clusters for this?
@@ -24,25 +37,76 @@ class Cluster:
     #   If False, requests will be serialized to a temporary file
     USE_VPN = True
 
+    #   Cluster reacts to events (size changes, services starting/failing), but some things can't be observed
+    #   this way and have to be checked periodically:
+    #   *   status of the services (e.g. provider might disappear without our service noticing) - every
+    #       STATUS_POLL_INTERVAL seconds
+    #   *   expected size, if it's not an integer (-> set_size) - every SIZE_POLL_INTERVAL seconds
+    STATUS_POLL_INTERVAL = 5
+    SIZE_POLL_INTERVAL = 1
+
     def __init__(
             self,
             manager: 'ServiceManager',
             image_hash: str,
             entrypoint: 'Optional[Tuple[str, ...]]',
-            network_wrapper: 'NetworkWrapper'
+            network_wrapper: 'NetworkWrapper',
+            provider_concurrency: int = 1,
+            scheduler: 'Optional[Scheduler]' = None,
+            hedging: 'Optional[HedgingPolicy]' = None,
+            name: str = '',
+            health: 'Optional[HealthPolicy]' = None,
+            performance: 'Optional[PerformanceStore]' = None,
+            admission: 'Optional[AdmissionController]' = None,
+            port: int = 80,
     ):
+        # pylint: disable=too-many-arguments
         self.manager = manager
         self.image_hash = image_hash
         self.entrypoint = entrypoint
         self.network_wrapper = network_wrapper
 
-        #   This queue is filled by YagnaTransport and emptied by Service instances
-        self.request_queue: asyncio.Queue = asyncio.Queue()
+        #   Used in logs and metrics (Session uses the url)
+        self.name = name
+
+        #   Port the provider-side server listens on (VPN only)
+        self.port = port
+
+        #   Clusters that don't have their own services, their requests are processed by our services
+        #   (on their port) - and the other way around, `host` is the cluster whose services process our requests
+        self.colocated: 'List[Cluster]' = []
+        self.host: 'Optional[Cluster]' = None
+
+        #   How many requests a single service processes at the same time
+        self.provider_concurrency = provider_concurrency
+
+        #   Scheduler is filled by YagnaTransport and emptied by Service instances
+        self.scheduler: 'Scheduler' = scheduler if scheduler is not None else LatencyWeightedScheduler()
+
+        #   If set, slow requests are sent also to a second provider (-> YagnaTransport)
+        self.hedging = hedging
+
+        #   If set, services that are much worse than the others are replaced and their providers blacklisted
+        self.health = health
+
+        #   If set, performance of every service is saved there when it stops (-> PerformanceStrategy)
+        self.performance = performance
+
+        #   If set, number of requests sent to the scheduler at the same time is limited (-> YagnaTransport)
+        self.admission = admission
 
         #   This is how many services we want to have running. It is set here to 0, but curretly
         #   every Cluster initialization is followed by a call to set_size, so this doesn't really matter.
         self.expected_cnt: 'Union[int, SupportsInt]' = 0
 
+        #   This is how many additional services we want to have running, but not processing any requests.
+        #   They replace failed services and take traffic when `expected_cnt` grows without waiting for a new provider.
+        self.spare_cnt: 'Union[int, SupportsInt]' = 0
+
+        #   Services that are already running, in the order they started. First `expected_cnt` of them
+        #   process requests, the rest are spares.
+        self._running_services: 'List[AbstractServiceBase]' = []
+
         #   Task that starts new services will be stored here (created later, because now we might not
         #   have a loop running yet)
         self._new_services_starter_task: 'Optional[asyncio.Task]' = None
@@ -51,79 +115,278 @@ class Cluster:
         #   (and thus to a single instance of a running service, assuming it already started and didn't stop)
         self._manager_tasks: 'List[asyncio.Task]' = []
 
+        #   Number of not-done tasks in self._manager_tasks
+        self._live_cnt = 0
+
+        #   yapapi_service_manager.ServiceWrapper -> network it was created in (-> NetworkWrapper.release)
+        self._service_networks: 'Dict[Any, Network]' = {}
+
+        #   Incremented every time something changed (-> _notify). Tasks waiting in `_wait_for_change` are woken up,
+        #   and a task that calls it after a change it didn't see yet doesn't wait at all - so no change is ever missed.
+        self._generation = 0
+        self._change_waiters: 'List[asyncio.Future]' = []
+
+        #   How long (seconds) it took recently started services to get from 'pending' to 'running'
+        self.startup_times: 'Deque[float]' = deque(maxlen=20)
+
+    @property
+    def request_queue(self) -> 'Scheduler':
+        '''Deprecated alias, left for compatibility - scheduler has `qsize` and `empty` the same way the queue had'''
+        return self.scheduler
+
+    @property
+    def avg_startup_time(self) -> 'Optional[float]':
+        if not self.startup_times:
+            return None
+        return sum(self.startup_times) / len(self.startup_times)
+
     @property
     def cnt(self) -> int:
-        current_manager_tasks = [task for task in self._manager_tasks if not task.done()]
-        return len(current_manager_tasks)
+        return self._live_cnt
+
+    def colocate(self, guest: 'Cluster') -> None:
+        '''
+        Process requests of the `guest` cluster on the same providers: our services take requests also from the
+        guest's scheduler and send them to the guest's port. Entrypoint of our image must start all the servers.
+        Guest cluster has no services of its own, so its size can't be set. Must be called before `start`.
+        '''
+        if not self.USE_VPN:
+            raise ValueError("Colocated clusters work only with VPN")
+        if self._new_services_starter_task is not None:
+            raise RuntimeError(f"Cluster {self.name} was already started, it's too late to colocate {guest.name}")
+        if self.host is not None or guest.host is not None or guest.colocated:
+            raise ValueError(f"Can't colocate {guest.name} with {self.name}: only one level of colocation is allowed")
+        guest.host = self
+        self.colocated.append(guest)
 
     def start(self) -> None:
+        if self.host is not None:
+            #   Our requests are processed by the services of the host cluster
+            return
         if self._new_services_starter_task is None:
             self._new_services_starter_task = asyncio.get_event_loop().create_task(self._start_new_services())
 
     def stop(self) -> None:
+        for running_service in self._running_services:
+            self._record_performance(running_service)
         for task in self._manager_tasks:
             task.cancel()
         if self._new_services_starter_task is not None:
             self._new_services_starter_task.cancel()
 
     def set_size(self, size: 'Union[int, Callable[[Cluster], SupportsInt]]') -> None:
+        self._check_not_colocated()
         if isinstance(size, int):
             self.expected_cnt = size
         else:
             self.expected_cnt = size(self)
+        self._notify()
+
+    def set_spare_size(self, size: 'Union[int, Callable[[Cluster], SupportsInt]]') -> None:
+        '''
+        Same as `set_size`, but for the spare services. Callable might implement a schedule, e.g. keep
+        some spares only during working hours, when we expect the traffic to grow.
+        '''
+        self._check_not_colocated()
+        if isinstance(size, int):
+            self.spare_cnt = size
+        else:
+            self.spare_cnt = size(self)
+        self._notify()
+
+    def _check_not_colocated(self) -> None:
+        if self.host is not None:
+            raise ValueError(f"Cluster {self.name} runs on the services of {self.host.name}, set the size there")
+
+    @property
+    def total_expected_cnt(self) -> int:
+        return int(self.expected_cnt) + int(self.spare_cnt)
 
     async def _start_new_services(self) -> None:
+        loop = asyncio.get_event_loop()
         while True:
-            expected_cnt = int(self.expected_cnt)
-            loop = asyncio.get_event_loop()
-            new_tasks = [loop.create_task(self._manage_single_service()) for _ in range(self.cnt, expected_cnt)]
-            self._manager_tasks += new_tasks
-            await asyncio.sleep(1)
+            generation = self._generation
+            for _ in range(self.cnt, self.total_expected_cnt):
+                task = loop.create_task(self._manage_single_service())
+                task.add_done_callback(self._manager_task_done)
+                self._manager_tasks.append(task)
+                self._live_cnt += 1
+            self._assign_roles()
+
+            sizes_are_fixed = isinstance(self.expected_cnt, int) and isinstance(self.spare_cnt, int)
+            await self._wait_for_change(generation, None if sizes_are_fixed else self.SIZE_POLL_INTERVAL)
+
+    def _manager_task_done(self, task: 'asyncio.Task') -> None:
+        self._manager_tasks.remove(task)
+
+    def _notify(self) -> None:
+        self._generation += 1
+        waiters, self._change_waiters = self._change_waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def _wait_for_change(self, seen_generation: int, timeout: 'Optional[float]') -> None:
+        '''Wait until something changed after the `seen_generation` (or for `timeout` seconds)'''
+        if self._generation != seen_generation:
+            return
+        waiter = asyncio.get_event_loop().create_future()
+        self._change_waiters.append(waiter)
+        try:
+            await asyncio.wait([waiter], timeout=timeout)
+        finally:
+            if waiter in self._change_waiters:
+                self._change_waiters.remove(waiter)
+
+    def _service_started(self, started_service: 'AbstractServiceBase') -> None:
+        self._running_services.append(started_service)
+        self._assign_roles()
+        self._notify()
+
+    def _service_failed(self, failed_service: 'AbstractServiceBase') -> None:
+        '''Service noticed it failed - we don't wait for the status change to restart its requests'''
+        logger.warning("Service on %s failed", failed_service.provider_name)
+        RESTARTS.inc(cluster=self.name)
+        self._service_stopped(failed_service)
+        failed_service.restart_failed_requests()
+        self._notify()
+
+    def _service_stopped(self, stopped_service: 'AbstractServiceBase') -> None:
+        if stopped_service in self._running_services:
+            self._record_performance(stopped_service)
+            self._running_services.remove(stopped_service)
+        #   If this was an active service, a spare (if there is any) is promoted right now
+        self._assign_roles()
+
+    def _assign_roles(self) -> None:
+        active_cnt = int(self.expected_cnt)
+        for i, running_service in enumerate(self._running_services):
+            running_service.set_active(i < active_cnt)
 
     async def _manage_single_service(self) -> None:
+        try:
+            await self._manage_single_service_wrapper()
+        finally:
+            #   Counter is decreased here and not in the task done callback, because callback is called later
+            #   and other manager tasks could see the old value in the meantime (and e.g. stop too many services)
+            self._live_cnt -= 1
+            self._notify()
+
+    async def _manage_single_service_wrapper(self) -> None:
         service_wrapper = None
+        loop = asyncio.get_event_loop()
 
         while True:
+            generation = self._generation
             if service_wrapper is None:
                 service_wrapper = await self._create_service_wrapper()
+                created_at, started = loop.time(), False
 
-            if int(self.expected_cnt) < self.cnt:
-                #   There are too many services running, (at least) one has to stop
+            if self._should_stop(service_wrapper.service):
+                #   There are too many services running, (at least) one has to stop.
+                #   Requests it is processing now will be processed by other services.
                 service_wrapper.stop()
+                if service_wrapper.service is not None:
+                    self._service_stopped(service_wrapper.service)
+                    service_wrapper.service.restart_failed_requests()
+                self._release_network(service_wrapper)
                 break
 
-            await asyncio.sleep(1)
+            await self._wait_for_change(generation, self.STATUS_POLL_INTERVAL)
 
-            if service_wrapper.status in ('pending', 'starting'):
-                print(f"waiting for the service, current status: {service_wrapper.status}")
-            elif service_wrapper.status == 'running':
-                pass
+            wrapped_service = service_wrapper.service
+            if wrapped_service is not None and wrapped_service in self._running_services:
+                self._check_health(wrapped_service)
+            failed = wrapped_service is not None and wrapped_service.failed
+            if not failed and (service_wrapper.status == 'running' or wrapped_service in self._running_services):
+                if not started:
+                    started = True
+                    self.startup_times.append(loop.time() - created_at)
+                    STARTUP_TIME.observe(loop.time() - created_at, cluster=self.name)
+            elif not failed and service_wrapper.status in ('pending', 'starting'):
+                logger.debug("Waiting for the service, current status: %s", service_wrapper.status)
             else:
-                print(f"Replacing service on {service_wrapper.service.provider_name} - it is {service_wrapper.status}")
-                service_wrapper.service.restart_failed_request()
-
-                #   TODO: We don't stop the old service_wrapper, because it is dead either way.
-                #         We can distinguish "stopped" wrappers from  "failed"  (although we don't
-                #         use this distinction). Think again if this is harmless.
+                logger.warning(
+                    "Replacing service on %s - it is %s", service_wrapper.service.provider_name, service_wrapper.status,
+                )
+                if not failed:
+                    #   Failed services were already counted in _service_failed
+                    RESTARTS.inc(cluster=self.name)
+                self._service_stopped(service_wrapper.service)
+                service_wrapper.service.restart_failed_requests()
+                if service_wrapper.status == 'running':
+                    #   Service failed (or was ejected), but the provider is still there - we don't need it anymore
+                    service_wrapper.stop()
+                self._release_network(service_wrapper)
                 service_wrapper = None
 
+    def _should_stop(self, running_service: 'Optional[AbstractServiceBase]') -> bool:
+        '''
+        There are too many services - should this one stop? Services that didn't start yet stop first, then spares,
+        then the most recently started active services (-> _assign_roles).
+        '''
+        excess_cnt = self.cnt - self.total_expected_cnt
+        if excess_cnt <= 0:
+            return False
+        if running_service not in self._running_services:
+            return True
+        not_started_cnt = max(0, self.cnt - len(self._running_services))
+        started_later_cnt = len(self._running_services) - 1 - self._running_services.index(running_service)
+        return not_started_cnt + started_later_cnt < excess_cnt
+
+    def _check_health(self, running_service: 'AbstractServiceBase') -> None:
+        '''If the service is an outlier, mark it as failed (-> it will be replaced) and blacklist the provider'''
+        if self.health is None or running_service not in self.scheduler.stats:
+            return
+
+        other_stats = [
+            self.scheduler.stats[other] for other in self._running_services
+            if other is not running_service and other in self.scheduler.stats
+        ]
+        reason = self.health.outlier_reason(self.scheduler.stats[running_service], other_stats)
+        if reason is not None:
+            logger.warning("Ejecting provider %s: %s", running_service.provider_name, reason)
+            if running_service.provider_id is not None:
+                self.health.blacklist.add(running_service.provider_id)
+            running_service.eject()
+
+    def _record_performance(self, running_service: 'AbstractServiceBase') -> None:
+        stats = self.scheduler.stats.get(running_service)
+        if self.performance is not None and stats is not None and running_service.provider_id is not None:
+            self.performance.record(self.name, running_service.provider_id, stats)
+
     async def _create_service_wrapper(self):
         service_cls = self._service_cls()
-        capabilities = service_cls.REQUIRED_CAPABILITIES
-        payload = await vm.repo(image_hash=self.image_hash, capabilities=capabilities)
-        network = await self.network_wrapper.network()
+        payload = await self._payload(service_cls)
+        network = await self.network_wrapper.network(self.name)
 
-        return self.manager.create_service(
+        service_wrapper = self.manager.create_service(
             service_cls,
             run_service_params={
                 'payload': payload,
                 'network': network,
                 'instance_params': [{
                     'entrypoint': self.entrypoint,
-                    'request_queue': self.request_queue,
+                    'scheduler': self.scheduler,
+                    'concurrency': self.provider_concurrency,
+                    'on_started': self._service_started,
+                    'on_failed': self._service_failed,
+                    'port': self.port,
+                    'colocated': [(guest.scheduler, guest.port) for guest in self.colocated],
                 }],
             },
         )
+        self._service_networks[service_wrapper] = network
+        return service_wrapper
+
+    def _release_network(self, service_wrapper) -> None:
+        network = self._service_networks.pop(service_wrapper, None)
+        if network is not None:
+            self.network_wrapper.release(network)
+
+    async def _payload(self, service_cls):
+        capabilities = service_cls.REQUIRED_CAPABILITIES
+        return await vm.repo(image_hash=self.image_hash, capabilities=capabilities)
 
     def _service_cls(self):
         cls = service.VPNService if self.USE_VPN else service.FileSerializationService
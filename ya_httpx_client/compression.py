@@ -0,0 +1,151 @@
+'''
+Compression of request/response bodies on the wire between the requestor and the provider.
+
+This is independent of the HTTP server: bodies are compressed only in our frames (-> serializable_request.pack_frame),
+the server and the client see exactly the same bodies and headers as without the compression. A compressed frame has
+the "encoding" key in its head, so the other side knows what to decompress - the only thing that must be configured
+on both sides is whether the responses should be compressed.
+
+Used by FileSerializationService (`FileSerializationService.COMPRESSION`, bodies in the batch files) and by VPNService
+with MULTIPLEXING (`VPNService.COMPRESSION`, bodies in the multiplexed streams). Provider-side worker/sidecar is
+started with the same settings.
+
+"zstd" requires the `zstandard` package (`ya-httpx-client[zstd]`), on both sides.
+'''
+import gzip
+import shlex
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from typing import Dict, Optional, Sequence
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+ALGORITHMS = (GZIP, ZSTD)
+
+#   Content types that are usually worth compressing. Entries ending with "/" match all subtypes,
+#   ANY_CONTENT_TYPE matches everything.
+ANY_CONTENT_TYPE = '*'
+DEFAULT_CONTENT_TYPES = (
+    'text/',
+    'application/json',
+    'application/xml',
+    'application/javascript',
+    'application/x-www-form-urlencoded',
+)
+
+
+class Compression:
+    '''
+    Bodies are compressed if:
+
+    *   they have at least `threshold` bytes
+    *   their Content-Type is in `content_types` (missing Content-Type matches only ANY_CONTENT_TYPE)
+    *   they were not already compressed by the server or the client (i.e. there is no Content-Encoding header)
+    *   compressed body is smaller than the original one
+    '''
+    def __init__(
+        self,
+        algorithm: str = GZIP,
+        threshold: int = 1024,
+        content_types: 'Sequence[str]' = DEFAULT_CONTENT_TYPES,
+        level: 'Optional[int]' = None,
+    ):
+        if algorithm not in ALGORITHMS:
+            raise ValueError(f"Unknown compression algorithm {algorithm}, expected one of {ALGORITHMS}")
+        if algorithm == ZSTD:
+            _zstandard()
+        self.algorithm = algorithm
+        self.threshold = threshold
+        self.content_types = tuple(val.lower() for val in content_types)
+        self.level = level
+
+    def should_compress(self, headers: 'Dict[str, str]', body: bytes) -> bool:
+        if len(body) < self.threshold:
+            return False
+        lower_headers = {key.lower(): val for key, val in headers.items()}
+        if lower_headers.get('content-encoding', 'identity').lower() != 'identity':
+            return False
+        if ANY_CONTENT_TYPE in self.content_types:
+            return True
+
+        content_type = lower_headers.get('content-type', '').split(';')[0].strip().lower()
+        return bool(content_type) and any(
+            content_type.startswith(allowed) if allowed.endswith('/') else content_type == allowed
+            for allowed in self.content_types
+        )
+
+    def compress(self, body: bytes) -> bytes:
+        if self.algorithm == ZSTD:
+            level = 3 if self.level is None else self.level
+            return _zstandard().ZstdCompressor(level=level).compress(body)
+        return gzip.compress(body, 6 if self.level is None else self.level)
+
+    def maybe_compress(self, headers: 'Dict[str, str]', body: bytes) -> 'Optional[bytes]':
+        '''Compressed body, or None if it should be sent as it is'''
+        if not self.should_compress(headers, body):
+            return None
+        compressed = self.compress(body)
+        if len(compressed) >= len(body):
+            return None
+        return compressed
+
+    def cli_args(self) -> str:
+        '''Options of the provider-side commands (-> ya_httpx_client.worker) that enable the same compression'''
+        args = ['--compression', self.algorithm, '--compression-threshold', str(self.threshold)]
+        if self.level is not None:
+            args += ['--compression-level', str(self.level)]
+        for content_type in self.content_types:
+            args += ['--compression-content-type', content_type]
+        return ' '.join(shlex.quote(arg) for arg in args)
+
+
+def from_cli_options(
+    algorithm: 'Optional[str]', threshold: int, content_types: 'Sequence[str]', level: 'Optional[int]' = None,
+) -> 'Optional[Compression]':
+    '''Counterpart of Compression.cli_args'''
+    if algorithm is None:
+        return None
+    return Compression(algorithm, threshold, content_types or DEFAULT_CONTENT_TYPES, level)
+
+
+def compression_options(func):
+    '''
+    Click options parsed by `from_cli_options`. The decorated command gets them as a single `compression`
+    argument (Compression or None).
+    '''
+    import functools  # pylint: disable=import-outside-toplevel
+    import click  # pylint: disable=import-outside-toplevel
+
+    @functools.wraps(func)
+    def wrapper(*args, compression, compression_threshold, compression_level, compression_content_types, **kwargs):
+        response_compression = from_cli_options(
+            compression, compression_threshold, compression_content_types, compression_level,
+        )
+        return func(*args, compression=response_compression, **kwargs)
+
+    wrapper = click.option('--compression-content-type', 'compression_content_types', multiple=True,
+                           help='Compress only responses with this content type (default: common text types)')(wrapper)
+    wrapper = click.option('--compression-level', type=int,
+                           help='Compression level (default: 6 for gzip, 3 for zstd)')(wrapper)
+    wrapper = click.option('--compression-threshold', type=int, default=1024,
+                           help='Compress only responses with at least that many bytes')(wrapper)
+    wrapper = click.option('--compression', type=click.Choice(ALGORITHMS),
+                           help='Compress the responses (requests are decompressed always when necessary)')(wrapper)
+    return wrapper
+
+
+def decompress(algorithm: str, body: bytes) -> bytes:
+    if algorithm == GZIP:
+        return gzip.decompress(body)
+    if algorithm == ZSTD:
+        return _zstandard().ZstdDecompressor().decompress(body)
+    raise ValueError(f"Unknown compression algorithm {algorithm}, expected one of {ALGORITHMS}")
+
+
+def _zstandard():
+    try:
+        import zstandard  # type: ignore  # pylint: disable=import-outside-toplevel
+    except ImportError as e:
+        raise ImportError("zstd compression requires the zstandard package") from e
+    return zstandard
@@ -0,0 +1,150 @@
+'''
+Provider health: services that are alive, but fail or are much slower than the others, are replaced
+(-> Cluster) and their providers are blacklisted, so that we don't sign an agreement with them again.
+
+    session = Session(executor_cfg, health=HealthPolicy(blacklist_file='blacklist.json'))
+'''
+import json
+import logging
+import os
+import time
+from decimal import Decimal
+from typing import TYPE_CHECKING
+
+from yapapi.props import com
+from yapapi.strategy import SCORE_REJECTED, LeastExpensiveLinearPayuMS, WrappingMarketStrategy
+
+if TYPE_CHECKING:
+    from typing import Dict, Iterable, Optional
+    from yapapi import rest
+    from yapapi.strategy import BaseMarketStrategy
+    from .scheduler import ProviderStats
+
+logger = logging.getLogger(__name__)
+
+
+class ProviderBlacklist:
+    '''Provider ids that should not be used, each one for `ttl` seconds. Saved in `path` (if set) on every change.'''
+    def __init__(self, path: 'Optional[str]' = None, ttl: float = 24 * 60 * 60):
+        self.path = path
+        self.ttl = ttl
+
+        #   provider id -> timestamp when it should be removed from the blacklist
+        self._expires_at: 'Dict[str, float]' = {}
+        self._load()
+
+    def add(self, provider_id: str) -> None:
+        self._expires_at[provider_id] = time.time() + self.ttl
+        self._save()
+
+    def __contains__(self, provider_id: str) -> bool:
+        expires_at = self._expires_at.get(provider_id)
+        if expires_at is None:
+            return False
+        if expires_at < time.time():
+            del self._expires_at[provider_id]
+            self._save()
+            return False
+        return True
+
+    def _load(self) -> None:
+        if self.path is None or not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            self._expires_at = json.load(f)
+
+    def _save(self) -> None:
+        if self.path is None:
+            return
+        tmp_path = self.path + '.part'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._expires_at, f)
+        os.replace(tmp_path, self.path)
+
+
+class HealthPolicy:
+    '''
+    Decides when a running service is an outlier that should be replaced. A service with at least `min_requests`
+    processed requests is an outlier if:
+
+    *   its (EWMA) rate of failures (tunnel errors, timeouts, 502/503/504 responses created by ya_httpx_client on
+        the provider side) is above `max_error_rate`, or
+    *   its (EWMA) rate of 5xx responses of the application is higher than the median rate of the other services
+        by more than `max_error_rate` (so a bug in the application that fails some requests on all providers
+        doesn't make them outliers), or
+    *   its (EWMA) latency is more than `latency_factor` times the median latency of the other services, or
+    *   websocket handshake failed `max_handshake_failures` times since the last successful request
+        (this doesn't require `min_requests`)
+
+    Providers of the outliers are added to the `blacklist`.
+    '''
+    def __init__(
+        self,
+        min_requests: int = 10,
+        max_error_rate: float = 0.5,
+        latency_factor: float = 5,
+        max_handshake_failures: int = 3,
+        blacklist_file: 'Optional[str]' = None,
+        blacklist_ttl: float = 24 * 60 * 60,
+    ):
+        # pylint: disable=too-many-arguments
+        self.min_requests = min_requests
+        self.max_error_rate = max_error_rate
+        self.latency_factor = latency_factor
+        self.max_handshake_failures = max_handshake_failures
+        self.blacklist = ProviderBlacklist(blacklist_file, blacklist_ttl)
+
+    def outlier_reason(self, stats: 'ProviderStats', other_stats: 'Iterable[ProviderStats]') -> 'Optional[str]':
+        '''Reason why a service with these stats should be replaced, or None if it is healthy'''
+        if stats.handshake_failures >= self.max_handshake_failures:
+            return f"{stats.handshake_failures} websocket handshake failures"
+
+        if stats.completed < self.min_requests:
+            return None
+
+        if stats.error_rate > self.max_error_rate:
+            return f"error rate {stats.error_rate:.2f}"
+
+        other_stats = [other for other in other_stats if other.completed >= self.min_requests]
+        other_app_error_rates = sorted(other.app_error_rate for other in other_stats)
+        if other_app_error_rates:
+            median_app_error_rate = other_app_error_rates[len(other_app_error_rates) // 2]
+            if stats.app_error_rate - median_app_error_rate > self.max_error_rate:
+                return (
+                    f"application error rate {stats.app_error_rate:.2f}, "
+                    f"median of other providers is {median_app_error_rate:.2f}"
+                )
+
+        other_latencies = sorted(
+            other.ewma_latency for other in other_stats if other.ewma_latency is not None
+        )
+        if stats.ewma_latency is not None and other_latencies:
+            median_latency = other_latencies[len(other_latencies) // 2]
+            if stats.ewma_latency > self.latency_factor * median_latency:
+                return f"latency {stats.ewma_latency:.3f}s, median of other providers is {median_latency:.3f}s"
+        return None
+
+    def strategy(self, base_strategy: 'Optional[BaseMarketStrategy]') -> 'BlacklistStrategy':
+        return BlacklistStrategy(base_strategy or default_strategy(), self.blacklist)
+
+
+class BlacklistStrategy(WrappingMarketStrategy):
+    '''Market strategy that rejects offers from the blacklisted providers and otherwise uses the base strategy'''
+    def __init__(self, base_strategy: 'BaseMarketStrategy', blacklist: ProviderBlacklist):
+        super().__init__(base_strategy)
+        self.blacklist = blacklist
+
+    async def score_offer(self, offer: 'rest.market.OfferProposal') -> float:
+        if offer.issuer in self.blacklist:
+            logger.debug("Rejecting offer from a blacklisted provider %s", offer.issuer)
+            return SCORE_REJECTED
+        return await super().score_offer(offer)
+
+
+def default_strategy() -> 'BaseMarketStrategy':
+    '''Same as the default yapapi strategy (except for lowering the score of providers that didn't confirm
+    an agreement, because this requires access to the yapapi event stream)'''
+    return LeastExpensiveLinearPayuMS(
+        max_fixed_price=Decimal("1.0"),
+        max_price_for={com.Counter.CPU: Decimal("0.2"), com.Counter.TIME: Decimal("0.1")},
+    )
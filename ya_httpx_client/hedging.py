@@ -0,0 +1,47 @@
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from typing import Iterable, Optional
+    from .scheduler import Scheduler
+    from .serializable_request import Request
+
+
+class HedgingPolicy:
+    '''
+    Request hedging: if there is no response after `delay` seconds, the same request is sent also to a different
+    provider. Whichever response comes first is returned, the other request is abandoned (if a service already took it,
+    it is processed to the end and the response is discarded - this is the extra load caused by hedging).
+
+    Delay is the `percentile` of the recently observed latencies (but at least `min_delay`), or `default_delay` if
+    we don't know enough latencies yet. Only idempotent requests are hedged (`methods`), and only when there are no
+    requests waiting in the scheduler - a duplicate would only make the backlog longer.
+    '''
+    #   Below this number of processed requests latency percentiles are not reliable
+    MIN_SAMPLES = 20
+
+    def __init__(
+        self,
+        percentile: float = 95,
+        min_delay: float = 0.05,
+        default_delay: float = 1,
+        methods: 'Iterable[str]' = ('GET', 'HEAD'),
+    ):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.default_delay = default_delay
+        self.methods = set(method.upper() for method in methods)
+
+    def applies_to(self, req: 'Request') -> bool:
+        #   Streamed body can't be sent twice at the same time
+        return req.method.upper() in self.methods and req.stream is None
+
+    def delay(self, scheduler: 'Scheduler') -> float:
+        latency: 'Optional[float]' = None
+        if len(scheduler.latencies) >= self.MIN_SAMPLES:
+            latency = scheduler.latency_percentile(self.percentile)
+        if latency is None:
+            return self.default_delay
+        return max(latency, self.min_delay)
+
+    def should_hedge(self, scheduler: 'Scheduler') -> bool:
+        return scheduler.empty()
@@ -0,0 +1,156 @@
+'''
+Client side of HTTP/1.1 connections, independent of the transport. Parsing and framing (Content-Length,
+chunked encoding, keep-alive) is done by h11.
+
+Used on the requestor side over websocket tunnels (-> service.ws_stream) and on the provider side by the sidecar,
+over plain TCP connections to the local server (-> ya_httpx_client.sidecar).
+'''
+from abc import ABC, abstractmethod
+from typing import TYPE_CHECKING
+
+import h11
+
+from .serializable_request import Response
+
+if TYPE_CHECKING:
+    from typing import Any, AsyncIterator, List, Optional
+    from .serializable_request import Request
+
+
+def h11_request(req: 'Request') -> h11.Request:
+    '''
+    Request line & headers. Host header is added if it's missing, and so is the body framing:
+    Content-Length for the bodies we have, chunked encoding for the streamed ones without a Content-Length.
+    '''
+    headers = dict(req.headers)
+    lower_names = {name.lower() for name in headers}
+    if 'host' not in lower_names:
+        headers['Host'] = req.host
+    if 'content-length' not in lower_names and 'transfer-encoding' not in lower_names:
+        if req.stream is not None:
+            headers['Transfer-Encoding'] = 'chunked'
+        elif req.data or req.method.upper() in ('POST', 'PUT', 'PATCH'):
+            headers['Content-Length'] = str(len(req.data))
+    return h11.Request(method=req.method.upper(), target=req.target, headers=list(headers.items()))
+
+
+def encode_request(req: 'Request', conn: 'Optional[h11.Connection]' = None) -> bytes:
+    '''Whole request (that is not streamed) as it is sent on the wire'''
+    if conn is None:
+        conn = h11.Connection(h11.CLIENT)
+    parts = [conn.send(h11_request(req))]
+    if req.data:
+        parts.append(conn.send(h11.Data(data=req.data)))
+    parts.append(conn.send(h11.EndOfMessage()))
+    return b''.join(part for part in parts if part)
+
+
+class AbstractHTTPConnection(ABC):
+    '''
+    Client side of a single HTTP/1.1 connection. After the whole response was received, the connection can be reused
+    for the next request if both sides agreed to keep it alive (`reusable`).
+
+    Inheriting classes implement the transport: `_receive_bytes` and `_write`.
+    '''
+    def __init__(self) -> None:
+        self._conn = h11.Connection(h11.CLIENT)
+
+    @property
+    def reusable(self) -> bool:
+        return self._conn.our_state is h11.DONE and self._conn.their_state is h11.DONE
+
+    async def send_request(self, req: 'Request') -> None:
+        if req.stream is None:
+            await self._send_bytes(encode_request(req, self._conn))
+            return
+
+        await self._send_bytes(self._conn.send(h11_request(req)))
+        async for chunk in req.aiter_body():
+            await self._send_bytes(self._conn.send(h11.Data(data=chunk)))
+        await self._send_bytes(self._conn.send(h11.EndOfMessage()))
+
+    async def receive_response(self) -> Response:
+        '''Status & headers, body should be read with `aiter_body`'''
+        while True:
+            event = await self._next_event()
+            if isinstance(event, h11.Response):
+                headers = {name.decode('latin-1'): val.decode('latin-1') for name, val in event.headers.raw_items()}
+                return Response(event.status_code, b'', headers)
+            if not isinstance(event, h11.InformationalResponse):
+                raise ConnectionError("Connection closed before response headers were received")
+
+    async def aiter_body(self) -> 'AsyncIterator[bytes]':
+        while True:
+            event = await self._next_event()
+            if isinstance(event, h11.Data):
+                yield bytes(event.data)
+            elif isinstance(event, h11.EndOfMessage):
+                return
+            else:
+                raise ConnectionError(f"Unexpected {type(event).__name__} while receiving the response body")
+
+    async def send_many(self, reqs: 'List[Request]', pipelining: bool = False) -> 'List[Response]':
+        '''
+        Send many requests (that are not streamed) one after another and receive whole responses.
+
+        With `pipelining`, first request is sent alone and the rest is sent together, without waiting for the
+        responses (this happens only if the server keeps the connection alive). Not all servers support this
+        - e.g. some would never answer the pipelined requests.
+
+        Returns responses for the prefix of `reqs` that was processed - this might be shorter than `reqs`
+        if the server closed the connection or the connection failed. Only the remaining requests should be sent
+        again. If the connection failed before the first response was received, the error is raised.
+        '''
+        responses: 'List[Response]' = []
+        try:
+            await self.send_request(reqs[0])
+            responses.append(await self._receive_whole_response())
+
+            rest = reqs[1:]
+            if pipelining and rest and self.reusable:
+                await self._send_bytes(b''.join(encode_request(req) for req in rest))
+            for req in rest:
+                if not self.reusable:
+                    break
+                self._conn.start_next_cycle()
+                if pipelining:
+                    #   Request was already sent, here we only move the state of the connection
+                    encode_request(req, self._conn)
+                else:
+                    await self.send_request(req)
+                responses.append(await self._receive_whole_response())
+        except OSError:
+            #   Transport failed (ConnectionError is an OSError too)
+            if not responses:
+                raise
+        return responses
+
+    async def _receive_whole_response(self) -> Response:
+        res = await self.receive_response()
+        res.data = b''.join([chunk async for chunk in self.aiter_body()])
+        return res
+
+    async def _next_event(self) -> 'Any':
+        while True:
+            try:
+                event = self._conn.next_event()
+            except h11.RemoteProtocolError as e:
+                raise ConnectionError(f"Invalid HTTP response: {e}") from e
+            if event is not h11.NEED_DATA:
+                return event
+
+            #   Empty data means the other side closed the connection
+            data = await self._receive_bytes()
+            self._conn.receive_data(data or b'')
+
+    async def _send_bytes(self, data: 'Optional[bytes]') -> None:
+        if data:
+            await self._write(data)
+
+    @abstractmethod
+    async def _receive_bytes(self) -> 'Optional[bytes]':
+        '''Next chunk of data received from the server, None or b'' if the connection was closed'''
+
+    @abstractmethod
+    async def _write(self, data: bytes) -> None:
+        '''Send data to the server'''
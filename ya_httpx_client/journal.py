@@ -0,0 +1,202 @@
+'''
+Durable journal of the requests, so that they are not lost when the requestor restarts:
+
+    journal = RequestJournal('requests.db', on_replayed=handle_response)
+    session = Session(executor_cfg, journal=journal)
+
+Every request sent via `Session.client` (except for the ones with streamed bodies) is written to the journal
+(a SQLite database) before it is submitted to the scheduler, and is removed from there when the caller got
+the response (or an exception). Requests left in the journal by the previous run are sent again by the first
+`Session.client` (at most `replay_concurrency` at the same time), their responses are passed to `on_replayed`.
+A replayed request that could not be sent (transport error, e.g. a timeout, or ClusterOverloaded) stays
+in the journal and is replayed again after the next restart.
+
+This gives at-least-once semantics: a request that was processed by a provider, but whose response was never
+returned (e.g. the requestor crashed in the meantime), will be processed again.
+
+Writes are batched: all requests added within `flush_interval` seconds are committed (and synced to the disk)
+in a single transaction, and they wait for this commit before they are submitted. Removals are not waited for
+- when one is lost, the request is only replayed once more. Requests that are removed before their batch was
+committed never reach the disk. Space of the removed requests is reclaimed every COMPACT_EVERY removals.
+'''
+import asyncio
+import logging
+import sqlite3
+from typing import TYPE_CHECKING
+
+from .serializable_request import Request, unpack_frame
+
+if TYPE_CHECKING:
+    from typing import Any, Callable, Collection, Dict, List, Optional, Set, Tuple
+    import httpx
+
+logger = logging.getLogger(__name__)
+
+#   Replayed requests are sent with this header (id of their journal entry), so that they are not journaled again.
+#   The header is removed before the request is sent to the provider. It is honoured only for the requests sent
+#   by `RequestJournal.replay`, in other requests it is ignored.
+JOURNAL_ID_HEADER = 'X-Yhc-Journal-Id'
+
+
+class RequestJournal:  # pylint: disable=too-many-instance-attributes
+    #   Free pages are released and the WAL file is truncated after that many removed requests
+    COMPACT_EVERY = 1000
+
+    def __init__(
+        self, path: str, on_replayed: 'Optional[Callable[[httpx.Response], Any]]' = None,
+        flush_interval: float = 0.005, replay_concurrency: int = 16,
+    ):
+        self.path = path
+        self.on_replayed = on_replayed
+        self.flush_interval = flush_interval
+        self.replay_concurrency = replay_concurrency
+
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        self._db.execute('PRAGMA journal_mode = WAL')
+        self._db.execute('PRAGMA synchronous = FULL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS requests (id INTEGER PRIMARY KEY, url TEXT, request BLOB)')
+
+        #   Requests left by the previous run: (id, cluster url, request), replayed by `replay`
+        self._recovered: 'List[Tuple[int, str, Request]]' = []
+        for entry_id, url, data in self._db.execute('SELECT id, url, request FROM requests ORDER BY id'):
+            head, body, _ = unpack_frame(data)
+            self._recovered.append((entry_id, url, Request.from_frame(head, body)))
+        self._next_id = self._recovered[-1][0] + 1 if self._recovered else 1
+
+        #   Ids of the entries that are being sent by `replay` now
+        self._replaying: 'Set[int]' = set()
+
+        #   Writes waiting for the next flush, and futures set when they (-> _batch_fut) or the writes being
+        #   flushed now (-> _flush_fut) are committed
+        self._inserts: 'Dict[int, Tuple[str, bytes]]' = {}
+        self._deletes: 'List[int]' = []
+        self._batch_fut: 'Optional[asyncio.Future]' = None
+        self._flush_fut: 'Optional[asyncio.Future]' = None
+        self._flush_handle: 'Optional[asyncio.TimerHandle]' = None
+        self._flush_task: 'Optional[asyncio.Task]' = None
+        self._removed_since_compaction = 0
+
+    def add(self, url: str, req: 'Request') -> int:
+        '''Journal a request for the cluster `url`, returns the id of the entry. Call `sync` to wait for the commit.'''
+        entry_id = self._next_id
+        self._next_id += 1
+        self._inserts[entry_id] = (url, req.as_bytes())
+        if self._batch_fut is None:
+            self._batch_fut = asyncio.get_event_loop().create_future()
+        self._schedule_flush()
+        return entry_id
+
+    def complete(self, entry_id: int) -> None:
+        '''Caller got the response, request will not be replayed'''
+        if self._inserts.pop(entry_id, None) is None:
+            self._deletes.append(entry_id)
+            self._schedule_flush()
+
+    def replayed_entry_id(self, header_value: str) -> 'Optional[int]':
+        '''Id of the entry from the JOURNAL_ID_HEADER, or None if the request was not sent by `replay`'''
+        try:
+            entry_id = int(header_value)
+        except ValueError:
+            entry_id = None
+        if entry_id is None or entry_id not in self._replaying:
+            logger.warning("Ignoring %s header that was not set by the journal: %r", JOURNAL_ID_HEADER, header_value)
+            return None
+        return entry_id
+
+    async def sync(self) -> None:
+        '''Wait until all requests added so far are committed'''
+        futures = [fut for fut in (self._flush_fut, self._batch_fut) if fut is not None]
+        if futures:
+            await asyncio.shield(asyncio.gather(*futures))
+
+    async def replay(self, client: 'httpx.AsyncClient', urls: 'Collection[str]') -> None:
+        '''
+        Send again the requests left by the previous run. Requests for the urls not in `urls` are not sent
+        (they stay in the journal).
+        '''
+        recovered, self._recovered = self._recovered, []
+        if recovered:
+            logger.info("Replaying %s requests from %s", len(recovered), self.path)
+
+        entries = iter([entry for entry in recovered if entry[1] in urls])
+
+        async def replay_entries() -> None:
+            for entry_id, url, req in entries:
+                await self._replay_request(client, entry_id, url, req)
+        await asyncio.gather(*(replay_entries() for _ in range(self.replay_concurrency)))
+
+        for _, url, req in recovered:
+            if url not in urls:
+                logger.warning("Request %s %s was not replayed, there is no service for %s", req.method, req.url, url)
+
+    async def close(self) -> None:
+        '''Commit the remaining writes and close the database'''
+        if self._flush_task is not None:
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._inserts or self._deletes:
+            await self._flush()
+        self._db.close()
+
+    async def _replay_request(self, client: 'httpx.AsyncClient', entry_id: int, url: str, req: 'Request') -> None:
+        headers = {**req.headers, JOURNAL_ID_HEADER: str(entry_id)}
+        self._replaying.add(entry_id)
+        try:
+            res = await client.request(req.method, req.url, content=req.data, headers=headers)
+        except Exception as e:  # pylint: disable=broad-except
+            logger.warning("Replayed request %s %s for %s failed: %s", req.method, req.url, url, e)
+            return
+        finally:
+            self._replaying.discard(entry_id)
+        if self.on_replayed is not None:
+            result = self.on_replayed(res)
+            if asyncio.iscoroutine(result):
+                await result
+
+    def _schedule_flush(self) -> None:
+        if self._flush_handle is None and self._flush_task is None:
+            self._flush_handle = asyncio.get_event_loop().call_later(self.flush_interval, self._start_flush)
+
+    def _start_flush(self) -> None:
+        self._flush_handle = None
+        self._flush_task = asyncio.ensure_future(self._flush())
+
+    async def _flush(self) -> None:
+        inserts, self._inserts = self._inserts, {}
+        deletes, self._deletes = self._deletes, []
+        self._flush_fut, self._batch_fut = self._batch_fut, None
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, self._write, inserts, deletes)
+        except Exception as e:  # pylint: disable=broad-except
+            logger.error("Failed to write the request journal %s: %s", self.path, e)
+            if self._flush_fut is not None:
+                self._flush_fut.set_exception(e)
+                #   Nobody might be waiting, this prevents the "exception was never retrieved" warning
+                self._flush_fut.exception()
+        else:
+            if self._flush_fut is not None:
+                self._flush_fut.set_result(None)
+        finally:
+            self._flush_fut = None
+            self._flush_task = None
+            if self._inserts or self._deletes:
+                self._schedule_flush()
+
+    def _write(self, inserts: 'Dict[int, Tuple[str, bytes]]', deletes: 'List[int]') -> None:
+        '''Executed in a thread, so that the event loop is not blocked by the disk'''
+        with self._db:
+            self._db.executemany(
+                'INSERT INTO requests (id, url, request) VALUES (?, ?, ?)',
+                [(entry_id, url, data) for entry_id, (url, data) in inserts.items()],
+            )
+            self._db.executemany('DELETE FROM requests WHERE id = ?', [(entry_id,) for entry_id in deletes])
+
+        self._removed_since_compaction += len(deletes)
+        if self._removed_since_compaction >= self.COMPACT_EVERY:
+            self._removed_since_compaction = 0
+            #   executescript runs the vacuum to the end (execute would free a single page)
+            self._db.executescript('PRAGMA incremental_vacuum')
+            self._db.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
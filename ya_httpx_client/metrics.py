@@ -0,0 +1,210 @@
+'''
+Requestor-side instrumentation.
+
+All metrics are registered in the module-level `METRICS` registry. They can be:
+
+*   read directly (e.g. `METRICS.get('yhc_queue_wait_seconds').values`)
+*   exported in the Prometheus text format (`METRICS.prometheus_text()`, or `serve_prometheus` that
+    starts a HTTP server with the /metrics endpoint)
+*   observed by sinks - callables added with `METRICS.add_sink`, called on every single observation
+
+If `opentelemetry-api` is installed, every request sent by YagnaTransport is wrapped in a span (-> `span`).
+'''
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+    #   (metric name, metric type, value, labels)
+    Sink = Callable[[str, str, float, Dict[str, str]], None]
+
+#   Default histogram buckets (seconds)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+class Metric(ABC):
+    TYPE = ''
+
+    def __init__(self, registry: 'MetricsRegistry', name: str, description: str, label_names: 'Sequence[str]'):
+        self.registry = registry
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+
+    def _label_values(self, labels: 'Dict[str, Any]') -> 'Tuple[str, ...]':
+        return tuple(str(labels.get(name, '')) for name in self.label_names)
+
+    def _format_labels(self, label_values: 'Tuple[str, ...]', extra: str = '') -> str:
+        parts = [f'{name}="{_escape(val)}"' for name, val in zip(self.label_names, label_values)]
+        if extra:
+            parts.append(extra)
+        return '{' + ','.join(parts) + '}' if parts else ''
+
+    @abstractmethod
+    def prometheus_lines(self) -> 'List[str]':
+        '''Samples of this metric in the Prometheus text format (without the HELP/TYPE lines)'''
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values: 'Dict[Tuple[str, ...], float]' = {}
+
+    def inc(self, amount: float = 1, **labels: 'Any') -> None:
+        key = self._label_values(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+        self.registry.emit(self.name, self.TYPE, amount, labels)
+
+    def prometheus_lines(self) -> 'List[str]':
+        return [f'{self.name}{self._format_labels(key)} {val}' for key, val in self.values.items()]
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, *args, buckets: 'Sequence[float]' = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+
+        #   label values -> [count in each bucket (not cumulative), sum, count]
+        self.values: 'Dict[Tuple[str, ...], Tuple[List[int], List[float]]]' = {}
+
+    def observe(self, value: float, **labels: 'Any') -> None:
+        key = self._label_values(labels)
+        if key not in self.values:
+            self.values[key] = ([0] * len(self.buckets), [0.0, 0.0])
+        bucket_counts, totals = self.values[key]
+        for i, upper_bound in enumerate(self.buckets):
+            if value <= upper_bound:
+                bucket_counts[i] += 1
+                break
+        totals[0] += value
+        totals[1] += 1
+        self.registry.emit(self.name, self.TYPE, value, labels)
+
+    @contextmanager
+    def time(self, **labels: 'Any') -> 'Iterator[None]':
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def prometheus_lines(self) -> 'List[str]':
+        lines = []
+        for key, (bucket_counts, (total, cnt)) in self.values.items():
+            cumulative = 0
+            for upper_bound, bucket_cnt in zip(self.buckets, bucket_counts):
+                cumulative += bucket_cnt
+                le_label = f'le="{upper_bound}"'
+                lines.append(f'{self.name}_bucket{self._format_labels(key, le_label)} {cumulative}')
+            inf_label = 'le="+Inf"'
+            lines.append(f'{self.name}_bucket{self._format_labels(key, inf_label)} {int(cnt)}')
+            lines.append(f'{self.name}_sum{self._format_labels(key)} {total}')
+            lines.append(f'{self.name}_count{self._format_labels(key)} {int(cnt)}')
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self.metrics: 'Dict[str, Metric]' = {}
+        self.sinks: 'List[Sink]' = []
+
+    def counter(self, name: str, description: str, label_names: 'Sequence[str]' = ()) -> Counter:
+        counter = Counter(self, name, description, label_names)
+        self.metrics[name] = counter
+        return counter
+
+    def histogram(
+        self, name: str, description: str, label_names: 'Sequence[str]' = (),
+        buckets: 'Sequence[float]' = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        histogram = Histogram(self, name, description, label_names, buckets=buckets)
+        self.metrics[name] = histogram
+        return histogram
+
+    def get(self, name: str) -> 'Metric':
+        return self.metrics[name]
+
+    def add_sink(self, sink: 'Sink') -> None:
+        self.sinks.append(sink)
+
+    def remove_sink(self, sink: 'Sink') -> None:
+        self.sinks.remove(sink)
+
+    def emit(self, name: str, metric_type: str, value: float, labels: 'Dict[str, Any]') -> None:
+        for sink in self.sinks:
+            sink(name, metric_type, value, {key: str(val) for key, val in labels.items()})
+
+    def prometheus_text(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.description}')
+            lines.append(f'# TYPE {metric.name} {metric.TYPE}')
+            lines += metric.prometheus_lines()
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(val: str) -> str:
+    return val.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+METRICS = MetricsRegistry()
+
+QUEUE_WAIT = METRICS.histogram(
+    'yhc_queue_wait_seconds', 'Time between sending the request and the moment a service took it', ['cluster'],
+)
+SERVICE_TIME = METRICS.histogram(
+    'yhc_service_time_seconds', 'Time between the moment a service took the request and the response',
+    ['cluster', 'provider'],
+)
+REQUESTS = METRICS.counter('yhc_requests_total', 'Finished requests', ['cluster', 'result'])
+HEDGED_REQUESTS = METRICS.counter('yhc_hedged_requests_total', 'Requests sent also to a second provider', ['cluster'])
+HANDSHAKE_TIME = METRICS.histogram(
+    'yhc_ws_handshake_seconds', 'Time of opening a new websocket tunnel to the provider', ['provider'],
+)
+BYTES_SENT = METRICS.counter('yhc_sent_bytes_total', 'Bytes of the requests sent to the provider', ['provider'])
+BYTES_RECEIVED = METRICS.counter(
+    'yhc_received_bytes_total', 'Bytes of the responses received from the provider', ['provider'],
+)
+RETRIES = METRICS.counter('yhc_retries_total', 'Requests that were retried on the same provider', ['provider'])
+RESTARTS = METRICS.counter('yhc_service_restarts_total', 'Services replaced because they failed', ['cluster'])
+STARTUP_TIME = METRICS.histogram(
+    'yhc_provider_startup_seconds', 'Time between creating a service and the moment it was running', ['cluster'],
+)
+
+
+@contextmanager
+def span(name: str, attributes: 'Optional[Dict[str, Any]]' = None) -> 'Iterator[Any]':
+    '''OpenTelemetry span, if opentelemetry is installed (and otherwise nothing)'''
+    try:
+        from opentelemetry import trace  # type: ignore  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        yield None
+        return
+
+    with trace.get_tracer('ya_httpx_client').start_as_current_span(name, attributes=attributes) as current_span:
+        yield current_span
+
+
+async def serve_prometheus(port: int, host: str = '0.0.0.0', registry: MetricsRegistry = METRICS) -> 'Any':
+    '''
+    Start a HTTP server with the /metrics endpoint for Prometheus. Returns an `aiohttp.web.AppRunner`,
+    server is stopped by `await runner.cleanup()`.
+    '''
+    from aiohttp import web  # pylint: disable=import-outside-toplevel
+
+    async def handler(_request: 'web.Request') -> 'web.Response':
+        return web.Response(text=registry.prometheus_text(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
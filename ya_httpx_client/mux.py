@@ -0,0 +1,309 @@
+'''
+Multiplexed protocol used between the requestor and the provider-side sidecar (-> ya_httpx_client.sidecar).
+
+Many concurrent requests share a single tunnel. Every request/response pair is a separate stream: requestor opens
+streams (odd ids), sidecar answers on the same stream. Tunnel carries frames:
+
+*   HEADERS - JSON-encoded head: request (method, url, headers, port of the server) or response (status, headers)
+*   DATA - a part of the body
+*   WINDOW_UPDATE - receiver consumed that many bytes of the stream, sender may send more (flow control)
+*   RESET - stream is cancelled (e.g. nobody waits for the response anymore), or it failed on the provider
+
+HEADERS or DATA frame with the END_STREAM flag is the last frame sent on a stream by a given side. Every side may have
+at most INITIAL_WINDOW not acknowledged bytes (before compression) sent on a single stream, so a slow reader doesn't
+make the other side buffer a whole body.
+
+Bodies might be compressed (-> ya_httpx_client.compression): sender adds the "encoding" key to the head, and
+DATA frames with the COMPRESSED flag are compressed with this algorithm (every frame separately).
+'''
+import asyncio
+import json
+import struct
+from collections import deque
+from typing import TYPE_CHECKING
+
+from .compression import decompress
+
+if TYPE_CHECKING:
+    from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Optional, Union
+    from .compression import Compression
+
+#   Frame header: type, flags, stream id, payload length
+FRAME_HEADER = struct.Struct('!BBII')
+
+HEADERS = 1
+DATA = 2
+WINDOW_UPDATE = 3
+RESET = 4
+
+END_STREAM = 0x1
+COMPRESSED = 0x2
+
+MAX_FRAME_SIZE = 64 * 1024
+INITIAL_WINDOW = 256 * 1024
+
+WINDOW_UPDATE_PAYLOAD = struct.Struct('!I')
+
+
+class StreamReset(ConnectionError):
+    '''Stream was cancelled by the other side, or the whole connection was closed'''
+
+
+class MuxStream:  # pylint: disable=too-many-instance-attributes
+    '''A single request/response exchange within a MuxConnection'''
+    def __init__(self, conn: 'MuxConnection', stream_id: int):
+        self.conn = conn
+        self.stream_id = stream_id
+
+        #   Head received from the other side (-> receive_head)
+        self._head: 'asyncio.Future' = asyncio.get_event_loop().create_future()
+
+        #   Received body chunks, None after the last one (or an exception if the stream was reset)
+        self._incoming: 'Deque[Union[bytes, None, Exception]]' = deque()
+        self._incoming_changed = asyncio.Event()
+
+        #   Flow control: how many bytes we can still send, and how many received bytes were consumed, but not
+        #   acknowledged yet
+        self._send_window = INITIAL_WINDOW
+        self._window_changed = asyncio.Event()
+        self._unacked = 0
+
+        #   Headers of the body we send (only if it should be compressed), and the encoding of the body we receive
+        self._compressed_headers: 'Optional[Dict[str, str]]' = None
+        self._encoding: 'Optional[str]' = None
+        self._sent_end = False
+        self._received_end = False
+        self._reset: 'Optional[StreamReset]' = None
+
+        #   False if the received head had the END_STREAM flag (i.e. there is no body)
+        self.has_body = True
+
+        #   Called when the other side reset the stream (e.g. sidecar cancels the task that processes it)
+        self.on_reset: 'Optional[Callable[[], Any]]' = None
+
+    @property
+    def closed(self) -> bool:
+        return self._reset is not None or (self._sent_end and self._received_end)
+
+    async def send_head(self, head: 'Dict[str, Any]', end_stream: bool = False) -> None:
+        '''Send the request/response head. DATA frames that follow might be compressed (-> Compression).'''
+        compression = self.conn.compression
+        if compression is not None and not end_stream:
+            self._compressed_headers = head.get('headers', {})
+            head = {**head, 'encoding': compression.algorithm}
+        await self._send_frame(HEADERS, END_STREAM if end_stream else 0, json.dumps(head).encode('utf-8'))
+
+    async def send_data(self, data: bytes, end_stream: bool = False) -> None:
+        '''Send a part of the body, waits if the other side didn't consume the previous parts'''
+        view = memoryview(data)
+        while view:
+            while self._send_window <= 0:
+                self._check_reset()
+                self._window_changed.clear()
+                await self._window_changed.wait()
+            size = min(len(view), self._send_window, MAX_FRAME_SIZE)
+            chunk, view = bytes(view[:size]), view[size:]
+            self._send_window -= size
+            await self._send_data_frame(chunk, end_stream and not view)
+        if end_stream and not data:
+            await self._send_frame(DATA, END_STREAM, b'')
+
+    async def send_reset(self, reason: str = '') -> None:
+        '''Cancel the stream (if it's not closed already), `reason` is passed to the other side'''
+        if not self.closed and not self.conn.closed:
+            self._reset = StreamReset(reason or "Stream was cancelled")
+            self.conn.forget(self)
+            await self.conn.send_frame(RESET, 0, self.stream_id, reason.encode('utf-8'))
+
+    async def receive_head(self) -> 'Dict[str, Any]':
+        return await self._head
+
+    async def aiter_data(self) -> 'AsyncIterator[bytes]':
+        '''Received body, chunk by chunk. Raises StreamReset if the stream was reset before the end.'''
+        while True:
+            while not self._incoming:
+                self._incoming_changed.clear()
+                await self._incoming_changed.wait()
+            item = self._incoming.popleft()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            await self._consumed(len(item))
+            yield item
+
+    ###########################
+    #   CALLED BY THE CONNECTION
+    def head_received(self, head: 'Dict[str, Any]', end_stream: bool) -> None:
+        self._encoding = head.pop('encoding', None)
+        if not self._head.done():
+            self._head.set_result(head)
+        if end_stream:
+            self.has_body = False
+            self._end_received()
+
+    def data_received(self, payload: bytes, flags: int) -> None:
+        if flags & COMPRESSED:
+            payload = decompress(self._encoding or '', payload)
+        if payload:
+            self._incoming.append(payload)
+        if flags & END_STREAM:
+            self._end_received()
+        self._incoming_changed.set()
+
+    def window_update_received(self, increment: int) -> None:
+        self._send_window += increment
+        self._window_changed.set()
+
+    def reset_received(self, error: StreamReset) -> None:
+        if self._reset is not None:
+            return
+        self._reset = error
+        if not self._head.done():
+            self._head.set_exception(error)
+            #   Nobody might be waiting for the head, this prevents the "exception was never retrieved" warning
+            self._head.exception()
+        self._incoming.append(error)
+        self._incoming_changed.set()
+        self._window_changed.set()
+        if self.on_reset is not None:
+            self.on_reset()
+
+    ###########################
+    #   INTERNALS
+    async def _send_data_frame(self, chunk: bytes, end_stream: bool) -> None:
+        flags = END_STREAM if end_stream else 0
+        if self._compressed_headers is not None and self.conn.compression is not None:
+            compressed = self.conn.compression.maybe_compress(self._compressed_headers, chunk)
+            if compressed is not None:
+                chunk, flags = compressed, flags | COMPRESSED
+        await self._send_frame(DATA, flags, chunk)
+
+    async def _send_frame(self, frame_type: int, flags: int, payload: bytes) -> None:
+        self._check_reset()
+        await self.conn.send_frame(frame_type, flags, self.stream_id, payload)
+        if flags & END_STREAM:
+            self._sent_end = True
+            if self.closed:
+                self.conn.forget(self)
+
+    async def _consumed(self, size: int) -> None:
+        '''Acknowledge the consumed data, in larger portions (there's no need to send a frame for every chunk)'''
+        self._unacked += size
+        if self._unacked >= INITIAL_WINDOW // 4 and not self._received_end and self._reset is None:
+            increment, self._unacked = self._unacked, 0
+            await self.conn.send_frame(WINDOW_UPDATE, 0, self.stream_id, WINDOW_UPDATE_PAYLOAD.pack(increment))
+
+    def _end_received(self) -> None:
+        self._received_end = True
+        self._incoming.append(None)
+        self._incoming_changed.set()
+        if self.closed:
+            self.conn.forget(self)
+
+    def _check_reset(self) -> None:
+        if self._reset is not None:
+            raise self._reset
+
+
+class MuxConnection:
+    '''
+    One side of the multiplexed connection. Transport is given as two coroutine functions: `receive` returns
+    the next chunk of received bytes (None or b'' when the connection was closed), `send` sends bytes.
+
+    Client (requestor) opens streams with `open_stream`. Server (sidecar) gets new streams in `on_stream` callback,
+    called when the HEADERS frame of a new stream was received.
+    '''
+    def __init__(
+        self,
+        receive: 'Callable[[], Awaitable[Optional[bytes]]]',
+        send: 'Callable[[bytes], Awaitable[None]]',
+        compression: 'Optional[Compression]' = None,
+        on_stream: 'Optional[Callable[[MuxStream], None]]' = None,
+    ):
+        self.receive = receive
+        self.send = send
+        self.compression = compression
+        self.on_stream = on_stream
+
+        self.streams: 'Dict[int, MuxStream]' = {}
+        self._next_stream_id = 1
+        self._send_lock = asyncio.Lock()
+        self._reader_task: 'Optional[asyncio.Task]' = None
+        self.closed = False
+
+    def start(self) -> None:
+        self._reader_task = asyncio.ensure_future(self._read_frames())
+
+    async def wait_closed(self) -> None:
+        if self._reader_task is not None:
+            await asyncio.shield(self._reader_task)
+
+    async def close(self) -> None:
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+        self._close(StreamReset("Connection was closed"))
+
+    def open_stream(self) -> MuxStream:
+        if self.closed:
+            raise StreamReset("Connection was closed")
+        stream = MuxStream(self, self._next_stream_id)
+        self._next_stream_id += 2
+        self.streams[stream.stream_id] = stream
+        return stream
+
+    def forget(self, stream: MuxStream) -> None:
+        '''Stream is closed, frames sent on it are ignored from now on'''
+        self.streams.pop(stream.stream_id, None)
+
+    async def send_frame(self, frame_type: int, flags: int, stream_id: int, payload: bytes) -> None:
+        if self.closed:
+            raise StreamReset("Connection was closed")
+        async with self._send_lock:
+            await self.send(FRAME_HEADER.pack(frame_type, flags, stream_id, len(payload)) + payload)
+
+    async def _read_frames(self) -> None:
+        buf = bytearray()
+        try:
+            while True:
+                data = await self.receive()
+                if not data:
+                    break
+                buf += data
+                offset = 0
+                while len(buf) - offset >= FRAME_HEADER.size:
+                    frame_type, flags, stream_id, length = FRAME_HEADER.unpack_from(buf, offset)
+                    end = offset + FRAME_HEADER.size + length
+                    if len(buf) < end:
+                        break
+                    self._frame_received(frame_type, flags, stream_id, bytes(buf[offset + FRAME_HEADER.size:end]))
+                    offset = end
+                del buf[:offset]
+        finally:
+            self._close(StreamReset("Connection was closed"))
+
+    def _frame_received(self, frame_type: int, flags: int, stream_id: int, payload: bytes) -> None:
+        stream = self.streams.get(stream_id)
+        if stream is None:
+            if frame_type != HEADERS or self.on_stream is None or stream_id % 2 == 0:
+                #   Frame for a stream that was already closed (or reset by us)
+                return
+            stream = MuxStream(self, stream_id)
+            self.streams[stream_id] = stream
+            stream.head_received(json.loads(payload.decode('utf-8')), bool(flags & END_STREAM))
+            self.on_stream(stream)
+        elif frame_type == HEADERS:
+            stream.head_received(json.loads(payload.decode('utf-8')), bool(flags & END_STREAM))
+        elif frame_type == DATA:
+            stream.data_received(payload, flags)
+        elif frame_type == WINDOW_UPDATE:
+            stream.window_update_received(WINDOW_UPDATE_PAYLOAD.unpack(payload)[0])
+        elif frame_type == RESET:
+            self.forget(stream)
+            stream.reset_received(StreamReset(payload.decode('utf-8') or "Stream was reset by the other side"))
+
+    def _close(self, error: StreamReset) -> None:
+        self.closed = True
+        streams, self.streams = self.streams, {}
+        for stream in streams.values():
+            stream.reset_received(error)
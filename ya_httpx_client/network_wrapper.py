@@ -1,25 +1,132 @@
+'''
+VPN networks used by the services.
+
+Yagna network has a limited number of addresses (e.g. 253 providers in a /24 network) and addresses are never
+reused, so every replaced service uses a new one. NetworkWrapper manages a pool of networks: subnets of size
+PREFIX_LENGTH are carved out of ADDRESS_SPACES, a new network is created when all addresses in the existing ones
+are used, and networks that are full and have no services left are removed (their subnets can be used again).
+With PER_CLUSTER = True every cluster has its own networks, otherwise all clusters in a session share them.
+
+    NetworkWrapper.ADDRESS_SPACES = ('10.0.0.0/8',)
+    NetworkWrapper.PREFIX_LENGTH = 22
+'''
 import asyncio
+import ipaddress
+import logging
 
 from typing import TYPE_CHECKING
 if TYPE_CHECKING:
-    from typing import Optional
+    from typing import Dict, Iterator, List
     from yapapi.network import Network
 
+logger = logging.getLogger(__name__)
+
+
+class _PooledNetwork:
+    '''A single network in the pool, together with the number of addresses given to the services'''
+    def __init__(self, network: 'Network', subnet: 'ipaddress.IPv4Network'):
+        self.network = network
+        self.subnet = subnet
+
+        #   Addresses for all hosts, except for the requestor
+        self.capacity = subnet.num_addresses - 3
+
+        #   Services that were given this network (`allocated`), and those of them that didn't stop yet (`live`)
+        self.allocated = 0
+        self.live = 0
+
+    @property
+    def full(self) -> bool:
+        return self.allocated >= self.capacity
+
+    @property
+    def node_cnt(self) -> int:
+        '''Providers still in the network (they are removed by yapapi some time after the service stopped)'''
+        return sum(1 for ip in self.network.nodes_dict if ip != self.network.owner_ip)
+
 
 class NetworkWrapper:
+    #   Networks are subnets of these CIDRs (used in this order)
+    ADDRESS_SPACES = ('192.168.0.0/16',)
+
+    #   Size of a single network
+    PREFIX_LENGTH = 24
+
+    #   If True, every cluster has its own networks
+    PER_CLUSTER = False
+
     def __init__(self, service_manager):
         self.service_manager = service_manager
-        self._network: 'Optional[Network]' = None
+
+        #   Group (cluster name or '' if networks are shared) -> networks, oldest first
+        self._networks: 'Dict[str, List[_PooledNetwork]]' = {}
         self._network_state_lock = asyncio.Lock()
 
-    async def network(self):
+        #   Subnets that were not used yet, and subnets of the removed networks
+        self._new_subnets: 'Iterator[ipaddress.IPv4Network]' = self._subnets()
+        self._free_subnets: 'List[ipaddress.IPv4Network]' = []
+
+    async def network(self, cluster_name: str = '') -> 'Network':
+        '''Network with a free address for a new service of the cluster. Call `release` when the service stopped.'''
+        group = cluster_name if self.PER_CLUSTER else ''
         async with self._network_state_lock:
-            if self._network is None:
-                self._network = await self.service_manager.create_network("192.168.0.1/24")
-        return self._network
+            await self._remove_unused()
+            networks = self._networks.setdefault(group, [])
+            pooled = next((pooled for pooled in networks if not pooled.full), None)
+            if pooled is None:
+                pooled = await self._create(group)
+            pooled.allocated += 1
+            pooled.live += 1
+            return pooled.network
+
+    def release(self, network: 'Network') -> None:
+        '''Service that was given the `network` stopped'''
+        for pooled in self._all_networks():
+            if pooled.network is network:
+                pooled.live -= 1
+                if pooled.full and not pooled.live:
+                    asyncio.get_event_loop().create_task(self._remove_unused_with_lock())
+                return
 
     async def remove_network(self):
+        '''Remove all networks'''
         async with self._network_state_lock:
-            if self._network is not None:
-                await self._network.remove()
-            self._network = None
+            for pooled in self._all_networks():
+                await pooled.network.remove()
+            self._networks = {}
+            self._new_subnets = self._subnets()
+            self._free_subnets = []
+
+    async def _create(self, group: str) -> _PooledNetwork:
+        subnet = self._free_subnets.pop(0) if self._free_subnets else next(self._new_subnets, None)
+        if subnet is None:
+            raise RuntimeError(f"No free subnets left in {self.ADDRESS_SPACES}")
+
+        network = await self.service_manager.create_network(str(subnet))
+        logger.info("Created network %s", subnet)
+        pooled = _PooledNetwork(network, subnet)
+        self._networks[group].append(pooled)
+        return pooled
+
+    async def _remove_unused_with_lock(self) -> None:
+        async with self._network_state_lock:
+            await self._remove_unused()
+
+    async def _remove_unused(self) -> None:
+        '''Remove networks that will never be used again - all their addresses were used and all services stopped'''
+        for networks in self._networks.values():
+            for pooled in [pooled for pooled in networks if pooled.full and not pooled.live and not pooled.node_cnt]:
+                await pooled.network.remove()
+                logger.info("Removed network %s", pooled.subnet)
+                networks.remove(pooled)
+                self._free_subnets.append(pooled.subnet)
+
+    def _all_networks(self) -> 'List[_PooledNetwork]':
+        return [pooled for networks in self._networks.values() for pooled in networks]
+
+    def _subnets(self) -> 'Iterator[ipaddress.IPv4Network]':
+        if self.PREFIX_LENGTH > 29:
+            raise ValueError(f"Network prefix length {self.PREFIX_LENGTH} leaves no addresses for the providers")
+        for address_space in self.ADDRESS_SPACES:
+            network = ipaddress.IPv4Network(address_space)
+            yield from network.subnets(new_prefix=max(self.PREFIX_LENGTH, network.prefixlen))
@@ -0,0 +1,146 @@
+'''
+Provider performance history: when a service stops, what we know about its provider (latency, throughput,
+failure rate) is saved in a PerformanceStore (a JSON file, so it survives restarts). PerformanceStrategy uses
+this to prefer offers from the providers known to be fast:
+
+    session = Session(executor_cfg, performance=PerformanceStore('provider_performance.json'))
+'''
+import json
+import math
+import os
+import time
+from typing import TYPE_CHECKING
+
+from yapapi.strategy import SCORE_NEUTRAL, SCORE_TRUSTED, WrappingMarketStrategy
+
+if TYPE_CHECKING:
+    from typing import Dict, List, Optional
+    from yapapi import rest
+    from yapapi.strategy import BaseMarketStrategy
+    from .scheduler import ProviderStats
+
+
+class PerformanceStore:
+    '''
+    cluster name -> provider id -> {"requests", "latency", "throughput", "failure_rate", "updated_at"}
+
+    Clusters run different applications, so a provider is compared only with the other providers
+    of the same cluster. Latency, throughput and failure rate are moving averages over the services that run on
+    a given provider in a given cluster, the most recent one has the weight of EWMA_ALPHA. Throughput is the number
+    of requests processed per second when the service was busy (i.e. it doesn't depend on how many requests we sent).
+    '''
+    EWMA_ALPHA = 0.5
+
+    def __init__(self, path: 'Optional[str]' = None, min_requests: int = 10):
+        self.path = path
+
+        #   Services that processed less than this are ignored (we don't know enough about them)
+        self.min_requests = min_requests
+
+        self.clusters: 'Dict[str, Dict[str, Dict[str, float]]]' = {}
+        if path is not None and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            #   Files from older versions (keyed by the provider id only) are ignored
+            self.clusters = {
+                cluster: providers for cluster, providers in data.items()
+                if all(isinstance(provider_data, dict) for provider_data in providers.values())
+            }
+
+    def record(self, cluster: str, provider_id: str, stats: 'ProviderStats') -> None:
+        if stats.completed < self.min_requests or stats.ewma_latency is None:
+            return
+
+        new_data = {
+            'latency': stats.ewma_latency,
+            'throughput': stats.completed / max(stats.busy_time, 1e-3),
+            'failure_rate': stats.error_rate,
+        }
+        providers = self.clusters.setdefault(cluster, {})
+        data = providers.get(provider_id)
+        if data is None:
+            data = {**new_data, 'requests': 0}
+        else:
+            for key, val in new_data.items():
+                data[key] = self.EWMA_ALPHA * val + (1 - self.EWMA_ALPHA) * data[key]
+        data['requests'] += stats.completed
+        data['updated_at'] = time.time()
+        providers[provider_id] = data
+        self._save()
+
+    def get(self, cluster: str, provider_id: str) -> 'Optional[Dict[str, float]]':
+        return self.clusters.get(cluster, {}).get(provider_id)
+
+    def clusters_of(self, provider_id: str) -> 'List[str]':
+        '''Clusters where the provider was used'''
+        return [cluster for cluster, providers in self.clusters.items() if provider_id in providers]
+
+    def median(self, cluster: str, key: str) -> 'Optional[float]':
+        values = sorted(data[key] for data in self.clusters.get(cluster, {}).values())
+        if not values:
+            return None
+        return values[len(values) // 2]
+
+    def _save(self) -> None:
+        if self.path is None:
+            return
+        tmp_path = self.path + '.part'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.clusters, f)
+        os.replace(tmp_path, self.path)
+
+
+class PerformanceStrategy(WrappingMarketStrategy):
+    '''
+    Score from the base strategy (usually price-based) is multiplied by a performance factor of the provider:
+
+        (median_latency / latency) ** latency_weight
+        * (throughput / median_throughput) ** throughput_weight
+        * (1 - failure_rate) ** failure_weight
+
+    where medians are calculated over all known providers of the same cluster. Offers are not bound to a cluster,
+    so if the provider was used in many clusters, the factor is the geometric mean of the factors in all of them.
+    Factor is limited to [1 / max_factor, max_factor]. Providers we know nothing about have the factor of 1,
+    so they are still tried.
+    '''
+    def __init__(
+        self,
+        base_strategy: 'BaseMarketStrategy',
+        store: PerformanceStore,
+        latency_weight: float = 1,
+        throughput_weight: float = 0.5,
+        failure_weight: float = 2,
+        max_factor: float = 10,
+    ):
+        # pylint: disable=too-many-arguments
+        super().__init__(base_strategy)
+        self.store = store
+        self.latency_weight = latency_weight
+        self.throughput_weight = throughput_weight
+        self.failure_weight = failure_weight
+        self.max_factor = max_factor
+
+    async def score_offer(self, offer: 'rest.market.OfferProposal') -> float:
+        score = await super().score_offer(offer)
+        if score < SCORE_NEUTRAL:
+            return score
+        return min(score * self.performance_factor(offer.issuer), SCORE_TRUSTED)
+
+    def performance_factor(self, provider_id: str) -> float:
+        factors = [self._cluster_factor(cluster, provider_id) for cluster in self.store.clusters_of(provider_id)]
+        if not factors:
+            return 1
+        factor = math.exp(sum(math.log(factor) for factor in factors) / len(factors))
+        return max(1 / self.max_factor, min(factor, self.max_factor))
+
+    def _cluster_factor(self, cluster: str, provider_id: str) -> float:
+        data = self.store.get(cluster, provider_id)
+        median_latency = self.store.median(cluster, 'latency')
+        median_throughput = self.store.median(cluster, 'throughput')
+        if data is None or not median_latency or not median_throughput:
+            return 1
+
+        factor = (median_latency / max(data['latency'], 1e-6)) ** self.latency_weight
+        factor *= (data['throughput'] / median_throughput) ** self.throughput_weight
+        factor *= (1 - min(data['failure_rate'], 0.99)) ** self.failure_weight
+        return factor
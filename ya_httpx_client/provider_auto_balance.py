@@ -1,6 +1,9 @@
+from math import ceil
+from time import monotonic
 from typing import TYPE_CHECKING
 from datetime import datetime
 if TYPE_CHECKING:
+    from typing import Optional
     from ya_httpx_client.cluster import Cluster
 
 
@@ -28,13 +31,13 @@ class SimpleLoadBalancer:
         now = datetime.now()
         if self.cnt is None or (now - self.prev_queue_check_at).seconds > 10:
             self.cnt = self._calculate_new_cnt()
-            self.prev_queue_size = self.cluster.request_queue.qsize()
+            self.prev_queue_size = self.cluster.scheduler.qsize()
             self.prev_queue_check_at = now
         return self.cnt
 
     def _calculate_new_cnt(self) -> int:
         current_cnt = self.cnt
-        current_queue_size = self.cluster.request_queue.qsize()
+        current_queue_size = self.cluster.scheduler.qsize()
 
         if current_cnt is None:  # pylint: disable=no-else-return
             #   Initial value
@@ -47,3 +50,134 @@ class SimpleLoadBalancer:
             return min(self.cnt + 1, self.MAX_PROVIDER_CNT)
         else:
             return self.cnt
+
+
+class Autoscaler:
+    '''
+    Calculates the number of providers needed to keep the time requests spend in the queue below `target_queue_wait`
+    seconds (or the total request latency below `target_latency`, if set).
+
+    The calculation uses:
+        *   arrival rate of requests (smoothed with an EWMA),
+        *   average service time (-> Scheduler.avg_latency) and cluster.provider_concurrency,
+        *   number of requests in the queue and in progress,
+        *   average provider startup time - requests that will arrive before a new provider is ready
+            are also taken into account.
+
+    To avoid flapping:
+        *   we scale up immediately, but at most once every `scale_up_cooldown` seconds,
+        *   we scale down only if the calculated value is lower than current size by at least
+            `scale_down_threshold` (as a fraction of the current size), and not earlier than
+            `scale_down_cooldown` seconds after the last change.
+
+    Usage:
+        session.set_cluster_size(url, lambda cluster: Autoscaler(cluster, max_size=10))
+    '''
+    # pylint: disable=too-many-instance-attributes
+
+    #   Recalculate at most once every UPDATE_INTERVAL seconds
+    UPDATE_INTERVAL = 5
+
+    #   Weight of the most recent sample in the arrival rate EWMA
+    ARRIVAL_RATE_ALPHA = 0.5
+
+    #   Used before anything was measured
+    DEFAULT_STARTUP_TIME = 60
+
+    def __init__(
+        self,
+        cluster: 'Cluster',
+        min_size: int = 1,
+        max_size: int = 10,
+        init_size: 'Optional[int]' = None,
+        target_queue_wait: float = 1,
+        target_latency: 'Optional[float]' = None,
+        target_utilization: float = 0.8,
+        scale_up_cooldown: float = 10,
+        scale_down_cooldown: float = 120,
+        scale_down_threshold: float = 0.25,
+    ):
+        # pylint: disable=too-many-arguments
+        if not 0 < target_utilization <= 1:
+            raise ValueError(f"target_utilization should be in (0, 1], got {target_utilization}")
+        if min_size > max_size:
+            raise ValueError(f"min_size ({min_size}) is greater than max_size ({max_size})")
+
+        self.cluster = cluster
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_queue_wait = target_queue_wait
+        self.target_latency = target_latency
+        self.target_utilization = target_utilization
+        self.scale_up_cooldown = scale_up_cooldown
+        self.scale_down_cooldown = scale_down_cooldown
+        self.scale_down_threshold = scale_down_threshold
+
+        self.cnt = self._bounded(init_size if init_size is not None else min_size)
+        self.arrival_rate: 'Optional[float]' = None
+
+        self._last_update_at = monotonic()
+        self._last_change_at = self._last_update_at
+        self._last_submitted_cnt = cluster.scheduler.submitted_cnt
+
+    def __int__(self) -> int:
+        now = monotonic()
+        if now - self._last_update_at >= self.UPDATE_INTERVAL:
+            self._update_arrival_rate(now)
+            self._rescale(now, self.required_cnt())
+        return self.cnt
+
+    def required_cnt(self) -> 'Optional[int]':
+        '''Number of providers needed to meet the target (not bounded by min/max), None if we don't know yet'''
+        scheduler = self.cluster.scheduler
+        service_time = scheduler.avg_latency
+        if service_time is None or self.arrival_rate is None:
+            return None
+
+        queue_wait = self.target_queue_wait
+        if self.target_latency is not None:
+            queue_wait = max(self.target_latency - service_time, 0.001)
+
+        #   Requests/second processed by a single provider
+        provider_throughput = self.cluster.provider_concurrency / service_time
+
+        #   Providers needed for the current traffic
+        steady_cnt = self.arrival_rate / (provider_throughput * self.target_utilization)
+
+        #   Providers needed to process the backlog within the target queue wait. Backlog includes requests that
+        #   will arrive (and not be processed by current providers) before a new provider starts.
+        startup_time = self.cluster.avg_startup_time or self.DEFAULT_STARTUP_TIME
+        current_throughput = self.cluster.cnt * provider_throughput
+        backlog = float(scheduler.qsize() + scheduler.outstanding_cnt)
+        backlog += max(self.arrival_rate - current_throughput, 0) * startup_time
+        backlog_cnt = backlog / (provider_throughput * (queue_wait + startup_time))
+
+        return ceil(steady_cnt + backlog_cnt)
+
+    def _update_arrival_rate(self, now: float) -> None:
+        submitted_cnt = self.cluster.scheduler.submitted_cnt
+        rate = (submitted_cnt - self._last_submitted_cnt) / (now - self._last_update_at)
+        if self.arrival_rate is None:
+            self.arrival_rate = rate
+        else:
+            self.arrival_rate = self.ARRIVAL_RATE_ALPHA * rate + (1 - self.ARRIVAL_RATE_ALPHA) * self.arrival_rate
+        self._last_submitted_cnt = submitted_cnt
+        self._last_update_at = now
+
+    def _rescale(self, now: float, required_cnt: 'Optional[int]') -> None:
+        if required_cnt is None:
+            return
+        new_cnt = self._bounded(required_cnt)
+        since_last_change = now - self._last_change_at
+
+        if new_cnt > self.cnt and since_last_change >= self.scale_up_cooldown:
+            self.cnt, self._last_change_at = new_cnt, now
+        elif (
+            new_cnt < self.cnt
+            and since_last_change >= self.scale_down_cooldown
+            and self.cnt - new_cnt >= self.scale_down_threshold * self.cnt
+        ):
+            self.cnt, self._last_change_at = new_cnt, now
+
+    def _bounded(self, cnt: int) -> int:
+        return max(self.min_size, min(cnt, self.max_size))
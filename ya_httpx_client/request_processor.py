@@ -0,0 +1,91 @@
+'''
+Provider-side code that sends deserialized requests to the HTTP server listening on the unix socket.
+Used both by the one-shot `python -m ya_httpx_client` and the long-running `python -m ya_httpx_client.worker`.
+'''
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
+
+import requests_unixsocket  # type: ignore
+
+from ya_httpx_client.serializable_request import PROVIDER_ERROR_HEADER, Response
+
+if TYPE_CHECKING:
+    from typing import List
+    from ya_httpx_client.serializable_request import Request
+
+logger = logging.getLogger(__name__)
+
+
+class RequestProcessor:
+    '''
+    Keeps a single `requests_unixsocket.Session`, so connections to the server are reused
+    by all requests processed by this object.
+    '''
+    def __init__(self, url: str, concurrency: int = 1):
+        self.url = adjust_url(url)
+        self.concurrency = concurrency
+        self.session = requests_unixsocket.Session()
+
+    def process(self, reqs: 'List[Request]') -> 'List[Response]':
+        '''Send requests (up to self.concurrency at the same time), return responses in the same order'''
+        if self.concurrency > 1 and len(reqs) > 1:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                return list(executor.map(self.send, reqs))
+        return [self.send(req) for req in reqs]
+
+    def send(self, req: 'Request') -> Response:
+        '''
+        Response from the server. If the request failed (e.g. the server closed the connection), this is a 502
+        response - a single failed request doesn't fail the whole batch.
+        '''
+        try:
+            req.replace_mount_url(self.url)
+            requests_req = req.as_requests_request()
+            requests_res = self.session.send(requests_req.prepare())
+            return Response.from_requests_response(requests_res)
+        except Exception as e:  # pylint: disable=broad-except
+            logger.warning("Request %s %s failed: %s", req.method, req.url, e)
+            return provider_error_response(f"Request failed on the provider: {e}")
+
+
+def provider_error_response(message: str) -> Response:
+    return Response(502, message.encode('utf-8'), {'Content-Type': 'text/plain', PROVIDER_ERROR_HEADER: '1'})
+
+
+def replace_unserializable(res: 'Response', error: Exception) -> Response:
+    '''
+    `on_error` for `to_batch_file`: a response that can't be saved (e.g. a non-utf-8 body in the JSON format)
+    is replaced with a 502 response, so that it doesn't fail the whole batch
+    '''
+    logger.warning("Response %s could not be serialized: %s", res.status, error)
+    return provider_error_response(f"Response could not be serialized on the provider: {error}")
+
+
+def adjust_url(url: str) -> str:
+    '''
+    Only current usecase:
+        unix:///tmp/golem.sock/  --> http+unix://%2Ftmp%2Fgolem.sock
+
+    NOTE: urllib.parse is not used, because it doesn't work well with urls with empty host,
+          e.g. with the one above
+    '''
+    if '://' not in url:
+        raise ValueError(f"Missing schema in url {url}")
+
+    schema, no_schema_url = url.split('://', 1)
+    if schema == 'unix':
+        #   This is required by requests_unixsocket
+        schema = 'http+unix'
+
+    if no_schema_url.endswith('/'):
+        no_schema_url = no_schema_url[:-1]
+
+    if no_schema_url.startswith('/'):
+        #   If this is a no-host url, and we don't url-encode all '/',
+        #   requests assume the path is the host.
+        #   Also we can't use ullib.parse.quote, because some part might
+        #   already be url-encoded.
+        no_schema_url = no_schema_url.replace('/', '%2F')
+
+    return '://'.join([schema, no_schema_url])
@@ -0,0 +1,575 @@
+import asyncio
+import bisect
+import hashlib
+import math
+import time
+from collections import deque
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from typing import Any, Callable, Container, Deque, Dict, List, Optional, Set, Tuple
+    from .serializable_request import Request
+
+    Item = Tuple[Request, asyncio.Future]
+    RoutingKey = Callable[[Request], Optional[str]]
+
+
+#   Requests with this header are scheduled with a given priority (default is 0, higher is more important).
+#   The header is removed before the request is sent to the provider.
+PRIORITY_HEADER = 'X-Yhc-Priority'
+
+
+class ProviderStats:
+    '''What the scheduler knows about a single service'''
+
+    #   Weight of the most recent sample in the exponentially weighted moving average of the latency
+    EWMA_ALPHA = 0.3
+
+    def __init__(self) -> None:
+        self.outstanding = 0
+        self.completed = 0
+        self.ewma_latency: 'Optional[float]' = None
+
+        #   EWMA of the failures of the provider (tunnel errors, timeouts, 502/503/504 created by ya_httpx_client
+        #   on the provider side), i.e. a number between 0 (no failures) and 1 (all failed)
+        self.error_rate = 0.0
+
+        #   EWMA of the 5xx responses of the application. They might be caused by the requests, not by the provider,
+        #   so they matter only compared to the other providers (-> HealthPolicy).
+        self.app_error_rate = 0.0
+
+        #   Websocket handshake failures since the last successful request
+        self.handshake_failures = 0
+
+        #   Total time when the service was processing at least one request (-> throughput)
+        self._busy_time = 0.0
+        self._busy_since: 'Optional[float]' = None
+
+    @property
+    def busy_time(self) -> float:
+        if self._busy_since is None:
+            return self._busy_time
+        return self._busy_time + time.monotonic() - self._busy_since
+
+    def task_started(self) -> None:
+        if self.outstanding == 0:
+            self._busy_since = time.monotonic()
+        self.outstanding += 1
+
+    def task_finished(self) -> None:
+        self.outstanding -= 1
+        if self.outstanding == 0 and self._busy_since is not None:
+            self._busy_time += time.monotonic() - self._busy_since
+            self._busy_since = None
+
+    def add_latency(self, latency: float) -> None:
+        if self.ewma_latency is None:
+            self.ewma_latency = latency
+        else:
+            self.ewma_latency = self.EWMA_ALPHA * latency + (1 - self.EWMA_ALPHA) * self.ewma_latency
+
+    def add_result(self, failed: bool, app_error: bool = False) -> None:
+        self.error_rate = self.EWMA_ALPHA * float(failed) + (1 - self.EWMA_ALPHA) * self.error_rate
+        self.app_error_rate = self.EWMA_ALPHA * float(app_error) + (1 - self.EWMA_ALPHA) * self.app_error_rate
+        if not failed:
+            self.handshake_failures = 0
+
+
+class Scheduler:  # pylint: disable=too-many-public-methods
+    '''
+    Decides which service processes which request. Replaces a plain asyncio.Queue shared by all services:
+    YagnaTransport calls `submit`, services call `get` and later `task_done`.
+
+    Requests are processed in priority lanes (higher priority first, FIFO within a lane). Requests from failed
+    services are put back with `requeue`, at the front of their lane. When more than one service is waiting for
+    a request, the `select` method decides which one gets it - this is what differs between scheduling policies.
+    This class always picks the service that waits longest.
+
+    NOTE: `select` is used only when a request arrives and there are idle services. When requests are queued, services
+    take them in the order they become free (`get_nowait`), so the policy doesn't matter then - faster services
+    just take more requests.
+    '''
+
+    def __init__(self) -> None:
+        #   priority -> requests waiting for a service
+        self._lanes: 'Dict[int, Deque[Item]]' = {}
+
+        #   (service, future that will receive the request) for all services waiting in `get`, oldest first
+        self._waiters: 'List[Tuple[Any, asyncio.Future]]' = []
+
+        self.stats: 'Dict[Any, ProviderStats]' = {}
+
+        #   request future -> (service, start time)
+        self._started: 'Dict[asyncio.Future, Tuple[Any, float]]' = {}
+
+        #   Total number of submitted requests (-> arrival rate)
+        self.submitted_cnt = 0
+
+        #   Latencies of the recently processed requests (all services)
+        self.latencies: 'Deque[float]' = deque(maxlen=1000)
+
+        #   request future -> services that should not process this request
+        self._excluded: 'Dict[asyncio.Future, Container[Any]]' = {}
+
+        #   request future -> future that is resolved when some service takes the request
+        self._start_waiters: 'Dict[asyncio.Future, asyncio.Future]' = {}
+
+        #   requests whose caller didn't get the response in time (-> report_timeout)
+        self._timed_out: 'Set[asyncio.Future]' = set()
+
+        #   first request of a batch -> other requests of the batch (-> submit_batch)
+        self._batches: 'Dict[asyncio.Future, List[Item]]' = {}
+
+        #   service -> requests that will be processed by this service, before anything else
+        self._reserved: 'Dict[Any, Deque[Item]]' = {}
+
+        #   Requests waiting in the lanes, batches and reservations, so that `qsize` doesn't have to count them.
+        #   Requests cancelled by the caller (e.g. after a timeout) are removed when they are done, although they stay
+        #   in the lanes until someone pops them.
+        self._queued: 'Set[asyncio.Future]' = set()
+
+    ###########################
+    #   REQUESTOR-SIDE INTERFACE
+    def submit(self, req: 'Request', fut: asyncio.Future, exclude: 'Container[Any]' = ()) -> None:
+        '''Schedule a request. It will not be processed by any service in `exclude`.'''
+        self.submitted_cnt += 1
+        if exclude:
+            self._excluded[fut] = exclude
+            fut.add_done_callback(self._forget_excluded)
+        self._put((req, fut), front=False)
+
+    def submit_batch(self, items: 'List[Item]') -> None:
+        '''
+        Schedule requests that should be processed together: the service that takes the first request
+        will process all of them (e.g. FileSerializationService sends them in a single batch file).
+        '''
+        self.submitted_cnt += len(items)
+        self._put_batch(items)
+
+    async def wait_started(self, fut: asyncio.Future) -> None:
+        '''Wait until a service takes the request (or the request future is done)'''
+        if fut in self._started or fut.done():
+            return
+        waiter = asyncio.get_event_loop().create_future()
+        self._start_waiters[fut] = waiter
+        try:
+            await waiter
+        finally:
+            self._start_waiters.pop(fut, None)
+
+    def service_of(self, fut: asyncio.Future) -> 'Any':
+        '''Service processing the request right now (or None)'''
+        service, _ = self._started.get(fut, (None, None))
+        return service
+
+    def report_timeout(self, fut: asyncio.Future) -> None:
+        '''Caller didn't get the response in time, this counts as a failure of the service processing the request'''
+        if fut in self._started:
+            self._timed_out.add(fut)
+
+    def latency_percentile(self, percentile: float) -> 'Optional[float]':
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        index = min(int(len(latencies) * percentile / 100), len(latencies) - 1)
+        return latencies[index]
+
+    def qsize(self) -> int:
+        return len(self._queued)
+
+    def reserved_cnt(self, service: 'Any') -> int:
+        '''Number of requests reserved for the service (-> take_reserved)'''
+        return sum(1 for _, fut in self._reserved.get(service, ()) if not fut.done())
+
+    @property
+    def outstanding_cnt(self) -> int:
+        '''Number of requests currently processed by services'''
+        return len(self._started)
+
+    @property
+    def avg_latency(self) -> 'Optional[float]':
+        '''Average of the EWMA latencies of all services (None if nothing was processed yet)'''
+        latencies = [stats.ewma_latency for stats in self.stats.values() if stats.ewma_latency is not None]
+        if not latencies:
+            return None
+        return sum(latencies) / len(latencies)
+
+    def empty(self) -> bool:
+        return not self._queued
+
+    ###########################
+    #   SERVICE-SIDE INTERFACE
+    async def get(self, service: 'Any') -> 'Item':
+        try:
+            return self.get_nowait(service)
+        except asyncio.QueueEmpty:
+            pass
+
+        waiter = asyncio.get_event_loop().create_future()
+        self._waiters.append((service, waiter))
+        try:
+            return await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                #   We got a request at the same moment we were cancelled - someone else has to process it
+                self.requeue(waiter.result())
+            raise
+        finally:
+            self._remove_waiter(waiter)
+
+    def get_nowait(self, service: 'Any') -> 'Item':
+        reserved = self._reserved.get(service)
+        while reserved:
+            req, fut = reserved.popleft()
+            if not fut.done():
+                self.task_started(service, fut)
+                return req, fut
+
+        for priority in sorted(self._lanes, reverse=True):
+            lane = self._lanes[priority]
+            skipped: 'List[Item]' = []
+            try:
+                while lane:
+                    req, fut = lane.popleft()
+                    if fut.done():
+                        self._release_batch(fut)
+                        continue
+                    if not self._can_take(service, fut):
+                        skipped.append((req, fut))
+                        continue
+                    self.task_started(service, fut)
+                    return req, fut
+            finally:
+                lane.extendleft(reversed(skipped))
+        raise asyncio.QueueEmpty()
+
+    def take_reserved(self, service: 'Any', limit: 'Optional[int]' = None) -> 'List[Item]':
+        '''
+        Requests reserved for the service (i.e. rest of the batch it took), marked as started. If `limit` is set,
+        at most that many are taken, the others can be processed by any service (-> release_reserved).
+        '''
+        items: 'List[Item]' = []
+        reserved = self._reserved.pop(service, deque())
+        while reserved and (limit is None or len(items) < limit):
+            req, fut = reserved.popleft()
+            if not fut.done():
+                self.task_started(service, fut)
+                items.append((req, fut))
+        if reserved:
+            self._reserved[service] = reserved
+            self.release_reserved(service)
+        return items
+
+    def release_reserved(self, service: 'Any') -> None:
+        '''Requests reserved for the service are scheduled again, ahead of the other requests with their priority'''
+        for item in reversed(self._reserved.pop(service, deque())):
+            self._put(item, front=True)
+
+    def requeue(self, item: 'Item') -> None:
+        '''Put back a request from a failed service. It will be the next one processed (within its priority).'''
+        _, fut = item
+        self._finish(fut)
+        self._put(item, front=True)
+
+    def task_started(self, service: 'Any', fut: asyncio.Future) -> None:
+        self._queued.discard(fut)
+        self._stats(service).task_started()
+        self._started[fut] = (service, asyncio.get_event_loop().time())
+
+        batch_rest = self._batches.pop(fut, None)
+        if batch_rest:
+            self._reserved.setdefault(service, deque()).extend(batch_rest)
+
+        start_waiter = self._start_waiters.pop(fut, None)
+        if start_waiter is not None and not start_waiter.done():
+            start_waiter.set_result(None)
+
+    def task_done(self, fut: asyncio.Future, failed: bool = False, app_error: bool = False) -> None:
+        '''
+        Request was processed - latency and result are recorded. `failed` means a failure of the provider,
+        `app_error` a 5xx response of the application.
+        '''
+        service, started_at = self._started.get(fut, (None, None))
+        failed = failed or fut in self._timed_out
+        self._finish(fut)
+        if service is not None and started_at is not None:
+            stats = self._stats(service)
+            latency = asyncio.get_event_loop().time() - started_at
+            stats.completed += 1
+            stats.add_latency(latency)
+            stats.add_result(failed, app_error and not failed)
+            self.latencies.append(latency)
+
+    def set_service_active(self, service: 'Any', active: bool) -> None:
+        '''
+        Service was activated or deactivated (-> spares). Inactive services don't get new requests in `_put`,
+        so a reactivated service that waits in `get` takes a request from the lanes now - otherwise it would wait
+        for the next submitted request, although requests might be waiting already. Requests reserved for
+        a deactivated service are processed by other services.
+        '''
+        if not active:
+            self.release_reserved(service)
+            return
+        for waiter_service, waiter in self._waiters:
+            if waiter_service is service and not waiter.done():
+                try:
+                    item = self.get_nowait(service)
+                except asyncio.QueueEmpty:
+                    return
+                waiter.set_result(item)
+
+    def report_handshake_failure(self, service: 'Any') -> None:
+        self._stats(service).handshake_failures += 1
+
+    def remove_service(self, service: 'Any') -> None:
+        '''Forget about a service that stopped. Requests reserved for it will be processed by other services.'''
+        self.stats.pop(service, None)
+        self.release_reserved(service)
+
+    ###########################
+    #   POLICY
+    def select(self, candidates: 'List[Any]') -> 'Any':
+        '''Choose one of the waiting services (ordered from the one waiting longest) for the next request'''
+        return candidates[0]
+
+    ###########################
+    #   INTERNALS
+    def _put(self, item: 'Item', front: bool) -> None:
+        _, fut = item
+        if fut.done():
+            self._release_batch(fut)
+            return
+
+        #   Services that were deactivated (-> spares) while waiting don't get new requests
+        candidates = [
+            service for service, waiter in self._waiters
+            if not waiter.done() and getattr(service, 'active', True) and not self._is_excluded(service, fut)
+        ]
+        if candidates:
+            service = self.select(candidates)
+            waiter = next(waiter for waiter_service, waiter in self._waiters
+                          if waiter_service is service and not waiter.done())
+            self.task_started(service, fut)
+            waiter.set_result(item)
+            return
+
+        self._append_to_lane(item, front)
+
+    def _append_to_lane(self, item: 'Item', front: bool) -> None:
+        req, fut = item
+        self._add_queued(fut)
+        lane = self._lanes.setdefault(req.priority, deque())
+        if front:
+            lane.appendleft(item)
+        else:
+            lane.append(item)
+
+    def _put_batch(self, items: 'List[Item]') -> None:
+        items = [item for item in items if not item[1].done()]
+        if not items:
+            return
+        first, *rest = items
+        if rest:
+            self._batches[first[1]] = rest
+            for _, fut in rest:
+                self._add_queued(fut)
+        self._put(first, front=False)
+
+    def _release_batch(self, fut: asyncio.Future) -> None:
+        '''First request of a batch was cancelled before any service took it - schedule the rest without it'''
+        rest = self._batches.pop(fut, None)
+        if rest:
+            self._put_batch(rest)
+
+    def _add_queued(self, fut: asyncio.Future) -> None:
+        if fut not in self._queued:
+            self._queued.add(fut)
+            fut.add_done_callback(self._queued.discard)
+
+    def _finish(self, fut: asyncio.Future) -> None:
+        self._timed_out.discard(fut)
+        service, _ = self._started.pop(fut, (None, None))
+        if service is not None and service in self.stats:
+            self.stats[service].task_finished()
+
+    def _can_take(self, service: 'Any', fut: asyncio.Future) -> bool:
+        '''True if the service can process the request waiting in a lane'''
+        return not self._is_excluded(service, fut)
+
+    def _is_excluded(self, service: 'Any', fut: asyncio.Future) -> bool:
+        return service in self._excluded.get(fut, ())
+
+    def _forget_excluded(self, fut: asyncio.Future) -> None:
+        self._excluded.pop(fut, None)
+
+    def _remove_waiter(self, waiter: asyncio.Future) -> None:
+        self._waiters = [(service, w) for service, w in self._waiters if w is not waiter]
+
+    def _stats(self, service: 'Any') -> ProviderStats:
+        if service not in self.stats:
+            self.stats[service] = ProviderStats()
+        return self.stats[service]
+
+
+class LeastOutstandingScheduler(Scheduler):
+    '''
+    Next request goes to the waiting service that has the smallest number of requests in progress.
+    Makes a difference only if there are idle services (-> Scheduler).
+    '''
+    def select(self, candidates: 'List[Any]') -> 'Any':
+        return min(candidates, key=lambda service: self._stats(service).outstanding)
+
+
+class LatencyWeightedScheduler(Scheduler):
+    '''
+    Next request goes to the waiting service with the lowest (EWMA) latency.
+    Services that didn't process anything yet are preferred, so that we learn their latency.
+    Makes a difference only if there are idle services (-> Scheduler).
+    '''
+    def select(self, candidates: 'List[Any]') -> 'Any':
+        def ewma_latency(service: 'Any') -> float:
+            latency = self._stats(service).ewma_latency
+            return -1 if latency is None else latency
+        return min(candidates, key=ewma_latency)
+
+
+class ConsistentHashScheduler(Scheduler):
+    '''
+    Requests with the same routing key go to the same service, so that caches inside the provider-side server
+    stay warm. `key` extracts the key from the request (-> path_prefix_key, header_key), requests without a key
+    (None) are scheduled the same way as by the base Scheduler.
+
+    Keys are mapped to services with a consistent-hash ring (`replicas` points per service), so when a service
+    joins or leaves, only the keys of this service are remapped. Load is bounded: a service can't have more than
+    `load_factor` times the average number of requests (processed and waiting for it) - if the service for
+    the key is that busy, the next one on the ring is used.
+
+    Requests waiting for a busy service stay in the priority lanes (so a more important request for this service
+    is processed first), other services don't take them. When the service is deactivated or stops, they are
+    routed again.
+    '''
+    def __init__(self, key: 'Optional[RoutingKey]' = None, replicas: int = 100, load_factor: float = 1.25):
+        super().__init__()
+        self.key = key if key is not None else path_prefix_key()
+        self.replicas = replicas
+        self.load_factor = load_factor
+
+        #   Sorted (hash, service) points of all services that took requests and didn't stop
+        self._ring: 'List[Tuple[int, Any]]' = []
+        self._ring_hashes: 'List[int]' = []
+        self._members: 'Set[Any]' = set()
+
+        #   request future -> service that should process it (only for the requests waiting in the lanes)
+        self._targets: 'Dict[asyncio.Future, Any]' = {}
+
+    def get_nowait(self, service: 'Any') -> 'Item':
+        if service not in self._members:
+            self._join(service)
+        return super().get_nowait(service)
+
+    def remove_service(self, service: 'Any') -> None:
+        self._leave(service)
+        super().remove_service(service)
+        self._reroute(service)
+
+    def set_service_active(self, service: 'Any', active: bool) -> None:
+        super().set_service_active(service, active)
+        if not active:
+            self._reroute(service)
+
+    def task_started(self, service: 'Any', fut: asyncio.Future) -> None:
+        self._targets.pop(fut, None)
+        super().task_started(service, fut)
+
+    def service_for(self, key: str, fut: 'Optional[asyncio.Future]' = None) -> 'Optional[Any]':
+        '''Service that should process a request with the key (None if no service can take it)'''
+        loads = {
+            service: self._load(service) for service in self._members
+            if getattr(service, 'active', True) and (fut is None or not self._is_excluded(service, fut))
+        }
+        if not loads:
+            return None
+        capacity = math.ceil(self.load_factor * (sum(loads.values()) + 1) / len(loads))
+
+        start = bisect.bisect(self._ring_hashes, _hash(key))
+        for i in range(len(self._ring)):
+            _, service = self._ring[(start + i) % len(self._ring)]
+            if service in loads and loads[service] < capacity:
+                return service
+        return None
+
+    def _put(self, item: 'Item', front: bool) -> None:
+        req, fut = item
+        key = None if fut.done() else self.key(req)
+        service = None if key is None else self.service_for(key, fut)
+        if service is None:
+            super()._put(item, front)
+            return
+
+        waiter = next((waiter for waiter_service, waiter in self._waiters
+                       if waiter_service is service and not waiter.done()), None)
+        if waiter is not None:
+            self.task_started(service, fut)
+            waiter.set_result(item)
+            return
+
+        #   Service is busy, request waits in the lane until this service takes it
+        self._targets[fut] = service
+        fut.add_done_callback(self._forget_target)
+        self._append_to_lane(item, front)
+
+    def _can_take(self, service: 'Any', fut: asyncio.Future) -> bool:
+        target = self._targets.get(fut)
+        return (target is None or target is service) and super()._can_take(service, fut)
+
+    def _reroute(self, service: 'Any') -> None:
+        '''Requests waiting for the service are scheduled again (i.e. to the next service on the ring)'''
+        rerouted = []
+        for priority, lane in self._lanes.items():
+            if any(self._targets.get(fut) is service for _, fut in lane):
+                rerouted += [item for item in lane if self._targets.get(item[1]) is service]
+                self._lanes[priority] = deque(item for item in lane if self._targets.get(item[1]) is not service)
+        for item in reversed(rerouted):
+            del self._targets[item[1]]
+            self._put(item, front=True)
+
+    def _forget_target(self, fut: asyncio.Future) -> None:
+        self._targets.pop(fut, None)
+
+    def _load(self, service: 'Any') -> int:
+        waiting_cnt = sum(1 for fut, target in self._targets.items() if target is service and not fut.done())
+        return self._stats(service).outstanding + self.reserved_cnt(service) + waiting_cnt
+
+    def _join(self, service: 'Any') -> None:
+        self._members.add(service)
+        service_id = getattr(service, 'provider_id', None) or str(id(service))
+        for i in range(self.replicas):
+            self._ring.append((_hash(f'{service_id}-{i}'), service))
+        self._ring.sort(key=lambda point: point[0])
+        self._ring_hashes = [point_hash for point_hash, _ in self._ring]
+
+    def _leave(self, service: 'Any') -> None:
+        if service in self._members:
+            self._members.remove(service)
+            self._ring = [point for point in self._ring if point[1] is not service]
+            self._ring_hashes = [point_hash for point_hash, _ in self._ring]
+
+
+def path_prefix_key(segments: 'Optional[int]' = None) -> 'RoutingKey':
+    '''Routing key: first `segments` segments of the path (whole path with the query string if None)'''
+    def key(req: 'Request') -> str:
+        if segments is None:
+            return req.target
+        return '/'.join(req.path.split('/')[:segments + 1])
+    return key
+
+
+def header_key(name: str) -> 'RoutingKey':
+    '''Routing key: value of the header (requests without it have no key)'''
+    def key(req: 'Request') -> 'Optional[str]':
+        return next((val for header, val in req.headers.items() if header.lower() == name.lower()), None)
+    return key
+
+
+def _hash(val: str) -> int:
+    return int.from_bytes(hashlib.blake2b(val.encode('utf-8'), digest_size=8).digest(), 'big')
@@ -1,12 +1,18 @@
 import json
+import struct
 from typing import TYPE_CHECKING
 from urllib.parse import urlsplit, urlunsplit, urlparse
 
+from .compression import decompress
+
 if TYPE_CHECKING:
-    from typing import Dict, TypedDict, Tuple, Optional, List  # pylint: disable=ungrouped-imports
+    from typing import (  # pylint: disable=ungrouped-imports
+        Any, Callable, Dict, TypedDict, Tuple, Optional, List, AsyncIterable, AsyncIterator, Iterator, Sequence,
+        TypeVar,
+    )
     import requests
     import httpx
-    import aiohttp
+    from .compression import Compression
 
     class DictResponse(TypedDict):
         status: int
@@ -19,35 +25,173 @@ if TYPE_CHECKING:
         data: str
         headers: 'Dict[str, str]'
 
+    BatchItem = TypeVar('BatchItem', 'Request', 'Response')
+
+
+#   Serialization formats used when requests/responses are passed in files
+#   BINARY is a length-prefixed frame (-> pack_frame), JSON is kept for compatibility with older providers
+#   (and works only for utf-8 bodies)
+BINARY = 'binary'
+JSON = 'json'
+FORMATS = (BINARY, JSON)
+
+#   Set on the error responses created by ya_httpx_client on the provider side (e.g. when the server could not
+#   be reached), so that they are not mistaken for errors of the application
+PROVIDER_ERROR_HEADER = 'X-Yhc-Provider-Error'
+
+#   Binary frame: magic, length of the JSON-encoded head (everything except the body), length of the body.
+#   This is followed by the head and the raw body. If the body is compressed, head has the "encoding" key.
+FRAME_MAGIC = b'YHC1'
+FRAME_HEADER = struct.Struct('!4sIQ')
+
+
+def pack_frame(
+    head: 'Dict[str, Any]', body: bytes, compression: 'Optional[Compression]' = None,
+) -> 'Tuple[bytes, bytes, bytes]':
+    '''Parts of a binary frame. They are not joined, so that the body can be written without copying it'''
+    if compression is not None:
+        compressed = compression.maybe_compress(head.get('headers', {}), body)
+        if compressed is not None:
+            head = {**head, 'encoding': compression.algorithm}
+            body = compressed
+    head_bytes = json.dumps(head).encode('utf-8')
+    return FRAME_HEADER.pack(FRAME_MAGIC, len(head_bytes), len(body)), head_bytes, body
+
+
+def unpack_frame(buf: bytes, offset: int = 0) -> 'Tuple[Dict[str, Any], bytes, int]':
+    '''Parse frame starting at `offset`. Returns (head, body, offset of the next frame)'''
+    view = memoryview(buf)
+    if offset + FRAME_HEADER.size > len(view):
+        raise ValueError(f"Truncated frame at offset {offset}")
+    magic, head_len, body_len = FRAME_HEADER.unpack_from(view, offset)
+    if magic != FRAME_MAGIC:
+        raise ValueError(f"Invalid frame at offset {offset}")
+
+    head_start = offset + FRAME_HEADER.size
+    body_start = head_start + head_len
+    body_end = body_start + body_len
+    if body_end > len(view):
+        raise ValueError(f"Truncated frame at offset {offset}")
+
+    head = json.loads(bytes(view[head_start:body_start]).decode('utf-8'))
+    body = bytes(view[body_start:body_end])
+    if 'encoding' in head:
+        body = decompress(head.pop('encoding'), body)
+    return head, body, body_end
+
+
+def iter_frames(buf: bytes) -> 'Iterator[Tuple[Dict[str, Any], bytes]]':
+    '''(head, body) pairs of all frames in a buffer with concatenated frames'''
+    offset = 0
+    while offset < len(buf):
+        head, body, offset = unpack_frame(buf, offset)
+        yield head, body
+
+
+def to_batch_file(
+    items: 'Sequence[BatchItem]', fname: str, fmt: str = BINARY, compression: 'Optional[Compression]' = None,
+    on_error: 'Optional[Callable[[BatchItem, Exception], BatchItem]]' = None,
+) -> None:
+    '''
+    Save many requests (or responses) in a single file. BINARY batch is just a sequence of frames,
+    JSON batch is a list of dicts. Should be read with `Request.batch_from_file`/`Response.batch_from_file`.
+    Bodies are compressed according to `compression` (BINARY only).
+
+    If an item can't be encoded (e.g. it has a non-utf-8 body and the format is JSON) and `on_error` is set,
+    the item returned by `on_error(item, exception)` is saved instead. Otherwise nothing is saved and the
+    exception is raised.
+    '''
+    _check_format(fmt, compression)
+    encoded = [_encode_batch_item(item, fmt, compression, on_error) for item in items]
+    if fmt == JSON:
+        with open(fname, 'w', encoding='utf-8') as f:
+            json.dump(encoded, f)
+    else:
+        with open(fname, 'wb') as f:
+            for parts in encoded:
+                f.writelines(parts)
+
+
+def _encode_batch_item(
+    item: 'BatchItem', fmt: str, compression: 'Optional[Compression]',
+    on_error: 'Optional[Callable[[BatchItem, Exception], BatchItem]]',
+) -> 'Any':
+    try:
+        return item.as_dict() if fmt == JSON else item.as_frame_parts(compression)
+    except Exception as e:  # pylint: disable=broad-except
+        if on_error is None:
+            raise
+        replacement = on_error(item, e)
+    return replacement.as_dict() if fmt == JSON else replacement.as_frame_parts(compression)
+
+
+def _check_format(fmt: str, compression: 'Optional[Compression]' = None) -> None:
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown serialization format {fmt}, expected one of {FORMATS}")
+    if compression is not None and fmt != BINARY:
+        raise ValueError(f"Compression requires the {BINARY} serialization format, not {fmt}")
+
 
 class Response:
-    def __init__(self, status: int, data: bytes, headers: 'Dict[str, str]'):
+    def __init__(
+        self, status: int, data: bytes, headers: 'Dict[str, str]', stream: 'Optional[AsyncIterable[bytes]]' = None,
+    ):
         self.status = status
-        self.data = data
         self.headers = headers
 
-    @classmethod
-    def from_wsmessages(cls, headers_msg: 'aiohttp.WSMessage', content_msg: 'aiohttp.WSMessage') -> 'Response':
-        lines = headers_msg.data.decode('ascii').splitlines()
+        #   Body is either already here (data) or will be received later (stream).
+        #   Streamed body is never stored in data, unless `aread` is called.
+        self.data = data
+        self.stream = stream
+
+    @property
+    def is_provider_error(self) -> bool:
+        '''True if this is an error of the provider (-> PROVIDER_ERROR_HEADER), not of the application'''
+        return self.status in (502, 503, 504) and any(
+            name.lower() == PROVIDER_ERROR_HEADER.lower() for name in self.headers
+        )
+
+    async def aread(self) -> bytes:
+        '''Receive the whole streamed body (if there is any) and return the body'''
+        if self.stream is not None:
+            self.data = b''.join([chunk async for chunk in self.stream])
+            self.stream = None
+        return self.data
 
-        status_code = lines[0].split()[1]
+    @classmethod
+    def from_file(cls, fname: str, fmt: str = BINARY) -> 'Response':
+        _check_format(fmt)
+        if fmt == JSON:
+            with open(fname, 'r', encoding='utf-8') as f:
+                return cls.from_json(f.read())
+        with open(fname, 'rb') as f:
+            return cls.from_bytes(f.read())
 
-        headers = {}
-        for header_line in lines[1:]:
-            if header_line:
-                name, value = header_line.split(': ', maxsplit=1)
-                headers[name] = value
+    @classmethod
+    def batch_from_file(cls, fname: str, fmt: str = BINARY) -> 'List[Response]':
+        _check_format(fmt)
+        if fmt == JSON:
+            with open(fname, 'r', encoding='utf-8') as f:
+                return [cls.from_dict(data) for data in json.load(f)]
+        with open(fname, 'rb') as f:
+            return [cls.from_frame(head, body) for head, body in iter_frames(f.read())]
 
-        return Response(status_code, content_msg.data, headers)
+    @classmethod
+    def from_bytes(cls, buf: bytes) -> 'Response':
+        head, body, _ = unpack_frame(buf)
+        return cls.from_frame(head, body)
 
     @classmethod
-    def from_file(cls, fname: str) -> 'Response':
-        with open(fname, 'r', encoding='utf-8') as f:
-            return cls.from_json(f.read())
+    def from_frame(cls, head: 'Dict[str, Any]', body: bytes) -> 'Response':
+        return cls(int(head['status']), body, head['headers'])
 
     @classmethod
     def from_json(cls, json_data: str) -> 'Response':
         data = json.loads(json_data)
+        return cls.from_dict(data)
+
+    @classmethod
+    def from_dict(cls, data: 'DictResponse') -> 'Response':
         return cls(
             int(data['status']),
             data['data'].encode('utf-8'),
@@ -62,9 +206,20 @@ class Response:
     def from_httpx_response(cls, res: 'httpx.Response') -> 'Response':
         return cls(res.status_code, res.content, dict(res.headers))
 
-    def to_file(self, fname: str) -> None:
-        with open(fname, 'w', encoding='utf-8') as f:
-            f.write(self.as_json())
+    def to_file(self, fname: str, fmt: str = BINARY, compression: 'Optional[Compression]' = None) -> None:
+        _check_format(fmt, compression)
+        if fmt == JSON:
+            with open(fname, 'w', encoding='utf-8') as f:
+                f.write(self.as_json())
+        else:
+            with open(fname, 'wb') as f:
+                f.writelines(self.as_frame_parts(compression))
+
+    def as_frame_parts(self, compression: 'Optional[Compression]' = None) -> 'Tuple[bytes, bytes, bytes]':
+        return pack_frame({'status': self.status, 'headers': self.headers}, self.data, compression)
+
+    def as_bytes(self) -> bytes:
+        return b''.join(self.as_frame_parts())
 
     def as_json(self) -> str:
         return json.dumps(self.as_dict())
@@ -76,24 +231,78 @@ class Response:
             'headers': self.headers,
         }
 
-    def as_flask_response(self) -> 'Tuple[str, int, Dict[str, str]]':
-        return self.data.decode('utf-8'), self.status, self.headers
+    def as_flask_response(self) -> 'Tuple[bytes, int, Dict[str, str]]':
+        return self.data, self.status, self.headers
 
-    def as_quart_response(self) -> 'Tuple[str, int, Dict[str, str]]':
+    def as_quart_response(self) -> 'Tuple[bytes, int, Dict[str, str]]':
         return self.as_flask_response()
 
 
-class Request:
-    def __init__(self, method: str, url: str, data: bytes, headers: 'Dict[str, str]'):
+class Request:  # pylint: disable=too-many-public-methods
+    def __init__(
+        self, method: str, url: str, data: bytes, headers: 'Dict[str, str]',
+        stream: 'Optional[AsyncIterable[bytes]]' = None,
+    ):
+        # pylint: disable=too-many-arguments
         self.method = method
         self.url = url
-        self.data = data
         self.headers = headers
 
+        #   Body is either here (data) or it will be produced by the caller while the request is
+        #   being sent (stream). Stream can be sent only once, so if the request failed after
+        #   the body was (partially) consumed, it can't be sent again.
+        self.data = data
+        self.stream = stream
+        self.body_consumed = False
+
+        #   Used by the scheduler, higher is more important
+        self.priority = 0
+
+    def pop_header(self, name: str) -> 'Optional[str]':
+        '''Remove header (case-insensitive), return its value or None if it was not there'''
+        for key in list(self.headers):
+            if key.lower() == name.lower():
+                return self.headers.pop(key)
+        return None
+
+    @property
+    def is_replayable(self) -> bool:
+        return self.stream is None or not self.body_consumed
+
+    async def aiter_body(self) -> 'AsyncIterator[bytes]':
+        if self.stream is None:
+            if self.data:
+                yield self.data
+        else:
+            self.body_consumed = True
+            async for chunk in self.stream:
+                if chunk:
+                    yield chunk
+
+    async def aread(self) -> bytes:
+        '''Consume the streamed body (if there is any) and return the whole body'''
+        if self.stream is not None:
+            self.data = b''.join([chunk async for chunk in self.aiter_body()])
+            self.stream = None
+        return self.data
+
     @property
     def path(self) -> str:
         return urlparse(self.url).path
 
+    @property
+    def target(self) -> str:
+        '''Request target sent to the server, i.e. path with the query string'''
+        url_parts = urlsplit(self.url)
+        target = url_parts.path or '/'
+        if url_parts.query:
+            target += '?' + url_parts.query
+        return target
+
+    @property
+    def host(self) -> str:
+        return urlsplit(self.url).netloc
+
     def replace_mount_url(self, new_base_url: str) -> None:
         if '://' not in new_base_url:
             raise ValueError(f"Missing schema in url {new_base_url}")
@@ -122,9 +331,31 @@ class Request:
         return cls(request.method, request.url, data, dict(request.headers))
 
     @classmethod
-    def from_file(cls, fname: str) -> 'Request':
-        with open(fname, 'r', encoding='utf-8') as f:
-            return cls.from_json(f.read())
+    def from_file(cls, fname: str, fmt: str = BINARY) -> 'Request':
+        _check_format(fmt)
+        if fmt == JSON:
+            with open(fname, 'r', encoding='utf-8') as f:
+                return cls.from_json(f.read())
+        with open(fname, 'rb') as f:
+            return cls.from_bytes(f.read())
+
+    @classmethod
+    def batch_from_file(cls, fname: str, fmt: str = BINARY) -> 'List[Request]':
+        _check_format(fmt)
+        if fmt == JSON:
+            with open(fname, 'r', encoding='utf-8') as f:
+                return [cls.from_dict(data) for data in json.load(f)]
+        with open(fname, 'rb') as f:
+            return [cls.from_frame(head, body) for head, body in iter_frames(f.read())]
+
+    @classmethod
+    def from_bytes(cls, buf: bytes) -> 'Request':
+        head, body, _ = unpack_frame(buf)
+        return cls.from_frame(head, body)
+
+    @classmethod
+    def from_frame(cls, head: 'Dict[str, Any]', body: bytes) -> 'Request':
+        return cls(head['method'], head['url'], body, head['headers'])
 
     @classmethod
     def from_json(cls, json_data: str) -> 'Request':
@@ -146,8 +377,9 @@ class Request:
         _method: bytes,
         _url: 'Tuple[bytes, bytes, Optional[int], bytes]',
         _headers: 'List[Tuple[bytes, bytes]]',
-        stream: 'httpx.ByteStream',
+        stream: 'httpx.AsyncByteStream',
     ) -> 'Request':
+        import httpx  # pylint: disable=import-outside-toplevel
         method = _method.decode()
         scheme, host, port, path = cls._decode_httpx_url(_url)
         headers = {key.decode(): val.decode() for key, val in _headers}
@@ -157,27 +389,31 @@ class Request:
         else:
             url = f'{scheme}://{host}:{port}{path}'
 
-        data = stream.read()
-
-        return cls(method, url, data, headers)
+        if isinstance(stream, httpx.ByteStream):
+            #   Body was passed as bytes, so it's already in memory
+            return cls(method, url, stream.read(), headers)
+        return cls(method, url, b'', headers, stream)
 
     @staticmethod
     def _decode_httpx_url(url: 'Tuple[bytes, bytes, Optional[int], bytes]') -> 'Tuple[str, str, Optional[int], str]':
         scheme, host, port, path = url
         return scheme.decode(), host.decode(), port, path.decode()
 
-    @classmethod
-    def from_httpx_request(cls, req: 'httpx.Request') -> 'Request':
-        return cls(
-            req.method,
-            str(req.url),
-            req.read(),
-            dict(req.headers),
-        )
+    def to_file(self, fname: str, fmt: str = BINARY, compression: 'Optional[Compression]' = None) -> None:
+        _check_format(fmt, compression)
+        if fmt == JSON:
+            with open(fname, 'w', encoding='utf-8') as f:
+                f.write(self.as_json())
+        else:
+            with open(fname, 'wb') as f:
+                f.writelines(self.as_frame_parts(compression))
 
-    def to_file(self, fname: str) -> None:
-        with open(fname, 'w', encoding='utf-8') as f:
-            f.write(self.as_json())
+    def as_frame_parts(self, compression: 'Optional[Compression]' = None) -> 'Tuple[bytes, bytes, bytes]':
+        head = {'method': self.method, 'url': self.url, 'headers': self.headers}
+        return pack_frame(head, self.data, compression)
+
+    def as_bytes(self) -> bytes:
+        return b''.join(self.as_frame_parts())
 
     def as_json(self) -> str:
         return json.dumps(self.as_dict())
@@ -190,22 +426,6 @@ class Request:
             'headers': self.headers,
         }
 
-    def as_raw_request_str(self) -> str:
-        return (
-            f"{self.method.upper()} {self.path} HTTP/1.0"
-            f"{self.raw_headers_str()}"
-            "\r\n"
-            f"{self.raw_body_str()}"
-        )
-
-    def raw_headers_str(self) -> str:
-        lines = [": ".join(key_val) + "\r\n" for key_val in self.headers.items()]
-        headers = "".join(lines)
-        return headers
-
-    def raw_body_str(self):
-        return self.data.decode()
-
     def as_requests_request(self) -> 'requests.Request':
         #   Imported here, because we use this only on the provider side
         import requests  # pylint: disable=import-outside-toplevel
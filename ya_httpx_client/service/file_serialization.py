@@ -1,25 +1,157 @@
+import asyncio
+import logging
+import os
 from tempfile import NamedTemporaryFile
-from typing import List
+from typing import TYPE_CHECKING, List, Optional
 
-from .service_base import AbstractServiceBase
-from ..serializable_request import Response
+from .service_base import AbstractServiceBase, wait_for_pid_file
+from ..metrics import BYTES_RECEIVED, BYTES_SENT
+from ..serializable_request import Response, BINARY, to_batch_file
+
+if TYPE_CHECKING:
+    from typing import Tuple
+    from ..compression import Compression
+    from ..serializable_request import Request
+
+logger = logging.getLogger(__name__)
 
 
 class FileSerializationService(AbstractServiceBase):
     REQUIRED_CAPABILITIES: List[str] = []
 
+    #   Format of the request/response files, one of serializable_request.FORMATS.
+    #   BINARY works for all bodies and supports COMPRESSION, JSON works only for utf-8 bodies.
+    SERIALIZATION_FORMAT = BINARY
+
+    #   If set, bodies of the requests and responses are compressed in the files (-> ya_httpx_client.compression).
+    #   Works only with the BINARY format and requires a ya-httpx-client[provider] version that supports it.
+    COMPRESSION: 'Optional[Compression]' = None
+
+    #   Requests are sent to the provider in batches: a single file with up to BATCH_SIZE requests is processed
+    #   by a single provider-side process (with at most `concurrency` requests sent to the server at the same time).
+    #   After the first request of a batch arrived, we wait up to BATCH_WAIT seconds for more requests.
+    BATCH_SIZE = 32
+    BATCH_WAIT = 0.01
+
+    #   If True, batches are processed by a long-running worker (-> ya_httpx_client.worker) started together
+    #   with the service. If False, a new `python -m ya_httpx_client` process is started for every batch.
+    USE_WORKER = True
+
+    PROVIDER_URL = 'unix:///tmp/golem.sock'
+    WORKER_INBOX = '/golem/work/inbox'
+    WORKER_OUTBOX = '/golem/work/outbox'
+    WORKER_PID_FILE = '/golem/work/worker.pid'
+
+    #   If the worker doesn't write its pid file in that many seconds (e.g. ya-httpx-client[provider] is missing
+    #   in the image), the service fails
+    WORKER_START_TIMEOUT = 30
+
+    def __init__(self, *args, **kwargs):
+        if self.COMPRESSION is not None and self.SERIALIZATION_FORMAT != BINARY:
+            raise ValueError(
+                f"COMPRESSION requires SERIALIZATION_FORMAT = {BINARY!r}, not {self.SERIALIZATION_FORMAT!r}"
+            )
+        super().__init__(*args, **kwargs)
+        self._batch_cnt = 0
+
+    def daemon_commands(self):
+        if not self.USE_WORKER:
+            return []
+
+        fmt = self.SERIALIZATION_FORMAT
+        start_worker = (
+            f'nohup python -m ya_httpx_client.worker --url {self.PROVIDER_URL} --format {fmt} '
+            f'--concurrency {self.concurrency} --pid-file {self.WORKER_PID_FILE} {self._compression_args()} '
+            f'{self.WORKER_INBOX} {self.WORKER_OUTBOX} > /golem/work/worker.log 2>&1 &'
+        )
+        wait_for_worker = wait_for_pid_file(self.WORKER_PID_FILE, self.WORKER_START_TIMEOUT)
+        return [('/bin/sh', '-c', f'{start_worker} {wait_for_worker}')]
+
     async def run(self):
-        provider_url = 'unix:///tmp/golem.sock'
+        fmt = self.SERIALIZATION_FORMAT
         while True:
-            req, fut = self.current_req, self.current_fut = await self.queue.get()
-            print(f"processing {req.url} on {self.provider_name}")
+            batch = await self._get_batch()
+            logger.debug("Processing %s requests on %s", len(batch), self.provider_name)
+
+            for req, fut in batch:
+                self._start_processing(req, fut)
+                await req.aread()
+
             with NamedTemporaryFile() as in_file, NamedTemporaryFile() as out_file:
-                req.to_file(in_file.name)
+                to_batch_file([req for req, _ in batch], in_file.name, fmt, self.COMPRESSION)
+                BYTES_SENT.inc(os.path.getsize(in_file.name), provider=self.provider_name)
+
                 script = self._ctx.new_script()
-                script.upload_file(in_file.name, '/golem/work/req.json')
-                script.run('/bin/sh', '-c', f'python -m ya_httpx_client --url {provider_url} req.json res.json')
-                script.download_file('/golem/work/res.json', out_file.name)
-                yield script
+                if self.USE_WORKER:
+                    self._add_worker_commands(script, in_file.name, out_file.name)
+                else:
+                    self._add_process_commands(script, in_file.name, out_file.name)
+                try:
+                    yield script
+                except Exception:
+                    self._report_failure()
+                    raise
+
+                BYTES_RECEIVED.inc(os.path.getsize(out_file.name), provider=self.provider_name)
+                try:
+                    responses = Response.batch_from_file(out_file.name, fmt)
+                except ValueError:
+                    #   Truncated or corrupted file
+                    self._report_failure()
+                    raise
+
+            for (_, fut), res in zip(batch, responses):
+                self._finish_processing(fut, res)
+            if len(responses) != len(batch):
+                #   Requests without responses are still in `in_flight`, so they are restarted on another provider
+                self._report_failure()
+                raise ConnectionError(
+                    f"Provider {self.provider_name} returned {len(responses)} responses for {len(batch)} requests"
+                )
+
+    def _add_process_commands(self, script, in_fname: str, out_fname: str) -> None:
+        fmt = self.SERIALIZATION_FORMAT
+        script.upload_file(in_fname, f'/golem/work/req.{fmt}')
+        script.run(
+            '/bin/sh', '-c',
+            f'python -m ya_httpx_client --url {self.PROVIDER_URL} --format {fmt} '
+            f'--batch --concurrency {self.concurrency} {self._compression_args()} req.{fmt} res.{fmt}'
+        )
+        script.download_file(f'/golem/work/res.{fmt}', out_fname)
+
+    def _add_worker_commands(self, script, in_fname: str, out_fname: str) -> None:
+        self._batch_cnt += 1
+        name = f'batch_{self._batch_cnt}.{self.SERIALIZATION_FORMAT}'
+        inbox_path, outbox_path = f'{self.WORKER_INBOX}/{name}', f'{self.WORKER_OUTBOX}/{name}'
+
+        #   Worker ignores the .part files, so it will never see an incomplete batch file.
+        #   If the worker died, we fail instead of waiting forever (and the service will be restarted).
+        script.upload_file(in_fname, f'{inbox_path}.part')
+        script.run(
+            '/bin/sh', '-c',
+            f'mv {inbox_path}.part {inbox_path} && '
+            f'while [ ! -f {outbox_path} ]; do kill -0 $(cat {self.WORKER_PID_FILE}) || exit 1; sleep 0.005; done'
+        )
+        script.download_file(outbox_path, out_fname)
+        script.run('/bin/rm', outbox_path)
+
+    def _compression_args(self) -> str:
+        if self.COMPRESSION is None:
+            return ''
+        return self.COMPRESSION.cli_args()
+
+    async def _get_batch(self) -> 'List[Tuple[Request, asyncio.Future]]':
+        batch = [await self._get_request()]
 
-                res = Response.from_file(out_file.name)
-                fut.set_result(res)
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.BATCH_WAIT
+        while len(batch) < self.BATCH_SIZE:
+            timeout = deadline - loop.time()
+            try:
+                if timeout > 0:
+                    batch.append(await asyncio.wait_for(self.scheduler.get(self), timeout))
+                else:
+                    batch.append(self.scheduler.get_nowait(self))
+            except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                break
+        return batch
@@ -1,3 +1,6 @@
+import asyncio
+import logging
+import warnings
 from abc import ABC
 from typing import TYPE_CHECKING
 
@@ -5,34 +8,189 @@ from yapapi.services import Service
 from yapapi.script.command import Run
 
 if TYPE_CHECKING:
-    import asyncio
-    from typing import Tuple, Optional
-    from ya_httpx_client.serializable_request import Request
+    from typing import Callable, Tuple, Dict, List, Optional, Sequence
+    from ya_httpx_client.serializable_request import Request, Response
+    from ya_httpx_client.scheduler import Scheduler
+
+logger = logging.getLogger(__name__)
+
+
+def wait_for_pid_file(pid_file: str, timeout: float) -> str:
+    '''
+    Shell commands that follow a `... &` command (in the same shell) and wait until that background process
+    writes `pid_file`. They fail if the process exits or doesn't write the file in `timeout` seconds,
+    so the service fails (and is replaced) instead of staying in the "starting" state forever.
+    '''
+    interval = 0.01
+    max_checks = max(1, int(timeout / interval))
+    return (
+        f'pid=$!; checks=0; while [ ! -f {pid_file} ]; do '
+        f'kill -0 $pid 2>/dev/null || exit 1; '
+        f'checks=$((checks + 1)); [ $checks -lt {max_checks} ] || exit 1; '
+        f'sleep {interval}; done'
+    )
 
 
 class AbstractServiceBase(ABC, Service):
     '''Base class for all services. Contains common things, inheriting classes
     are expected to implement the `run` method.'''
 
-    def __init__(self, *args, entrypoint: 'Tuple[str, ...]', request_queue: 'asyncio.Queue', **kwargs):
+    def __init__(
+        self,
+        *args,
+        entrypoint: 'Tuple[str, ...]',
+        scheduler: 'Scheduler',
+        concurrency: int = 1,
+        on_started: 'Optional[Callable[[AbstractServiceBase], None]]' = None,
+        on_failed: 'Optional[Callable[[AbstractServiceBase], None]]' = None,
+        port: int = 80,
+        colocated: 'Sequence[Tuple[Scheduler, int]]' = (),
+        **kwargs
+    ):
+        # pylint: disable=too-many-arguments
         super().__init__(*args, **kwargs)
 
         self.entrypoint: 'Tuple[str, ...]' = entrypoint
-        self.queue: 'asyncio.Queue' = request_queue
+        self.scheduler: 'Scheduler' = scheduler
+
+        #   Scheduler -> port of the provider-side server that processes its requests. Apart from our own `scheduler`,
+        #   service might process requests from the schedulers of the `colocated` clusters (-> Cluster.colocate),
+        #   all of them share the same `concurrency`.
+        self.ports: 'Dict[Scheduler, int]' = {scheduler: port, **dict(colocated)}
+        self.schedulers: 'List[Scheduler]' = list(self.ports)
+
+        #   Request future -> scheduler it was taken from (if this is not our own scheduler)
+        self._colocated_futures: 'Dict[asyncio.Future, Scheduler]' = {}
+
+        #   Colocated schedulers take turns in `_get_request`, so that none of them starves the others
+        self._next_scheduler = 0
+
+        #   Max number of requests processed by this service at the same time
+        self.concurrency = concurrency
+
+        #   Requests taken from the scheduler and not yet answered. Requests are removed from here only
+        #   after the response was set, so if the service fails they are still here and will be restarted.
+        self.in_flight: 'Dict[asyncio.Future, Request]' = {}
 
-        self.current_req: 'Optional[Request]' = None
-        self.current_fut: 'Optional[asyncio.Future]' = None
+        #   Called when the service is started. Service doesn't take requests until it is activated by `set_active`
+        #   (inactive services are spares that wait for a failure of an other service or for more traffic).
+        self._on_started = on_started
+        self._active = asyncio.Event()
+
+        #   Called when the service noticed it failed (this happens before the service status changes)
+        self._on_failed = on_failed
+        self.failed = False
 
     async def start(self):
         async for script in super().start():
             yield script
 
+        sidecar_commands = self.sidecar_commands()
+        if sidecar_commands:
+            script = self._ctx.new_script()
+            for command in sidecar_commands:
+                script.add(Run(*command))
+            yield script
+
         if self.entrypoint:
             script = self._ctx.new_script()
             script.add(Run(*self.entrypoint))
             yield script
 
-        print(f"STARTED ON {self.provider_name}")
+        daemon_commands = self.daemon_commands()
+        if daemon_commands:
+            script = self._ctx.new_script()
+            for command in daemon_commands:
+                script.add(Run(*command))
+            yield script
+
+        logger.info("Service started on %s", self.provider_name)
+        if self._on_started is not None:
+            self._on_started(self)
+        else:
+            self.set_active(True)
+
+    def sidecar_commands(self) -> 'List[Tuple[str, ...]]':
+        '''Commands that start our own long-running provider-side processes before the entrypoint
+        (the same way as `daemon_commands`)'''
+        return []
+
+    def daemon_commands(self) -> 'List[Tuple[str, ...]]':
+        '''Commands that start our own long-running provider-side processes (after the entrypoint).
+        They should start the process in the background and finish when it is ready.'''
+        return []
+
+    def set_active(self, active: bool) -> None:
+        changed = active != self.active
+        if active:
+            self._active.set()
+        else:
+            self._active.clear()
+        if changed:
+            for scheduler in self.schedulers:
+                scheduler.set_service_active(self, active)
+
+    @property
+    def active(self) -> bool:
+        return self._active.is_set()
+
+    def eject(self) -> None:
+        '''Stop using this service, although it is still running (e.g. because it is much slower than others)'''
+        self._report_failure()
+
+    def _report_failure(self) -> None:
+        if not self.failed:
+            self.failed = True
+            self.set_active(False)
+            if self._on_failed is not None:
+                self._on_failed(self)
+
+    async def _get_request(self) -> 'Tuple[Request, asyncio.Future]':
+        '''Wait until the service is active and there is a request for it (from any of the schedulers)'''
+        await self._active.wait()
+        if len(self.schedulers) == 1:
+            return await self.scheduler.get(self)
+
+        schedulers = self.schedulers[self._next_scheduler:] + self.schedulers[:self._next_scheduler]
+        self._next_scheduler = (self._next_scheduler + 1) % len(self.schedulers)
+        for scheduler in schedulers:
+            try:
+                item = scheduler.get_nowait(self)
+            except asyncio.QueueEmpty:
+                continue
+            self._remember_scheduler(scheduler, item[1])
+            return item
+
+        getters = [asyncio.ensure_future(scheduler.get(self)) for scheduler in schedulers]
+        received = False
+        try:
+            await asyncio.wait(getters, return_when=asyncio.FIRST_COMPLETED)
+            received = True
+        finally:
+            for getter in getters:
+                getter.cancel()
+
+            #   More than one scheduler might have given us a request - we keep the first one and put back the others
+            #   (or all of them, if we were cancelled)
+            taken = [(scheduler, getter.result()) for scheduler, getter in zip(schedulers, getters)
+                     if getter.done() and not getter.cancelled() and getter.exception() is None]
+            for scheduler, item in taken[1 if received else 0:]:
+                scheduler.requeue(item)
+
+        if not taken:
+            #   None of the schedulers gave us a request, so one of them failed - `result` raises the exception
+            return next(getter for getter in getters if getter.done() and not getter.cancelled()).result()
+        scheduler, item = taken[0]
+        self._remember_scheduler(scheduler, item[1])
+        return item
+
+    def _remember_scheduler(self, scheduler: 'Scheduler', fut: 'asyncio.Future') -> None:
+        if scheduler is not self.scheduler:
+            self._colocated_futures[fut] = scheduler
+
+    def scheduler_of(self, fut: 'asyncio.Future') -> 'Scheduler':
+        '''Scheduler the request was taken from'''
+        return self._colocated_futures.get(fut, self.scheduler)
 
     async def run(self):
         raise NotImplementedError
@@ -40,7 +198,51 @@ class AbstractServiceBase(ABC, Service):
         # method run must be a generator
         yield  # pylint: disable=unreachable
 
+    def restart_failed_requests(self) -> None:
+        '''Put all failed requests back into the scheduler (they will be processed before any other request)'''
+        for fut, req in self.in_flight.items():
+            scheduler = self.scheduler_of(fut)
+            if fut.done():
+                scheduler.task_done(fut)
+            elif req.is_replayable:
+                scheduler.requeue((req, fut))
+            else:
+                scheduler.task_done(fut, failed=True)
+                fut.set_exception(ConnectionError(
+                    f"Provider {self.provider_name} failed after the streamed request body was sent, "
+                    "request can't be sent again"
+                ))
+        self.in_flight.clear()
+        self._colocated_futures.clear()
+        for scheduler in self.schedulers:
+            scheduler.remove_service(self)
+
     def restart_failed_request(self) -> None:
-        '''Put failed request back into request queue'''
-        if self.current_fut is not None and not self.current_fut.done():
-            self.queue.put_nowait((self.current_req, self.current_fut))
+        '''Deprecated alias of `restart_failed_requests`'''
+        warnings.warn(
+            "restart_failed_request is deprecated, use restart_failed_requests", DeprecationWarning, stacklevel=2,
+        )
+        self.restart_failed_requests()
+
+    def _start_processing(self, req: 'Request', fut: 'asyncio.Future') -> None:
+        self.in_flight[fut] = req
+
+    def _finish_processing(self, fut: 'asyncio.Future', res: 'Response') -> None:
+        if not fut.done():
+            fut.set_result(res)
+        else:
+            #   Nobody waits for this response anymore (timeout or a hedged request won), body is discarded
+            aclose = getattr(res.stream, 'aclose', None)
+            if aclose is not None:
+                asyncio.ensure_future(aclose())
+        self.in_flight.pop(fut, None)
+        self.scheduler_of(fut).task_done(fut, failed=res.is_provider_error, app_error=res.status >= 500)
+        self._colocated_futures.pop(fut, None)
+
+    def _fail_processing(self, fut: 'asyncio.Future', error: Exception) -> None:
+        '''Request failed and can't be sent again (e.g. its streamed body was already consumed)'''
+        if not fut.done():
+            fut.set_exception(error)
+        self.in_flight.pop(fut, None)
+        self.scheduler_of(fut).task_done(fut, failed=True)
+        self._colocated_futures.pop(fut, None)
@@ -1,48 +1,297 @@
+import asyncio
+import logging
+import math
+from typing import TYPE_CHECKING
+
 import aiohttp
 from yapapi.payload import vm
 
-from .service_base import AbstractServiceBase
+from .service_base import AbstractServiceBase, wait_for_pid_file
+from .ws_pool import WebsocketPool
+from .ws_stream import HTTPConnection, MuxBodyStream, WebsocketBodyStream, open_mux
+from ..metrics import RETRIES
 from ..serializable_request import Response
 
+if TYPE_CHECKING:
+    from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, TypeVar
+    from ..compression import Compression
+    from ..mux import MuxConnection
+    from ..scheduler import Scheduler
+    from ..serializable_request import Request
+
+    T = TypeVar('T')
+
+logger = logging.getLogger(__name__)
+
 
 class VPNService(AbstractServiceBase):
     REQUIRED_CAPABILITIES = [vm.VM_CAPS_VPN]
 
+    #   If True, requests from a single batch (-> Scheduler.submit_batch) are pipelined over a single tunnel (sent
+    #   without waiting for the responses) - this requires a server that supports HTTP/1.1 pipelining. The batch is
+    #   split between the `concurrency` workers, the rest of it is processed by other services.
+    #   If False (and without MULTIPLEXING), requests from a batch are processed separately, as any other requests.
+    PIPELINING = False
+
+    #   If True, a sidecar (-> ya_httpx_client.sidecar) is started on the provider before the entrypoint (this requires
+    #   `ya-httpx-client[provider]` installed in the image). All requests are sent to the sidecar over a single tunnel
+    #   (-> ya_httpx_client.mux), sidecar forwards them to the server over keep-alive connections. Number of concurrent
+    #   requests is still limited by the `provider_concurrency`, but it can be much higher than without the sidecar.
+    MULTIPLEXING = False
+    SIDECAR_PORT = 8888
+    SIDECAR_PID_FILE = '/golem/work/sidecar.pid'
+
+    #   If the sidecar doesn't write its pid file in that many seconds, the service fails
+    SIDECAR_START_TIMEOUT = 30
+
+    #   If set, request and response bodies are compressed between the requestor and the sidecar
+    #   (-> ya_httpx_client.compression). Works only with MULTIPLEXING.
+    COMPRESSION: 'Optional[Compression]' = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        #   Port -> pool of tunnels to this port. Created on the first request, because websocket url is known only
+        #   after the service started.
+        self._ws_pools: 'Dict[int, WebsocketPool]' = {}
+
+        #   Connection to the sidecar (if MULTIPLEXING), replaced when it is closed
+        self._mux: 'Optional[MuxConnection]' = None
+        self._mux_ws: 'Optional[aiohttp.ClientWebSocketResponse]' = None
+        self._mux_lock = asyncio.Lock()
+
+    def sidecar_commands(self):
+        if not self.MULTIPLEXING:
+            return []
+
+        compression_args = '' if self.COMPRESSION is None else self.COMPRESSION.cli_args()
+        start_sidecar = (
+            f'nohup python -m ya_httpx_client.sidecar --port {self.SIDECAR_PORT} --pid-file {self.SIDECAR_PID_FILE} '
+            f'{compression_args} > /golem/work/sidecar.log 2>&1 &'
+        )
+        wait_for_sidecar = wait_for_pid_file(self.SIDECAR_PID_FILE, self.SIDECAR_START_TIMEOUT)
+        return [('/bin/sh', '-c', f'{start_sidecar} {wait_for_sidecar}')]
+
     async def run(self):
-        while True:
-            req, fut = self.current_req, self.current_fut = await self.queue.get()
-            res = await self._handle_request_with_504_guard(req)
-            fut.set_result(res)
+        loop = asyncio.get_event_loop()
+        workers = [loop.create_task(self._process_requests()) for _ in range(self.concurrency)]
+        try:
+            #   Workers never finish, unless one of them fails - and then the whole service fails
+            await asyncio.gather(*workers)
+        except Exception:
+            self._report_failure()
+            raise
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await self._close_ws_pools()
 
         #   We never get here, but `run` is supposed to be a generator, so we need a yield
-        yield
+        yield  # pylint: disable=unreachable
+
+    async def _process_requests(self):
+        while True:
+            req, fut = await self._get_request()
+            scheduler = self.scheduler_of(fut)
+            batch = [(req, fut)] + scheduler.take_reserved(self, self._batch_limit(scheduler))
+            for batch_req, batch_fut in batch:
+                self._remember_scheduler(scheduler, batch_fut)
+                self._start_processing(batch_req, batch_fut)
+
+            if self.MULTIPLEXING:
+                #   Every request is a separate stream, so the whole batch is sent at once
+                await self._process_concurrently(scheduler, batch)
+            elif len(batch) > 1 and all(batch_req.stream is None for batch_req, _ in batch):
+                await self._process_batch(scheduler, batch)
+            else:
+                for batch_req, batch_fut in batch:
+                    await self._process_request(scheduler, batch_req, batch_fut)
+
+    async def _process_concurrently(
+        self, scheduler: 'Scheduler', batch: 'List[Tuple[Request, asyncio.Future]]',
+    ) -> None:
+        '''
+        If one of the requests fails the service, the other ones are cancelled before the error is raised - they stay
+        in `in_flight`, so they are restarted on another provider (and are not processed here at the same time).
+        '''
+        tasks = [asyncio.ensure_future(self._process_request(scheduler, *item)) for item in batch]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    def _batch_limit(self, scheduler: 'Scheduler') -> 'Optional[int]':
+        '''How many of the requests reserved for us (-> take_reserved) are processed together with the first one'''
+        if self.MULTIPLEXING:
+            #   Every request is a separate stream anyway
+            return None
+        if not self.PIPELINING:
+            #   Requests would be sent one after another, other workers/services can process them concurrently
+            return 0
+        reserved_cnt = scheduler.reserved_cnt(self)
+        return math.ceil((reserved_cnt + 1) / self.concurrency) - 1
+
+    async def _process_request(self, scheduler: 'Scheduler', req: 'Request', fut: asyncio.Future) -> None:
+        try:
+            res = await self._with_504_guard(scheduler, self._handle_request, req, self.ports[scheduler])
+        except (aiohttp.ClientError, ConnectionError) as e:
+            if req.is_replayable:
+                raise
 
-    async def _handle_request_with_504_guard(self, req):
+            #   Streamed body was already (partially) sent, so the request can't be restarted on another provider.
+            #   Only this request fails, the service keeps processing the other ones.
+            self._fail_processing(fut, ConnectionError(
+                f"Request failed on {self.provider_name} after the streamed request body was sent: {e}"
+            ))
+            return
+        self._finish_processing(fut, res)
+
+    async def _process_batch(self, scheduler: 'Scheduler', batch: 'List[Tuple[Request, asyncio.Future]]') -> None:
+        while batch:
+            reqs = [req for req, _ in batch]
+            responses = await self._with_504_guard(scheduler, self._handle_batch, reqs, self.ports[scheduler])
+            for (_, fut), res in zip(batch, responses):
+                self._finish_processing(fut, res)
+            batch = batch[len(responses):]
+
+    async def shutdown(self):
+        await self._close_ws_pools()
+        async for script in super().shutdown():
+            yield script
+
+    async def _with_504_guard(
+        self, scheduler: 'Scheduler', handler: 'Callable[..., Awaitable[T]]', *args: 'Any',
+    ) -> 'T':
         max_attempts = 3
         for _ in range(max_attempts):
             try:
-                return await self._handle_request(req)
+                return await handler(*args)
             except aiohttp.WSServerHandshakeError:
-                pass
+                RETRIES.inc(provider=self.provider_name)
+                scheduler.report_handshake_failure(self)
         raise Exception(f"Provider {self.provider_name} had WSServerHandshakeError {max_attempts} times in a row")
 
-    async def _handle_request(self, req):
-        async with aiohttp.ClientSession(headers=self._ws_headers) as ws_session:
-            async with ws_session.ws_connect(self._ws_url) as ws:
-                print(f"processing {req.url} on {self.provider_name}")
-                request_str = req.as_raw_request_str()
-                await ws.send_str(request_str)
-                headers = await ws.__anext__()
-                content = await ws.__anext__()
+    async def _handle_request(self, req: 'Request', port: int) -> 'Response':
+        if self.MULTIPLEXING:
+            return await self._handle_mux_request(req, port)
+
+        pool = self._get_ws_pool(port)
+        conn = HTTPConnection(await pool.acquire(), self.provider_name)
+        try:
+            res = await self._send_request(conn, req)
+        except (aiohttp.ClientError, ConnectionError):
+            pool.release(conn.ws, reusable=False)
+            if not req.is_replayable:
+                raise
+
+            #   Most probably the tunnel was closed by the other side while idle in the pool,
+            #   so we try once more on a fresh one
+            RETRIES.inc(provider=self.provider_name)
+            conn = HTTPConnection(await pool.connect(), self.provider_name)
+            try:
+                res = await self._send_request(conn, req)
+            except BaseException:
+                pool.release(conn.ws, reusable=False)
+                raise
 
-        res = Response.from_wsmessages(headers, content)
+        #   Response body is streamed by the caller. Tunnel goes back to the pool when the whole body was received
+        #   (and only if the server keeps the connection alive).
+        def on_close(complete: bool) -> None:
+            pool.release(conn.ws, reusable=complete and conn.reusable)
+        res.stream = WebsocketBodyStream(conn, on_close)
         return res
 
+    async def _send_request(self, conn: HTTPConnection, req: 'Request') -> 'Response':
+        logger.debug("Processing %s on %s", req.url, self.provider_name)
+        await conn.send_request(req)
+        return await conn.receive_response()
+
+    async def _handle_mux_request(self, req: 'Request', port: int) -> 'Response':
+        try:
+            return await self._send_mux_request(await self._get_mux(), req, port)
+        except (aiohttp.ClientError, ConnectionError):
+            if not req.is_replayable:
+                raise
+
+            #   Most probably the tunnel was closed, so we try once more on a new one
+            RETRIES.inc(provider=self.provider_name)
+            return await self._send_mux_request(await self._get_mux(), req, port)
+
+    async def _send_mux_request(self, mux: 'MuxConnection', req: 'Request', port: int) -> 'Response':
+        logger.debug("Processing %s on %s (multiplexed)", req.url, self.provider_name)
+        stream = mux.open_stream()
+        head = {'method': req.method, 'url': req.url, 'headers': req.headers, 'port': port}
+        has_body = req.stream is not None or bool(req.data)
+        try:
+            await stream.send_head(head, end_stream=not has_body)
+            if has_body:
+                async for chunk in req.aiter_body():
+                    await stream.send_data(chunk)
+                await stream.send_data(b'', end_stream=True)
+            res_head = await stream.receive_head()
+        except BaseException:
+            await stream.send_reset()
+            raise
+
+        res = Response(res_head['status'], b'', res_head['headers'])
+        res.stream = MuxBodyStream(stream)
+        return res
+
+    async def _get_mux(self) -> 'MuxConnection':
+        async with self._mux_lock:
+            if self._mux is None or self._mux.closed:
+                await self._close_mux()
+                self._mux_ws = await self._get_ws_pool(self.SIDECAR_PORT).connect()
+                self._mux = open_mux(self._mux_ws, self.provider_name, self.COMPRESSION)
+            return self._mux
+
+    async def _close_mux(self) -> None:
+        if self._mux is not None:
+            await self._mux.close()
+            self._mux = None
+        if self._mux_ws is not None:
+            await self._mux_ws.close()
+            self._mux_ws = None
+
+    async def _handle_batch(self, reqs: 'List[Request]', port: int) -> 'List[Response]':
+        '''
+        Responses for (a prefix of) reqs, bodies are already received. Connection is retried only if it failed
+        before any response was received, otherwise the rest of the batch is sent again by `_process_batch`.
+        '''
+        pool = self._get_ws_pool(port)
+        conn = HTTPConnection(await pool.acquire(), self.provider_name)
+        try:
+            responses = await conn.send_many(reqs, self.PIPELINING)
+        except (aiohttp.ClientError, ConnectionError):
+            pool.release(conn.ws, reusable=False)
+            RETRIES.inc(provider=self.provider_name)
+            conn = HTTPConnection(await pool.connect(), self.provider_name)
+            try:
+                responses = await conn.send_many(reqs, self.PIPELINING)
+            except BaseException:
+                pool.release(conn.ws, reusable=False)
+                raise
+        logger.debug("Processed %s requests from a batch on %s", len(responses), self.provider_name)
+        pool.release(conn.ws, reusable=conn.reusable)
+        return responses
+
+    def _get_ws_pool(self, port: int) -> WebsocketPool:
+        if port not in self._ws_pools:
+            self._ws_pools[port] = WebsocketPool(self._ws_url(port), self._ws_headers, self.provider_name)
+        return self._ws_pools[port]
+
+    async def _close_ws_pools(self) -> None:
+        await self._close_mux()
+        for pool in self._ws_pools.values():
+            await pool.close()
+
     @property
     def _ws_headers(self):
         app_key = self.cluster._engine._api_config.app_key  # pylint: disable=protected-access
         return {"Authorization": f"Bearer {app_key}"}
 
-    @property
-    def _ws_url(self):
-        return self.network_node.get_websocket_uri(80)
+    def _ws_url(self, port):
+        return self.network_node.get_websocket_uri(port)
@@ -0,0 +1,100 @@
+import asyncio
+from collections import deque
+from typing import TYPE_CHECKING
+
+import aiohttp
+
+from ..metrics import HANDSHAKE_TIME
+
+if TYPE_CHECKING:
+    from typing import Deque, Dict, Optional, Tuple
+
+
+class WebsocketPool:
+    '''
+    Long-lived `aiohttp.ClientSession` together with a small pool of websocket tunnels to a single
+    provider port.
+
+    Tunnels are handed out by `acquire` and given back by `release`. Released tunnels that are still
+    open are kept for later reuse, so we don't pay for a new websocket handshake with every request.
+    A tunnel is considered healthy if it is not closed, did not fail and was idle for less than
+    `idle_timeout` seconds. Liveness of the idle tunnels is ensured by the websocket heartbeat
+    (aiohttp closes the connection if there is no answer to a ping).
+    '''
+
+    #   How many idle tunnels are kept open
+    MAX_IDLE_CNT = 4
+
+    #   Idle tunnels older than this (seconds) are closed instead of reused
+    IDLE_TIMEOUT = 30
+
+    #   Ping interval (seconds) for the open tunnels
+    HEARTBEAT = 10
+
+    def __init__(self, url: str, headers: 'Dict[str, str]', provider_name: 'Optional[str]' = None):
+        self.url = url
+        self.headers = headers
+
+        #   Only for metrics
+        self.provider_name = provider_name
+
+        self._session: 'Optional[aiohttp.ClientSession]' = None
+
+        #   (websocket, time when it was released) pairs, most recently released last
+        self._idle: 'Deque[Tuple[aiohttp.ClientWebSocketResponse, float]]' = deque()
+
+    async def acquire(self) -> 'aiohttp.ClientWebSocketResponse':
+        '''Return a healthy idle tunnel or a new one if there are none'''
+        self._remove_expired()
+        while self._idle:
+            #   Most recently used tunnels are the ones most likely to be still alive
+            ws, _ = self._idle.pop()
+            if self._is_healthy(ws):
+                return ws
+            await ws.close()
+        return await self.connect()
+
+    async def connect(self) -> 'aiohttp.ClientWebSocketResponse':
+        '''Open a new tunnel (bypassing the idle ones)'''
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(headers=self.headers)
+        with HANDSHAKE_TIME.time(provider=self.provider_name):
+            return await self._session.ws_connect(self.url, heartbeat=self.HEARTBEAT)
+
+    def release(self, ws: 'aiohttp.ClientWebSocketResponse', reusable: bool) -> None:
+        '''Give back a tunnel acquired with `acquire`/`connect`.
+
+        `reusable` should be True only if the tunnel is in a clean state, i.e. whole response
+        was already read and the server declared it will keep the connection open.'''
+        if reusable and self._is_healthy(ws) and len(self._idle) < self.MAX_IDLE_CNT:
+            self._idle.append((ws, self._now()))
+        else:
+            self._close_in_background(ws)
+        self._remove_expired()
+
+    async def close(self) -> None:
+        while self._idle:
+            ws, _ = self._idle.pop()
+            await ws.close()
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    @staticmethod
+    def _is_healthy(ws: 'aiohttp.ClientWebSocketResponse') -> bool:
+        return not ws.closed and ws.exception() is None
+
+    def _remove_expired(self) -> None:
+        now = self._now()
+        while self._idle and now - self._idle[0][1] > self.IDLE_TIMEOUT:
+            ws, _ = self._idle.popleft()
+            self._close_in_background(ws)
+
+    @staticmethod
+    def _close_in_background(ws: 'aiohttp.ClientWebSocketResponse') -> None:
+        if not ws.closed:
+            asyncio.get_event_loop().create_task(ws.close())
+
+    @staticmethod
+    def _now() -> float:
+        return asyncio.get_event_loop().time()
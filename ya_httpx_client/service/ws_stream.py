@@ -0,0 +1,117 @@
+'''
+HTTP/1.1 over a websocket tunnel to the provider (i.e. over a TCP connection to the provider-side server).
+'''
+from typing import TYPE_CHECKING
+
+import aiohttp
+
+from ..http11 import AbstractHTTPConnection
+from ..metrics import BYTES_RECEIVED, BYTES_SENT
+from ..mux import MuxConnection
+
+if TYPE_CHECKING:
+    from typing import AsyncIterator, Callable, Optional
+    from ..compression import Compression
+    from ..mux import MuxStream
+
+
+async def receive_bytes(ws: 'aiohttp.ClientWebSocketResponse') -> 'Optional[bytes]':
+    '''Next chunk of data received over the websocket, or None if it was closed'''
+    msg = await ws.receive()
+    if msg.type == aiohttp.WSMsgType.BINARY:
+        return msg.data
+    if msg.type == aiohttp.WSMsgType.TEXT:
+        return msg.data.encode()
+    if msg.type == aiohttp.WSMsgType.ERROR:
+        raise ConnectionError(f"Websocket error: {ws.exception()}")
+    return None
+
+
+class HTTPConnection(AbstractHTTPConnection):
+    '''
+    HTTP/1.1 connection over a websocket tunnel to the provider (i.e. over a TCP connection to the provider-side
+    server). `provider_name` is used only in metrics.
+    '''
+    def __init__(self, ws: 'aiohttp.ClientWebSocketResponse', provider_name: 'Optional[str]' = None):
+        super().__init__()
+        self.ws = ws
+        self.provider_name = provider_name
+
+    async def _receive_bytes(self) -> 'Optional[bytes]':
+        try:
+            data = await receive_bytes(self.ws)
+        except aiohttp.ClientError as e:
+            raise ConnectionError(f"Websocket error: {e}") from e
+        if data:
+            BYTES_RECEIVED.inc(len(data), provider=self.provider_name)
+        return data
+
+    async def _write(self, data: bytes) -> None:
+        try:
+            await self.ws.send_bytes(data)
+        except aiohttp.ClientError as e:
+            raise ConnectionError(f"Websocket error: {e}") from e
+        BYTES_SENT.inc(len(data), provider=self.provider_name)
+
+
+class WebsocketBodyStream:
+    '''
+    Body of a HTTP response that is still being received over a websocket tunnel.
+
+    `on_close` is called exactly once, when the body was fully received or the stream was closed before that,
+    with a single argument: True if the whole body was received, False otherwise.
+    '''
+    def __init__(self, conn: HTTPConnection, on_close: 'Callable[[bool], None]'):
+        self.conn = conn
+        self.on_close = on_close
+        self._closed = False
+
+    async def __aiter__(self) -> 'AsyncIterator[bytes]':
+        complete = False
+        try:
+            async for chunk in self.conn.aiter_body():
+                yield chunk
+            complete = True
+        finally:
+            self._close(complete)
+
+    async def aclose(self) -> None:
+        self._close(False)
+
+    def _close(self, complete: bool) -> None:
+        if not self._closed:
+            self._closed = True
+            self.on_close(complete)
+
+
+def open_mux(
+    ws: 'aiohttp.ClientWebSocketResponse', provider_name: 'Optional[str]' = None,
+    compression: 'Optional[Compression]' = None,
+) -> MuxConnection:
+    '''Multiplexed connection to the provider-side sidecar over a websocket tunnel (-> ya_httpx_client.mux)'''
+    async def receive() -> 'Optional[bytes]':
+        data = await receive_bytes(ws)
+        if data:
+            BYTES_RECEIVED.inc(len(data), provider=provider_name)
+        return data
+
+    async def send(data: bytes) -> None:
+        await ws.send_bytes(data)
+        BYTES_SENT.inc(len(data), provider=provider_name)
+
+    conn = MuxConnection(receive, send, compression)
+    conn.start()
+    return conn
+
+
+class MuxBodyStream:
+    '''Body of a HTTP response received over a multiplexed stream. Stream is reset if it is closed before the end.'''
+    def __init__(self, stream: 'MuxStream'):
+        self.stream = stream
+
+    async def __aiter__(self) -> 'AsyncIterator[bytes]':
+        async for chunk in self.stream.aiter_data():
+            yield chunk
+
+    async def aclose(self) -> None:
+        await self.stream.send_reset()
@@ -1,12 +1,20 @@
 import asyncio
+import logging
 import sys
 from typing import TYPE_CHECKING
 
 import httpx
 from yapapi_service_manager import ServiceManager
 
-from .serializable_request import Request
+from .admission import ClusterOverloaded
+from .cache import CachingTransport
+from .serializable_request import Request, Response
 from .cluster import Cluster
+from .health import default_strategy
+from .journal import JOURNAL_ID_HEADER
+from .metrics import HEDGED_REQUESTS, QUEUE_WAIT, REQUESTS, SERVICE_TIME, span
+from .performance import PerformanceStrategy
+from .scheduler import PRIORITY_HEADER
 from .network_wrapper import NetworkWrapper
 
 if sys.version_info >= (3, 7):
@@ -15,27 +23,286 @@ else:
     from async_generator import asynccontextmanager
 
 if TYPE_CHECKING:
-    from typing import Dict, Callable, SupportsInt, Union, AsyncGenerator, Tuple, Optional
+    from typing import Any, Dict, Callable, SupportsInt, Union, AsyncGenerator, AsyncIterator, Tuple, Optional, List
+    from .admission import AdmissionController
+    from .cache import ResponseCache
+    from .health import HealthPolicy
+    from .hedging import HedgingPolicy
+    from .journal import RequestJournal
+    from .performance import PerformanceStore
+    from .scheduler import Scheduler
+
+logger = logging.getLogger(__name__)
+
+
+class YagnaResponseStream(httpx.AsyncByteStream):
+    '''Body of the response, either already received or streamed from the provider'''
+    def __init__(self, res: 'Response'):
+        self.res = res
+
+    async def __aiter__(self) -> 'AsyncIterator[bytes]':
+        if self.res.stream is None:
+            yield self.res.data
+        else:
+            async for chunk in self.res.stream:
+                yield chunk
+
+    async def aclose(self) -> None:
+        aclose = getattr(self.res.stream, 'aclose', None)
+        if aclose is not None:
+            await aclose()
 
 
 class YagnaTransport(httpx.AsyncBaseTransport):
     '''
     https://www.python-httpx.org/advanced/#writing-custom-transports
+
+    Timeouts passed to httpx are honoured: `pool` timeout limits the time request waits in the scheduler for a free
+    service, `read` timeout limits the time between the moment a service took the request and the response.
+
+    If `admission` is set, requests wait there before they are submitted to the scheduler (-> admission.py).
+
+    If `journal` is set, requests (except for the streamed ones) are stored there until the response is returned,
+    so that they can be replayed after a restart (-> journal.py).
+
+    `name` is the name of the cluster, used in metrics and in the journal.
     '''
-    def __init__(self, request_queue):
-        self.request_queue = request_queue
+    def __init__(
+        self, scheduler: 'Scheduler', hedging: 'Optional[HedgingPolicy]' = None, name: str = '',
+        admission: 'Optional[AdmissionController]' = None, journal: 'Optional[RequestJournal]' = None,
+    ):
+        # pylint: disable=too-many-arguments
+        self.scheduler = scheduler
+        self.hedging = hedging
+        self.name = name
+        self.admission = admission
+        self.journal = journal
 
     async def handle_async_request(self, method, url, headers, stream, extensions):
         # pylint: disable=too-many-arguments
         req = Request.from_httpx_handle_request_args(method, url, headers, stream)
-        fut = asyncio.Future()
-        self.request_queue.put_nowait((req, fut))
-        res = await fut
-        return res.status, res.headers, httpx.ByteStream(res.data), {}
+        entry_id, replayed = self._journal_entry(req)
+        if entry_id is None:
+            return await self._handle_request(req, extensions)
+
+        await self.journal.sync()
+        try:
+            result = await self._handle_request(req, extensions)
+        except asyncio.CancelledError:  # pylint: disable=try-except-raise
+            #   Requestor might be shutting down, request stays in the journal and will be replayed
+            raise
+        except httpx.TransportError:
+            #   Replayed request was not processed (e.g. no providers yet, or ClusterOverloaded), we'll try again
+            #   after the next restart. A new request is the caller's business - caller got the exception.
+            if not replayed:
+                self.journal.complete(entry_id)
+            raise
+        except Exception:
+            self.journal.complete(entry_id)
+            raise
+        self.journal.complete(entry_id)
+        return result
+
+    def _journal_entry(self, req: 'Request') -> 'Tuple[Optional[int], bool]':
+        '''
+        Id of the journal entry of the request (a new one, or the old one if this request is replayed),
+        and True if the request is replayed
+        '''
+        header_value = req.pop_header(JOURNAL_ID_HEADER)
+        if self.journal is None:
+            return None, False
+        if header_value is not None:
+            replayed_entry_id = self.journal.replayed_entry_id(header_value)
+            if replayed_entry_id is not None:
+                return replayed_entry_id, True
+        if req.stream is not None:
+            return None, False
+        return self.journal.add(self.name, req), False
+
+    async def _handle_request(self, req: 'Request', extensions):
+        priority = req.pop_header(PRIORITY_HEADER)
+        if priority is not None:
+            try:
+                req.priority = int(priority)
+            except ValueError:
+                logger.warning("Ignoring invalid %s header: %r", PRIORITY_HEADER, priority)
+
+        span_attributes = {'http.method': req.method, 'http.url': req.url, 'yhc.cluster': self.name}
+        with span('ya_httpx_client.request', span_attributes) as current_span:
+            try:
+                res = await self._send(req, extensions.get('timeout', {}))
+            except httpx.TimeoutException:
+                REQUESTS.inc(cluster=self.name, result='timeout')
+                raise
+            except ClusterOverloaded:
+                REQUESTS.inc(cluster=self.name, result='rejected')
+                raise
+            except Exception:
+                REQUESTS.inc(cluster=self.name, result='error')
+                raise
+            REQUESTS.inc(cluster=self.name, result='ok')
+            if current_span is not None:
+                current_span.set_attribute('http.status_code', res.status)
+        return res.status, res.headers, YagnaResponseStream(res), {}
+
+    async def _send(self, req: 'Request', timeout: 'Dict[str, Optional[float]]') -> 'Response':
+        if self.admission is None:
+            return await self._send_admitted(req, timeout)
+
+        admitted_at = await self.admission.acquire(req.priority, timeout.get('pool'))
+        #   Only failures of the providers count, 5xx responses of the application don't slow down the whole cluster
+        failed: 'Optional[bool]' = None
+        try:
+            res = await self._send_admitted(req, timeout)
+            failed = res.is_provider_error
+            return res
+        except (httpx.TransportError, ConnectionError):
+            failed = True
+            raise
+        finally:
+            self.admission.release(admitted_at, failed)
+
+    async def _send_admitted(self, req: 'Request', timeout: 'Dict[str, Optional[float]]') -> 'Response':
+        loop = asyncio.get_event_loop()
+        submitted_at = loop.time()
+
+        fut = loop.create_future()
+        self._submit(req, fut)
+        try:
+            await asyncio.wait_for(self.scheduler.wait_started(fut), timeout.get('pool'))
+        except asyncio.TimeoutError as e:
+            fut.cancel()
+            raise httpx.PoolTimeout(f"Request waited more than {timeout['pool']}s for a free provider") from e
+
+        started_at = loop.time()
+        QUEUE_WAIT.observe(started_at - submitted_at, cluster=self.name)
+
+        try:
+            res, service = await asyncio.wait_for(self._get_response(req, fut), timeout.get('read'))
+        except asyncio.TimeoutError as e:
+            self.scheduler.report_timeout(fut)
+            raise httpx.ReadTimeout(f"No response in {timeout['read']}s") from e
+        provider_name = getattr(service, 'provider_name', None)
+        SERVICE_TIME.observe(loop.time() - started_at, cluster=self.name, provider=provider_name)
+        return res
+
+    def _submit(self, req: 'Request', fut: asyncio.Future) -> None:
+        self.scheduler.submit(req, fut)
+
+    async def _get_response(self, req: 'Request', fut: asyncio.Future) -> 'Tuple[Response, Any]':
+        '''
+        Wait for the response. If hedging applies, send the request also to another provider after a delay.
+        Returns the response and the service that sent it.
+
+        NOTE: the losing request is only abandoned: if a service already took it, provider processes it to the end
+        (and the response is discarded) - hedging adds this much extra load on the providers.
+        '''
+        futures: 'List[asyncio.Future]' = [fut]
+
+        #   Request future -> service that processes it (scheduler forgets this when the request is done)
+        services: 'Dict[asyncio.Future, Any]' = {fut: self.scheduler.service_of(fut)}
+        hedge_started: 'Optional[asyncio.Future]' = None
+        try:
+            if self.hedging is not None and self.hedging.applies_to(req):
+                await asyncio.wait(futures, timeout=self.hedging.delay(self.scheduler))
+                if not fut.done() and self.hedging.should_hedge(self.scheduler):
+                    hedge_fut = asyncio.get_event_loop().create_future()
+                    self.scheduler.submit(req, hedge_fut, exclude={services[fut]})
+                    futures.append(hedge_fut)
+                    HEDGED_REQUESTS.inc(cluster=self.name)
+
+                    hedge_started = asyncio.ensure_future(self.scheduler.wait_started(hedge_fut))
+                    hedge_started.add_done_callback(
+                        lambda _: services.setdefault(hedge_fut, self.scheduler.service_of(hedge_fut)),
+                    )
+
+            #   First successful response wins, we fail only if all requests failed
+            pending = set(futures)
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for done_fut in done:
+                    if done_fut.exception() is None:
+                        return done_fut.result(), services.get(done_fut)
+                if not pending:
+                    done_fut = done.pop()
+                    return done_fut.result(), services.get(done_fut)
+        finally:
+            if hedge_started is not None:
+                hedge_started.cancel()
+            for not_needed_fut in futures:
+                not_needed_fut.cancel()
+
+
+class BatchingTransport(YagnaTransport):
+    '''
+    YagnaTransport that groups small requests: requests sent within `window` seconds (but at most `max_batch_size`
+    of them) are submitted as a single batch, processed by a single service (-> Scheduler.submit_batch).
+    Each request still gets its own response.
+    '''
+    #   Requests with larger (or streamed) bodies are never batched
+    MAX_BODY_SIZE = 64 * 1024
+
+    def __init__(
+        self, scheduler: 'Scheduler', hedging: 'Optional[HedgingPolicy]' = None,
+        window: float = 0.005, max_batch_size: int = 32, name: str = '',
+        admission: 'Optional[AdmissionController]' = None, journal: 'Optional[RequestJournal]' = None,
+    ):
+        # pylint: disable=too-many-arguments
+        super().__init__(scheduler, hedging, name, admission, journal)
+        self.window = window
+        self.max_batch_size = max_batch_size
+
+        #   priority -> requests waiting for the end of the window
+        self._batches: 'Dict[int, List[Tuple[Request, asyncio.Future]]]' = {}
+        self._flush_handle: 'Optional[asyncio.TimerHandle]' = None
+
+    def _submit(self, req: 'Request', fut: asyncio.Future) -> None:
+        if req.stream is not None or len(req.data) > self.MAX_BODY_SIZE:
+            super()._submit(req, fut)
+            return
+
+        batch = self._batches.setdefault(req.priority, [])
+        batch.append((req, fut))
+        if len(batch) >= self.max_batch_size:
+            self.scheduler.submit_batch(self._batches.pop(req.priority))
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_event_loop().call_later(self.window, self._flush)
+
+    def _flush(self) -> None:
+        self._flush_handle = None
+        batches, self._batches = self._batches, {}
+        for batch in batches.values():
+            self.scheduler.submit_batch(batch)
+
+    async def aclose(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush()
 
 
 class Session:
-    def __init__(self, executor_cfg: dict):
+    def __init__(
+        self,
+        executor_cfg: dict,
+        health: 'Optional[HealthPolicy]' = None,
+        performance: 'Optional[PerformanceStore]' = None,
+        journal: 'Optional[RequestJournal]' = None,
+    ):
+        #   Offers from the providers known to be fast are preferred. Pass a PerformanceStrategy in
+        #   `executor_cfg['strategy']` to change how the performance and the price are weighted.
+        self.performance = performance
+        if performance is not None and not isinstance(executor_cfg.get('strategy'), PerformanceStrategy):
+            base_strategy = executor_cfg.get('strategy') or default_strategy()
+            executor_cfg = {**executor_cfg, 'strategy': PerformanceStrategy(base_strategy, performance)}
+
+        #   Offers from the providers blacklisted by the health policy are rejected
+        self.health = health
+        if health is not None:
+            executor_cfg = {**executor_cfg, 'strategy': health.strategy(executor_cfg.get('strategy'))}
+
+        #   Requests are journaled, those left by the previous run are replayed by the first client
+        self.journal = journal
+
         self.manager = ServiceManager(executor_cfg)
         self.clusters: 'Dict[str, Cluster]' = {}
         self.network_wrapper = NetworkWrapper(self.manager)
@@ -43,29 +310,107 @@ class Session:
     def set_cluster_size(self, url: str, size: 'Union[int, Callable[[Cluster], SupportsInt]]') -> None:
         self.clusters[url].set_size(size)
 
+    def set_spare_cluster_size(self, url: str, size: 'Union[int, Callable[[Cluster], SupportsInt]]') -> None:
+        self.clusters[url].set_spare_size(size)
+
     def add_url(
         self,
         url: str,
         image_hash: str,
         entrypoint: 'Optional[Tuple[str, ...]]' = None,
-        init_cluster_size: 'Union[int, Callable[[Cluster], SupportsInt]]' = 1
+        init_cluster_size: 'Union[int, Callable[[Cluster], SupportsInt]]' = 1,
+        provider_concurrency: int = 1,
+        scheduler: 'Optional[Scheduler]' = None,
+        init_spare_size: 'Union[int, Callable[[Cluster], SupportsInt]]' = 0,
+        hedging: 'Optional[HedgingPolicy]' = None,
+        admission: 'Optional[AdmissionController]' = None,
+        port: int = 80,
     ) -> None:
+        # pylint: disable=too-many-arguments
         if url in self.clusters:
             raise KeyError(f'Service for url {url} already exists')
 
-        self.clusters[url] = Cluster(self.manager, image_hash, entrypoint, self.network_wrapper)
+        self.clusters[url] = Cluster(
+            self.manager, image_hash, entrypoint, self.network_wrapper,
+            provider_concurrency=provider_concurrency, scheduler=scheduler, hedging=hedging, name=url,
+            health=self.health, performance=self.performance, admission=admission, port=port,
+        )
         self.set_cluster_size(url, init_cluster_size)
+        self.set_spare_cluster_size(url, init_spare_size)
+
+    def add_colocated_url(
+        self,
+        url: str,
+        host_url: str,
+        port: int,
+        scheduler: 'Optional[Scheduler]' = None,
+        hedging: 'Optional[HedgingPolicy]' = None,
+        admission: 'Optional[AdmissionController]' = None,
+    ) -> None:
+        '''
+        Requests for `url` are processed on the providers of `host_url`, by a server listening on `port` (started
+        by the `host_url` image entrypoint). Requests are scheduled separately for every url, but services of the
+        `host_url` (and their `provider_concurrency`) are shared.
+        '''
+        # pylint: disable=too-many-arguments
+        if url in self.clusters:
+            raise KeyError(f'Service for url {url} already exists')
+
+        host = self.clusters[host_url]
+        guest = Cluster(
+            self.manager, host.image_hash, None, self.network_wrapper,
+            scheduler=scheduler, hedging=hedging, name=url, admission=admission, port=port,
+        )
+        host.colocate(guest)
+        self.clusters[url] = guest
 
     @asynccontextmanager
-    async def client(self, *args, **kwargs) -> 'AsyncGenerator[httpx.AsyncClient, None]':
+    async def client(
+        self,
+        *args,
+        cache: 'Optional[ResponseCache]' = None,
+        batch_window: 'Optional[float]' = None,
+        max_batch_size: int = 32,
+        **kwargs,
+    ) -> 'AsyncGenerator[httpx.AsyncClient, None]':
+        '''
+        httpx.AsyncClient that sends requests for our urls to the providers. All arguments are passed to the
+        AsyncClient, except for:
+
+        *   `cache` - if set, cacheable responses are stored there (-> ya_httpx_client.cache)
+        *   `batch_window` - if set, small requests sent within this number of seconds (up to `max_batch_size`
+            of them) are processed together by a single service (-> BatchingTransport)
+        '''
         self.start_new_services()
 
+        #   Default httpx timeouts (5s) are too short for requests that wait for a provider to start
+        kwargs.setdefault('timeout', None)
+
         mounts = kwargs.pop('mounts', {})
-        yagna_mounts = {url: YagnaTransport(cluster.request_queue) for url, cluster in self.clusters.items()}
+        yagna_mounts: 'Dict[str, httpx.AsyncBaseTransport]' = {}
+        for url, cluster in self.clusters.items():
+            if batch_window is None:
+                yagna_mounts[url] = YagnaTransport(
+                    cluster.scheduler, cluster.hedging, name=url, admission=cluster.admission, journal=self.journal,
+                )
+            else:
+                yagna_mounts[url] = BatchingTransport(
+                    cluster.scheduler, cluster.hedging, batch_window, max_batch_size, name=url,
+                    admission=cluster.admission, journal=self.journal,
+                )
+        if cache is not None:
+            yagna_mounts = {url: CachingTransport(transport, cache) for url, transport in yagna_mounts.items()}
         kwargs['mounts'] = {**mounts, **yagna_mounts}
 
         async with httpx.AsyncClient(*args, **kwargs) as client:
-            yield client
+            replay_task = None
+            if self.journal is not None:
+                replay_task = asyncio.ensure_future(self.journal.replay(client, self.clusters))
+            try:
+                yield client
+            finally:
+                if replay_task is not None:
+                    replay_task.cancel()
 
     def start_new_services(self) -> None:
         for cluster in self.clusters.values():
@@ -76,3 +421,5 @@ class Session:
             cluster.stop()
         await self.network_wrapper.remove_network()
         await self.manager.close()
+        if self.journal is not None:
+            await self.journal.close()
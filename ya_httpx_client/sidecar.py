@@ -0,0 +1,188 @@
+'''
+Provider-side sidecar for the multiplexed VPN communication (-> VPNService.MULTIPLEXING).
+
+Listens on a single port. Every connection (i.e. a tunnel from the requestor) carries many concurrent requests
+(-> ya_httpx_client.mux), each of them is forwarded to the local HTTP server on the port given by the requestor.
+Connections to the servers are kept alive and reused by the following requests.
+
+Started by the VPNService before the entrypoint:
+
+    python -m ya_httpx_client.sidecar --port 8888 --pid-file /golem/work/sidecar.pid
+'''
+import asyncio
+import logging
+import os
+from collections import deque
+from typing import TYPE_CHECKING
+
+import click
+
+from ya_httpx_client.compression import compression_options
+from ya_httpx_client.http11 import AbstractHTTPConnection
+from ya_httpx_client.mux import MuxConnection
+from ya_httpx_client.serializable_request import PROVIDER_ERROR_HEADER, Request
+
+if TYPE_CHECKING:
+    from typing import Deque, Dict, Optional, Tuple
+    from ya_httpx_client.compression import Compression
+    from ya_httpx_client.mux import MuxStream
+    from ya_httpx_client.serializable_request import Response
+
+    Connection = Tuple[asyncio.StreamReader, asyncio.StreamWriter]
+
+logger = logging.getLogger(__name__)
+
+READ_SIZE = 64 * 1024
+
+
+class UpstreamConnection(AbstractHTTPConnection):
+    '''HTTP/1.1 connection to the local server, `reused` if it was taken from the idle pool'''
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, reused: bool = False):
+        super().__init__()
+        self.reader = reader
+        self.writer = writer
+        self.reused = reused
+
+    async def _receive_bytes(self) -> bytes:
+        return await self.reader.read(READ_SIZE)
+
+    async def _write(self, data: bytes) -> None:
+        self.writer.write(data)
+        await self.writer.drain()
+
+
+class UpstreamPool:
+    '''Idle keep-alive connections to the local servers (at most `max_idle` per port)'''
+    def __init__(self, host: str = '127.0.0.1', max_idle: int = 32):
+        self.host = host
+        self.max_idle = max_idle
+        self._idle: 'Dict[int, Deque[Connection]]' = {}
+
+    async def acquire(self, port: int) -> UpstreamConnection:
+        idle = self._idle.get(port)
+        while idle:
+            reader, writer = idle.pop()
+            if not reader.at_eof() and not writer.transport.is_closing():
+                return UpstreamConnection(reader, writer, reused=True)
+            writer.close()
+        return await self.connect(port)
+
+    async def connect(self, port: int) -> UpstreamConnection:
+        reader, writer = await asyncio.open_connection(self.host, port)
+        return UpstreamConnection(reader, writer)
+
+    def release(self, port: int, conn: UpstreamConnection, reusable: bool) -> None:
+        idle = self._idle.setdefault(port, deque())
+        if reusable and len(idle) < self.max_idle:
+            idle.append((conn.reader, conn.writer))
+        else:
+            conn.writer.close()
+
+
+class Sidecar:
+    def __init__(self, compression: 'Optional[Compression]' = None, upstream_host: str = '127.0.0.1'):
+        self.compression = compression
+        self.upstream = UpstreamPool(upstream_host)
+
+    async def handle_tunnel(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        async def receive() -> bytes:
+            return await reader.read(READ_SIZE)
+
+        async def send(data: bytes) -> None:
+            writer.write(data)
+            await writer.drain()
+
+        conn = MuxConnection(receive, send, self.compression, on_stream=self._stream_started)
+        conn.start()
+        try:
+            await conn.wait_closed()
+        finally:
+            writer.close()
+
+    def _stream_started(self, stream: 'MuxStream') -> None:
+        task = asyncio.ensure_future(self._process_stream(stream))
+        stream.on_reset = task.cancel
+
+    async def _process_stream(self, stream: 'MuxStream') -> None:
+        head = await stream.receive_head()
+        port = head.get('port', 80)
+        req = Request(
+            head['method'], head['url'], b'', head['headers'],
+            stream=stream.aiter_data() if stream.has_body else None,
+        )
+
+        head_sent = False
+        reusable = False
+        conn: 'Optional[UpstreamConnection]' = None
+        try:
+            conn = await self.upstream.acquire(port)
+            try:
+                res = await self._send_request(conn, req)
+            except ConnectionError:
+                if not conn.reused or not req.is_replayable:
+                    raise
+
+                #   Most probably the server closed the idle connection in the meantime,
+                #   so we try once more on a fresh one
+                self.upstream.release(port, conn, reusable=False)
+                conn = None
+                conn = await self.upstream.connect(port)
+                res = await self._send_request(conn, req)
+            await stream.send_head({'status': res.status, 'headers': res.headers})
+            head_sent = True
+            async for chunk in conn.aiter_body():
+                await stream.send_data(chunk)
+            await stream.send_data(b'', end_stream=True)
+            reusable = conn.reusable
+        except asyncio.CancelledError:
+            #   Requestor reset the stream
+            pass
+        except Exception as e:  # pylint: disable=broad-except
+            logger.warning("Request to port %s failed: %s", port, e)
+            await self._report_failure(stream, head_sent, e)
+        finally:
+            if conn is not None:
+                self.upstream.release(port, conn, reusable)
+
+    @staticmethod
+    async def _send_request(conn: UpstreamConnection, req: Request) -> 'Response':
+        await conn.send_request(req)
+        return await conn.receive_response()
+
+    @staticmethod
+    async def _report_failure(stream: 'MuxStream', head_sent: bool, error: Exception) -> None:
+        '''502 response if nothing was sent yet, otherwise the stream is reset'''
+        try:
+            if head_sent:
+                await stream.send_reset(f"Request failed on the provider: {error}")
+            else:
+                headers = {'Content-Type': 'text/plain', PROVIDER_ERROR_HEADER: '1'}
+                await stream.send_head({'status': 502, 'headers': headers})
+                await stream.send_data(f"Sidecar failed to process the request: {error}".encode(), end_stream=True)
+        except ConnectionError:
+            #   Stream was reset or the tunnel was closed in the meantime, there is nobody to tell
+            pass
+
+
+async def serve(port: int, compression: 'Optional[Compression]' = None) -> 'asyncio.AbstractServer':
+    sidecar = Sidecar(compression)
+    return await asyncio.start_server(sidecar.handle_tunnel, '0.0.0.0', port)
+
+
+@click.command()
+@click.option('--port', type=int, required=True, help='Port the requestor connects to')
+@click.option('--pid-file', help='Sidecar PID will be written there when it is ready to accept connections')
+@compression_options
+def run_sidecar(port: int, pid_file: str, compression: 'Optional[Compression]') -> None:
+    logging.basicConfig(level=logging.INFO)
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(serve(port, compression))
+    if pid_file:
+        with open(pid_file, 'w', encoding='utf-8') as f:
+            f.write(str(os.getpid()))
+    loop.run_forever()
+
+
+if __name__ == '__main__':
+    run_sidecar()  # pylint: disable=no-value-for-parameter
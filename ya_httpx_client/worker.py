@@ -0,0 +1,89 @@
+'''
+Long-running provider-side worker for the non-VPN communication.
+
+Requestor uploads a batch file to the INBOX directory (as NAME.part, then renames it to NAME),
+worker processes the batch and writes responses to OUTBOX/NAME (again, NAME.part is renamed
+to NAME only when the file is complete). Python startup and connection setup are paid only once,
+when the worker starts.
+'''
+import os
+import time
+
+from typing import TYPE_CHECKING
+
+import click
+
+from ya_httpx_client.compression import compression_options
+from ya_httpx_client.request_processor import RequestProcessor, replace_unserializable
+from ya_httpx_client.serializable_request import Request, BINARY, FORMATS, to_batch_file
+
+if TYPE_CHECKING:
+    from typing import Optional
+    from ya_httpx_client.compression import Compression
+
+PARTIAL_SUFFIX = '.part'
+
+
+class Worker:
+    #   How often (seconds) the inbox is checked for new files
+    POLL_INTERVAL = 0.005
+
+    def __init__(
+        self, processor: RequestProcessor, inbox: str, outbox: str, fmt: str,
+        compression: 'Optional[Compression]' = None, pid_file: 'Optional[str]' = None,
+    ):
+        # pylint: disable=too-many-arguments
+        self.processor = processor
+        self.inbox = inbox
+        self.outbox = outbox
+        self.fmt = fmt
+        self.compression = compression
+
+        #   Requestor waits for this file, so it is written only when the worker is ready to process batches
+        self.pid_file = pid_file
+
+    def run(self) -> None:
+        os.makedirs(self.inbox, exist_ok=True)
+        os.makedirs(self.outbox, exist_ok=True)
+        if self.pid_file:
+            with open(self.pid_file, 'w', encoding='utf-8') as f:
+                f.write(str(os.getpid()))
+
+        while True:
+            names = sorted(name for name in os.listdir(self.inbox) if not name.endswith(PARTIAL_SUFFIX))
+            for name in names:
+                self.process_file(name)
+            if not names:
+                time.sleep(self.POLL_INTERVAL)
+
+    def process_file(self, name: str) -> None:
+        in_path = os.path.join(self.inbox, name)
+        out_path = os.path.join(self.outbox, name)
+
+        reqs = Request.batch_from_file(in_path, self.fmt)
+        os.remove(in_path)
+
+        #   Failed requests get 502 responses (-> RequestProcessor.send), so one of them doesn't fail the whole batch
+        responses = self.processor.process(reqs)
+
+        to_batch_file(responses, out_path + PARTIAL_SUFFIX, self.fmt, self.compression, replace_unserializable)
+        os.rename(out_path + PARTIAL_SUFFIX, out_path)
+
+
+@click.command()
+@click.option('--url', required=True)
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), default=BINARY)
+@click.option('--concurrency', type=int, default=1, help='Max number of requests (from a batch) sent at the same time')
+@click.option('--pid-file', help='Worker PID will be written there, so that the requestor can check if it is alive')
+@compression_options
+@click.argument('inbox')
+@click.argument('outbox')
+def run_worker(  # pylint: disable=too-many-arguments
+    url: str, fmt: str, concurrency: int, pid_file: str, compression: 'Optional[Compression]', inbox: str, outbox: str,
+) -> None:
+    processor = RequestProcessor(url, concurrency)
+    Worker(processor, inbox, outbox, fmt, compression, pid_file).run()
+
+
+if __name__ == '__main__':
+    run_worker()  # pylint: disable=no-value-for-parameter